@@ -0,0 +1,57 @@
+/*
+ * Clientside callbacks of the excavations app. The time filter is applied inside the
+ * map iframe (see map_elements.ExcavationMarkers), so moving the range slider or
+ * picking a period never reaches the server. The search results are highlighted the
+ * same way (see map_elements.SearchHighlight).
+ */
+(function() {
+    var lastFilter = null;
+    var lastHighlight = null;
+    // Identifies this page load to the server (see flask_app.update_map_and_slider); made
+    // here rather than in the layout, so that the layout stays the same for every visit
+    var sessionId = Math.random().toString(36).slice(2) + Date.now().toString(36);
+
+    function postFilter(filter) {
+        var frame = document.getElementById('map');
+        if (filter && frame && frame.contentWindow) {
+            frame.contentWindow.postMessage(filter, '*');
+        }
+    }
+
+    // The map announces itself once loaded; replay the filter and highlight it may have missed
+    window.addEventListener('message', function(event) {
+        if (event.data && event.data.type === 'excavations-ready') {
+            postFilter(lastFilter);
+            postFilter(lastHighlight);
+        }
+    });
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        excavations: {
+            filter_map: function(rangeValues, timelineDic, filterMode) {
+                lastFilter = {
+                    type: 'excavations-filter',
+                    from_id: timelineDic[String(rangeValues[0])],
+                    until_id: timelineDic[String(rangeValues[1])],
+                    mode: filterMode
+                };
+                postFilter(lastFilter);
+                return lastFilter;
+            },
+            highlight_map: function(results) {
+                lastHighlight = results || null;
+                postFilter(lastHighlight);
+                return lastHighlight;
+            },
+            session_id: function(pathname) {
+                return sessionId;
+            },
+            select_period: function(period, periodRanges) {
+                if (!period || !(period in periodRanges)) {
+                    return window.dash_clientside.no_update;
+                }
+                return periodRanges[period];
+            }
+        }
+    });
+})();
@@ -0,0 +1,129 @@
+'''
+Load test of the excavations app under gunicorn. For every worker count the app is
+started with `gunicorn flask_app:server`, and concurrent clients move the range slider
+to random ranges of the timeline. Every response is checked to contain exactly the
+markers of its own range, so that a render leaking between requests is reported.
+
+Usage (from the excavations_webmap directory, requires the 'serve' extra):
+    python benchmarks/load_test.py --workers 1 2 4 --threads 4 --clients 16 --requests 200
+'''
+
+import argparse
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from map_renderer import FILTER_MODE, feature_store, marks, resolve_range  # noqa: E402
+
+
+def slider_ranges(count, seed=0):
+    '''
+    Returns count random [min, max] values of the range slider, drawn from its marks.
+    '''
+    values = sorted(int(value) for value in marks)
+    generator = random.Random(seed)
+    ranges = []
+    for _ in range(count):
+        a, b = sorted(generator.sample(values, 2))
+        ranges.append([a, b])
+    return ranges
+
+
+def expected_markers(range_values):
+    a, b = resolve_range(range_values)
+    _, properties = feature_store.select(a, b, FILTER_MODE)
+    return len(properties)
+
+
+def update_slider(session, url, range_values, session_id=None):
+    '''
+    Calls the range slider callback and returns (latency, marker count of the document).
+    '''
+    payload = {
+        'output': 'map.srcDoc',
+        'outputs': {'id': 'map', 'property': 'srcDoc'},
+        'inputs': [{'id': 'range-slider', 'property': 'value', 'value': range_values}],
+        'changedPropIds': ['range-slider.value'],
+        'state': [{'id': 'session-id', 'property': 'data', 'value': session_id}],
+    }
+    start = time.perf_counter()
+    response = session.post(url + '/_dash-update-component', json=payload, timeout=120)
+    response.raise_for_status()
+    document = response.json()['response']['map']['srcDoc']
+    return time.perf_counter() - start, document.count('"excavationId"')
+
+
+def wait_ready(url, process, timeout=120):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with code %s' % process.returncode)
+        try:
+            requests.get(url + '/_dash-layout', timeout=5).raise_for_status()
+            return
+        except requests.RequestException:
+            time.sleep(0.5)
+    raise RuntimeError('The app did not start within %s seconds' % timeout)
+
+
+def run(workers, threads, clients, count, port):
+    '''
+    Starts the app with a number of gunicorn workers and returns the load test results.
+    '''
+    url = f'http://127.0.0.1:{port}'
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', str(threads),
+         '--bind', f'127.0.0.1:{port}', '--timeout', '300', '--log-level', 'warning', 'flask_app:server'],
+        cwd=Path(__file__).resolve().parents[1], env={**os.environ, 'WEB_CONCURRENCY': str(workers)})
+    try:
+        wait_ready(url, process)
+        ranges = slider_ranges(count)
+        expected = [expected_markers(range_values) for range_values in ranges]
+        local = threading.local()
+
+        def call(range_values):
+            if not hasattr(local, 'session'):
+                local.session, local.session_id = requests.Session(), uuid.uuid4().hex
+            return update_slider(local.session, url, range_values, local.session_id)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(clients) as executor:
+            results = list(executor.map(call, ranges))
+        elapsed = time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        'workers': workers,
+        'throughput': count / elapsed,
+        'p50': statistics.median(latencies),
+        'p95': latencies[int(0.95 * (len(latencies) - 1))],
+        'mismatches': sum(markers != want for (_, markers), want in zip(results, expected)),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the excavations app under gunicorn.')
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4], help='Worker counts to test')
+    parser.add_argument('--threads', type=int, default=4, help='Threads per worker')
+    parser.add_argument('--clients', type=int, default=16, help='Concurrent clients')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per worker count')
+    parser.add_argument('--port', type=int, default=8091)
+    args = parser.parse_args()
+
+    print(f"{'workers':>8}{'req/s':>10}{'p50 (s)':>10}{'p95 (s)':>10}{'mismatches':>12}")
+    for workers in args.workers:
+        result = run(workers, args.threads, args.clients, args.requests, args.port)
+        print(f"{result['workers']:>8}{result['throughput']:>10.2f}{result['p50']:>10.3f}"
+              f"{result['p95']:>10.3f}{result['mismatches']:>12}")
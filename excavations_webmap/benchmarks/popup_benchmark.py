@@ -0,0 +1,82 @@
+'''
+Benchmark of the excavation popups. The real features are replicated (with new ids)
+up to each dataset size, and the per-render popup cost is measured for:
+
+- uncached: every popup rendered from the template (webmap_folium.feature_popup)
+- cold: the first batch pass of webmap_folium.feature_popups, filling the cache
+- cached: the same batch pass again, assembling the cached fragments
+- filtered: a cached pass over a quarter of the features, as a filtered re-render
+
+Usage (from the excavations_webmap directory):
+    python benchmarks/popup_benchmark.py --sizes 125 10000 100000
+'''
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import webmap_folium  # noqa: E402
+from map_renderer import PHOTO_DIR, feature_store, photo_manifest  # noqa: E402
+from photo_assets import photo_index  # noqa: E402
+
+
+class SyntheticPhotos:
+    '''
+    Photo index of the replicated features: each one shows the photos of its original.
+    '''
+
+    def __init__(self, photos, sources):
+        self._photos = photos
+        self._sources = sources
+
+    def photos(self, id):
+        return self._photos.photos(self._sources.get(id, id))
+
+
+def synthetic_features(size):
+    '''
+    Returns size feature properties cycled from the real ones with unique ids, and the
+    id of the original feature of each one.
+    '''
+    _, properties = feature_store.select()
+    features, sources = [], {}
+    for i in range(size):
+        property = dict(properties[i % len(properties)])
+        sources[i] = property['id']
+        property['id'] = i
+        features.append(property)
+    return features, sources
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def run(size):
+    features, sources = synthetic_features(size)
+    photos = SyntheticPhotos(photo_index(PHOTO_DIR), sources)
+    manifest = photo_manifest()
+    webmap_folium._popups.clear()
+    filtered = features[::4]
+    return {
+        'uncached': timed(lambda: [webmap_folium.feature_popup(p, photos, manifest) for p in features]),
+        'cold': timed(webmap_folium.feature_popups, features, photos, manifest),
+        'cached': timed(webmap_folium.feature_popups, features, photos, manifest),
+        'filtered': timed(webmap_folium.feature_popups, filtered, photos, manifest),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the rendering of the excavation popups.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[125, 10000, 100000], help='Dataset sizes')
+    args = parser.parse_args()
+
+    columns = ['uncached', 'cold', 'cached', 'filtered']
+    print(f"{'features':>10}" + ''.join(f'{column + " (ms)":>16}' for column in columns))
+    for size in args.sizes:
+        result = run(size)
+        print(f'{size:>10}' + ''.join(f'{result[column] * 1000:>16.1f}' for column in columns))
@@ -0,0 +1,216 @@
+'''
+Benchmark suite of the map rendering on synthetic datasets (see synthetic.py). For
+every dataset size, the following stages are measured in a fresh process started in
+the dataset directory:
+
+- input_vector: loading the roads and buildings into a feature group
+- create_popup_content: the popups of every excavation (webmap_folium.feature_popups)
+- default_map: the map of every excavation
+- update_map_and_slider: the range slider callback of flask_app for a period of the
+  dropdown, on an empty render cache
+
+Each stage reports its wall time (best of --repeat runs, with the memoized layers and
+popups cleared before each), its peak memory (tracemalloc, in a separate run) and the
+size of its output (layer GeoJSON, popup HTML or map document).
+
+The results can be saved as the baseline (benchmarks/baseline.json); a --compare run
+fails with a non-zero exit code when a metric grows beyond the baseline by more than
+its tolerance.
+
+Usage (from the excavations_webmap directory):
+    python benchmarks/suite.py --sizes 1000 10000 100000 --save-baseline
+    python benchmarks/suite.py --sizes 1000 10000 100000 --compare
+'''
+
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(APP_DIR))
+from benchmarks.synthetic import generate  # noqa: E402
+
+STAGES = ['input_vector', 'create_popup_content', 'default_map', 'update_map_and_slider']
+METRICS = ['seconds', 'peak_bytes', 'output_bytes']
+BASELINE_PATH = Path(__file__).resolve().parent / 'baseline.json'
+DATASET_DIR = APP_DIR / 'cache' / 'benchmarks'
+
+# Allowed growth over the baseline before a metric counts as a regression
+TOLERANCES = {'seconds': 0.5, 'peak_bytes': 0.2, 'output_bytes': 0.05}
+
+
+def measure(setup, stage, repeat):
+    '''
+    Returns the metrics of a stage: the best wall time of repeat runs, the peak memory
+    traced during one more run and the size of its output.
+
+    Parameters:
+    - setup (function): Clears the caches the stage must not benefit from.
+    - stage (function): Runs the stage and returns the size of its output, in bytes.
+    - repeat (int): Number of timed runs.
+    '''
+    seconds = []
+    for _ in range(repeat):
+        setup()
+        gc.collect()
+        start = time.perf_counter()
+        output_bytes = stage()
+        seconds.append(time.perf_counter() - start)
+
+    setup()
+    gc.collect()
+    tracemalloc.start()
+    stage()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': min(seconds), 'peak_bytes': peak_bytes, 'output_bytes': output_bytes}
+
+
+def run_stages(repeat):
+    '''
+    Measures every stage on the dataset of the working directory and returns the
+    metrics by stage.
+    '''
+    import folium
+    import webmap_folium
+    import map_renderer
+    from photo_assets import photo_index
+    from render_cache import RenderCache
+
+    geometry, properties = map_renderer.feature_store.select()
+    manifest = map_renderer.photo_manifest()
+    photos = photo_index(map_renderer.PHOTO_DIR)
+    categories = map_renderer.categ
+
+    def clear_memos():
+        webmap_folium._vector_layers.clear()
+        webmap_folium._popups.clear()
+
+    def input_vector():
+        report = {}
+        feature_group = folium.map.FeatureGroup(name='Υποδομή')
+        webmap_folium.input_vector('./data/amfissa_roads.geojson', 'Οδικό Δίκτυο', feature_group, 'darkblue', report=report)
+        webmap_folium.input_vector('./data/amfissa_buildings.geojson', 'Αστικό Δίκτυο', feature_group, 'darkorange', report=report)
+        return sum(layer['bytes'] for layer in report.values())
+
+    def create_popup_content():
+        popups = webmap_folium.feature_popups(properties, photos, manifest)
+        return sum(len(popup.encode('utf-8')) for popup in popups)
+
+    def default_map():
+        document = webmap_folium.default_map(True, properties, geometry, categories['category_colors'],
+                                             categories['category_icons'], photo_manifest=manifest,
+                                             lazy_popups=map_renderer.LAZY_POPUPS,
+                                             vector_tiles=map_renderer.VECTOR_TILES)
+        return len(document.encode('utf-8'))
+
+    # As flask_app.update_map_and_slider, which is not imported: flask_app starts warming
+    # its render cache on import
+    periods = list(map_renderer.dropdict)
+    range_values = map_renderer.resolve_period(periods[len(periods) // 2])
+
+    def update_map_and_slider():
+        render_cache = RenderCache(watch_paths=map_renderer.WATCH_PATHS)
+        user_range = map_renderer.resolve_range(range_values)
+        return len(render_cache.get_or_render(user_range, map_renderer.render_range).encode('utf-8'))
+
+    stages = {
+        'input_vector': input_vector,
+        'create_popup_content': create_popup_content,
+        'default_map': default_map,
+        'update_map_and_slider': update_map_and_slider,
+    }
+    return {name: measure(clear_memos, stages[name], repeat) for name in STAGES}
+
+
+def run_size(size, repeat, photo_every):
+    '''
+    Generates (or reuses) the dataset of a size and measures it in a separate process,
+    so that every size starts from empty module caches.
+    '''
+    dataset = generate(DATASET_DIR / str(size), size, photo_every=photo_every)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_path = Path(tmp_dir) / 'result.json'
+        subprocess.run([sys.executable, str(Path(__file__).resolve()), '--worker', str(result_path),
+                        '--repeat', str(repeat)], cwd=dataset, check=True, stdout=subprocess.DEVNULL)
+        with open(result_path, 'r') as file:
+            return json.load(file)
+
+
+def machine():
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()}
+
+
+def compare(results, baseline, tolerances=TOLERANCES):
+    '''
+    Returns the regressions of the results over the baseline, as printable lines.
+    '''
+    regressions = []
+    for size, stages in results.items():
+        for stage, metrics in stages.items():
+            reference = baseline.get(size, {}).get(stage)
+            if reference is None:
+                continue
+            for metric in METRICS:
+                if reference[metric] and metrics[metric] > reference[metric] * (1 + tolerances[metric]):
+                    regressions.append(f'{size} {stage} {metric}: {metrics[metric]:.4g} > {reference[metric]:.4g} '
+                                       f'(+{metrics[metric] / reference[metric] - 1:.0%}, tolerance {tolerances[metric]:.0%})')
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print(f"{'size':>8}  {'stage':<24}{'time (s)':>10}{'peak (MB)':>11}{'output (KB)':>13}{'vs baseline':>13}")
+    for size, stages in results.items():
+        for stage, metrics in stages.items():
+            reference = (baseline or {}).get(size, {}).get(stage)
+            change = f"{metrics['seconds'] / reference['seconds'] - 1:+.0%}" if reference else ''
+            print(f"{size:>8}  {stage:<24}{metrics['seconds']:>10.3f}{metrics['peak_bytes'] / 2 ** 20:>11.1f}"
+                  f"{metrics['output_bytes'] / 2 ** 10:>13.1f}{change:>13}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the map rendering on synthetic datasets.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000], help='Numbers of excavations')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stage (the best is kept)')
+    parser.add_argument('--photo-every', type=int, default=50, help='One photo every N excavations')
+    parser.add_argument('--baseline', default=str(BASELINE_PATH), help='Path of the baseline')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the baseline')
+    parser.add_argument('--compare', action='store_true', help='Fail if the results regress over the baseline')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        results = run_stages(args.repeat)
+        with open(args.worker, 'w') as file:
+            json.dump(results, file)
+        sys.exit(0)
+
+    baseline = None
+    if Path(args.baseline).exists():
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        if baseline['machine'] != machine():
+            print(f"Note: the baseline was recorded on another machine ({baseline['machine']})")
+
+    results = {str(size): run_size(size, args.repeat, args.photo_every) for size in args.sizes}
+    print_results(results, baseline['results'] if baseline else None)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump({'machine': machine(), 'results': results}, file, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+    if args.compare:
+        if baseline is None:
+            sys.exit(f'No baseline at {args.baseline}, run with --save-baseline first')
+        regressions = compare(results, baseline['results'])
+        for regression in regressions:
+            print('REGRESSION', regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,161 @@
+'''
+Generator of synthetic datasets for the benchmarks. A dataset is a directory laid
+out like the app's (data/ and photos/) where the excavations, the buildings and the
+roads are replaced by random ones of a chosen size:
+
+- excavations: points spread over the map extent, with the properties (texts,
+  categories, timeline bounds) of the real excavations they are cloned from
+- photos: the real photos, linked to one in every photo_every excavations
+- buildings: small rotated rectangles; roads: random polylines
+
+The remaining data files (categories, timeline, the ancient wall and fortress) are
+copied from the real data.
+
+Usage (from the excavations_webmap directory):
+    python benchmarks/synthetic.py ./cache/benchmarks/10000 --points 10000
+'''
+
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parents[1]
+# Map extent, as in webmap_folium.default_map: (min_lat, min_lon), (max_lat, max_lon)
+EXTENT = ((38.5118, 22.3584), (38.5437, 22.3979))
+COPIED_DATA = ['categories.json', 'marks_dropdown.json', 'marks_rangeslider.json', 'timeline_dic.json',
+               'appstyles.json', 'ancient_wall.geojson', 'ancient_fortess.geojson']
+
+
+def _random_point(generator):
+    (min_lat, min_lon), (max_lat, max_lon) = EXTENT
+    return [generator.uniform(min_lon, max_lon), generator.uniform(min_lat, max_lat)]
+
+
+def _feature_collection(features):
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def synthetic_excavations(count, generator):
+    '''
+    Returns count excavation features cloned from the real ones, with unique ids and
+    random positions.
+    '''
+    with open(APP_DIR / 'data' / 'excavation_ruins.geojson', 'r') as file:
+        sources = [feature['properties'] for feature in json.load(file)['features']]
+    features = []
+    for i in range(count):
+        properties = dict(sources[i % len(sources)])
+        properties['id'] = 1000000 + i
+        point = _random_point(generator)
+        properties['longitude'], properties['latitude'] = point
+        features.append({'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': point},
+                         'properties': properties})
+    return features
+
+
+def synthetic_buildings(count, generator):
+    '''
+    Returns count building footprints: rectangles of 8 to 30 meters, randomly rotated.
+    '''
+    features = []
+    for i in range(count):
+        lon, lat = _random_point(generator)
+        width, height = generator.uniform(8, 30) / 88000, generator.uniform(8, 30) / 111000
+        angle = generator.uniform(0, math.pi)
+        corners = []
+        for dx, dy in ((-1, -1), (1, -1), (1, 1), (-1, 1), (-1, -1)):
+            x, y = dx * width / 2, dy * height / 2
+            corners.append([lon + x * math.cos(angle) - y * math.sin(angle),
+                            lat + x * math.sin(angle) + y * math.cos(angle)])
+        features.append({'type': 'Feature', 'geometry': {'type': 'Polygon', 'coordinates': [corners]},
+                         'properties': {'description': f'Κτίριο {i}', 'bibliography': None}})
+    return features
+
+
+def synthetic_roads(count, generator, vertices=20):
+    '''
+    Returns count roads: random walks of a number of vertices, 10 to 40 meters apart.
+    '''
+    features = []
+    for i in range(count):
+        lon, lat = _random_point(generator)
+        heading = generator.uniform(0, 2 * math.pi)
+        line = [[lon, lat]]
+        for _ in range(vertices - 1):
+            heading += generator.gauss(0, 0.3)
+            step = generator.uniform(10, 40)
+            lon += step * math.cos(heading) / 88000
+            lat += step * math.sin(heading) / 111000
+            line.append([lon, lat])
+        features.append({'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': line},
+                         'properties': {'description': f'Οδός {i}', 'bibliography': None}})
+    return features
+
+
+def _link_photo(source, target):
+    # Hard links keep large datasets cheap on disk; copy where linking is not possible
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def generate(out_dir, points, buildings=None, roads=None, photo_every=50, seed=0):
+    '''
+    Writes a synthetic dataset to out_dir and returns its path. A dataset that was
+    already generated with the same parameters is reused.
+
+    Parameters:
+    - out_dir (str): Directory of the dataset.
+    - points (int): Number of excavations.
+    - buildings (int): Number of buildings (default: as many as the excavations).
+    - roads (int): Number of roads (default: one per ten excavations).
+    - photo_every (int): One in every photo_every excavations gets a photo.
+    - seed (int): Seed of the random generator.
+    '''
+    buildings = points if buildings is None else buildings
+    roads = max(1, points // 10) if roads is None else roads
+    parameters = {'points': points, 'buildings': buildings, 'roads': roads, 'photo_every': photo_every, 'seed': seed}
+    out_dir = Path(out_dir)
+    marker = out_dir / 'dataset.json'
+    if marker.exists() and json.loads(marker.read_text()) == parameters:
+        return out_dir
+    shutil.rmtree(out_dir, ignore_errors=True)
+    (out_dir / 'data').mkdir(parents=True)
+    (out_dir / 'photos').mkdir()
+
+    generator = random.Random(seed)
+    excavations = synthetic_excavations(points, generator)
+    layers = {
+        'excavation_ruins.geojson': excavations,
+        'amfissa_buildings.geojson': synthetic_buildings(buildings, generator),
+        'amfissa_roads.geojson': synthetic_roads(roads, generator),
+    }
+    for name, features in layers.items():
+        with open(out_dir / 'data' / name, 'w') as file:
+            json.dump(_feature_collection(features), file, ensure_ascii=False)
+    for name in COPIED_DATA:
+        shutil.copyfile(APP_DIR / 'data' / name, out_dir / 'data' / name)
+
+    photos = sorted((APP_DIR / 'photos').glob('*.jpg'))
+    for i in range(0, points, photo_every):
+        _link_photo(photos[(i // photo_every) % len(photos)], out_dir / 'photos' / f"{excavations[i]['properties']['id']}.jpg")
+
+    marker.write_text(json.dumps(parameters))
+    return out_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic excavations dataset.')
+    parser.add_argument('out_dir', help='Directory of the dataset')
+    parser.add_argument('--points', type=int, default=1000, help='Number of excavations')
+    parser.add_argument('--buildings', type=int, help='Number of buildings (default: --points)')
+    parser.add_argument('--roads', type=int, help='Number of roads (default: --points / 10)')
+    parser.add_argument('--photo-every', type=int, default=50, help='One photo every N excavations')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.out_dir, args.points, args.buildings, args.roads, args.photo_every, args.seed))
@@ -0,0 +1,318 @@
+'''
+The following script precomputes the artifacts of the excavations webmap ahead of
+deployment, so that the Dash app does not render anything on its first requests:
+
+- thumbnails: the resized photo thumbnails (see map_renderer.update_thumbnails)
+- popups: the popup HTML of every excavation
+- base: the full-timeline map, written to excavations_map.html
+- periods: the map of every period of the dropdown
+- compress: the gzip (and brotli) variants of the static files, served by flask_app
+  in place of compressing them on the fly (see http_caching)
+
+Usage:
+    python build.py [--stages thumbnails popups base periods compress] [--out ./cache/build] [--force] [--watch]
+
+The build is incremental: build.json records the content hash of every input (data
+files, photos and the rendering code) and of every generated artifact (thumbnails,
+popups, each infrastructure layer, each map and the excavations of each category in
+it). Only the artifacts whose inputs changed are generated again. A map is the unit of
+regeneration: the layer and category hashes tell which maps are out of date and why,
+but an out of date map is rendered whole. With --watch, the inputs are polled and
+rebuilt as they change; flask_app.py loads the artifacts at startup and, with
+BUILD_WATCH, swaps them in while running.
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from http_caching import precompress
+from webmap_folium import VECTOR_MAX_ZOOM
+import map_renderer
+
+STAGES = ['thumbnails', 'popups', 'base', 'periods', 'compress']
+BUILD_MANIFEST = 'build.json'
+
+# Infrastructure layers embedded in (or tiled for) every map, as in webmap_folium.default_map
+LAYER_INPUTS = {
+    'amfissa_roads': './data/amfissa_roads.geojson',
+    'amfissa_buildings': './data/amfissa_buildings.geojson',
+    'ancient_wall': './data/ancient_wall.geojson',
+    'ancient_fortess': './data/ancient_fortess.geojson',
+}
+
+# Static files served by flask_app, precompressed by the compress stage
+STATIC_DIRS = ['./static', './assets']
+PRECOMPRESSED_SUFFIXES = {'.css', '.js', '.svg'}
+
+# Modules whose code shapes the generated documents
+RENDER_MODULES = ['webmap_folium.py', 'map_elements.py', 'map_renderer.py', 'geometry_utils.py', 'photo_assets.py']
+
+
+def _input_name(path):
+    return Path(path).as_posix()
+
+
+def _digest(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write(path, text):
+    # Write next to the target and rename, so the app never loads a half written file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+def hash_inputs(previous=None):
+    '''
+    Returns the size, modification time and content hash of every input file, by path.
+    Files whose size and modification time did not change keep their previous hash.
+
+    Parameters:
+    - previous (dict): The inputs recorded by a previous build.
+    '''
+    previous = previous or {}
+    code_dir = Path(__file__).resolve().parent
+    files = [code_dir / module for module in RENDER_MODULES]
+    for path in map(Path, map_renderer.WATCH_PATHS):
+        files.extend(sorted(file for file in path.iterdir() if file.is_file()) if path.is_dir() else [path])
+
+    inputs = {}
+    for file in files:
+        name = file.name if file.parent == code_dir else _input_name(file)
+        stat = file.stat()
+        entry = previous.get(name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': _file_sha256(file)}
+        inputs[name] = entry
+    return inputs
+
+
+def artifact_hashes(inputs, keys=None):
+    '''
+    Returns the content hash that every artifact must have for the given inputs. An
+    artifact recorded with another hash is out of date.
+
+    Parameters:
+    - inputs (dict): The inputs, as returned by hash_inputs.
+    - keys (list): The timeline index pairs of the maps (default: map_renderer.period_keys()).
+    '''
+    def sha(path):
+        entry = inputs.get(_input_name(path))
+        return entry['sha256'] if entry else None
+
+    code = _digest([inputs[module]['sha256'] for module in RENDER_MODULES])
+    photos = {name: entry['sha256'] for name, entry in inputs.items()
+              if name.startswith(_input_name(map_renderer.PHOTO_DIR) + '/')}
+    settings = {
+        'lazy_popups': map_renderer.LAZY_POPUPS, 'vector_tiles': map_renderer.VECTOR_TILES,
+        'filter_mode': map_renderer.FILTER_MODE, 'photo_webp': map_renderer.PHOTO_WEBP,
+        'vector_max_zoom': VECTOR_MAX_ZOOM, 'server_clusters': map_renderer.SERVER_CLUSTERS,
+    }
+
+    hashes = {'thumbnails': _digest('thumbnails', photos, map_renderer.PHOTO_WEBP, code)}
+    hashes['popups'] = _digest('popups', sha(map_renderer.feature_store.path), hashes['thumbnails'], code)
+    hashes['layers'] = {name: _digest('layer', sha(path), settings, code) for name, path in LAYER_INPUTS.items()}
+
+    hashes['maps'] = {}
+    for key in keys or map_renderer.period_keys():
+        geometry, properties = map_renderer.feature_store.select(key[0], key[-1], map_renderer.FILTER_MODE)
+        by_category = {}
+        for geom, props in zip(geometry, properties):
+            by_category.setdefault(props['category'], []).append((geom, props))
+        categories = {category: _digest(features) for category, features in by_category.items()}
+        hashes['maps'][json.dumps(list(key))] = {
+            'hash': _digest('map', key, hashes['layers'], sha('./data/categories.json'), categories, settings,
+                            None if map_renderer.LAZY_POPUPS else hashes['thumbnails'], code),
+            'categories': categories,
+        }
+    return hashes
+
+
+def read_manifest(out_dir):
+    path = Path(out_dir) / BUILD_MANIFEST
+    if not path.exists():
+        return {}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def build(stages=STAGES, out_dir='./cache/build', webmap_path='./excavations_map.html', force=False):
+    '''
+    Runs the given build stages in order, only regenerating the artifacts whose inputs
+    changed since the previous build, and prints the duration of each stage. Returns
+    the timings (in seconds) by stage.
+
+    Parameters:
+    - stages (list): The stages to run, among STAGES.
+    - out_dir (str): Directory where the popups, the period maps and build.json are written.
+    - webmap_path (str): Path of the base map read by the Dash app at startup.
+    - force (bool): Whether to regenerate every artifact, changed or not.
+    '''
+    out_dir = Path(out_dir)
+    (out_dir / 'maps').mkdir(parents=True, exist_ok=True)
+    previous = {} if force else read_manifest(out_dir)
+    built = previous.get('artifacts', {})
+    inputs = hash_inputs(previous.get('inputs'))
+    expected = artifact_hashes(inputs)
+    artifacts = {'layers': expected['layers']}
+    timings = {}
+
+    def render(key, map_hash):
+        # The full timeline map is both the base map and a period map: it is rendered once
+        base = artifacts.get('base', {})
+        if base.get('hash') == map_hash and Path(webmap_path).exists():
+            return Path(webmap_path).read_text(encoding='utf-8')
+        return map_renderer.render_range(key)
+
+    for stage in STAGES:
+        if stage not in stages:
+            # Artifacts of the stages that are not run stay as they were
+            for name in {'periods': ['maps']}.get(stage, [stage]):
+                if name in built:
+                    artifacts[name] = built[name]
+            continue
+        start = time.perf_counter()
+        if stage == 'thumbnails':
+            unchanged = built.get('thumbnails') == expected['thumbnails']
+            if not unchanged:
+                map_renderer.update_thumbnails()
+            artifacts['thumbnails'] = expected['thumbnails']
+            detail = 'unchanged' if unchanged else 'rebuilt'
+        elif stage == 'popups':
+            entry = built.get('popups', {})
+            unchanged = entry.get('hash') == expected['popups'] and (out_dir / entry['file']).exists()
+            if not unchanged:
+                popups = map_renderer.render_popups()
+                _write(out_dir / 'popups.json', json.dumps(popups, ensure_ascii=False))
+                entry = {'hash': expected['popups'], 'file': 'popups.json'}
+            artifacts['popups'] = entry
+            detail = 'unchanged' if unchanged else 'rebuilt'
+        elif stage == 'base':
+            key = map_renderer.resolve_range(map_renderer.TIMELINE_RANGE)
+            map_hash = expected['maps'][json.dumps(list(key))]['hash']
+            unchanged = built.get('base', {}).get('hash') == map_hash and Path(webmap_path).exists()
+            if not unchanged:
+                _write(webmap_path, map_renderer.render_range(key))
+            artifacts['base'] = {'hash': map_hash}
+            detail = 'unchanged' if unchanged else 'rebuilt'
+        elif stage == 'periods':
+            maps, rebuilt = {}, []
+            for name, entry in expected['maps'].items():
+                key = tuple(json.loads(name))
+                previous_entry = built.get('maps', {}).get(name, {})
+                file = 'maps/{}_{}.html'.format(*key)
+                if previous_entry.get('hash') != entry['hash'] or not (out_dir / file).exists():
+                    _write(out_dir / file, render(key, entry['hash']))
+                    rebuilt.append(name)
+                maps[name] = dict(entry, file=file)
+            # Remove the maps of periods that do not exist anymore
+            for name, entry in built.get('maps', {}).items():
+                if name not in maps and entry['file'] not in {m['file'] for m in maps.values()}:
+                    (out_dir / entry['file']).unlink(missing_ok=True)
+            artifacts['maps'] = maps
+            changed_layers = [name for name, layer_hash in expected['layers'].items()
+                              if built.get('layers', {}).get(name) != layer_hash]
+            detail = f'{len(rebuilt)} rebuilt, {len(maps) - len(rebuilt)} unchanged'
+            if rebuilt and changed_layers:
+                detail += f" (layers changed: {', '.join(changed_layers)})"
+        elif stage == 'compress':
+            # The variants are named by the content hash of their file, so they never go stale
+            names = []
+            for directory in STATIC_DIRS:
+                for path in sorted(Path(directory).iterdir()):
+                    if path.is_file() and path.suffix in PRECOMPRESSED_SUFFIXES:
+                        names.extend(precompress(path.read_bytes(), out_dir / 'compressed'))
+            for path in (out_dir / 'compressed').glob('*'):
+                if path.name not in names:
+                    path.unlink()
+            artifacts['compress'] = sorted(names)
+            detail = f'{len(names)} variants'
+        timings[stage] = time.perf_counter() - start
+        print(f'{stage:<12}{timings[stage]:8.2f} s   {detail}')
+
+    _write(out_dir / BUILD_MANIFEST, json.dumps({'inputs': inputs, 'artifacts': artifacts, 'timings': timings}, indent=2))
+    print(f"{'total':<12}{sum(timings.values()):8.2f} s")
+    return timings
+
+
+def load_build(out_dir):
+    '''
+    Loads the period maps and popups of a previous build that are up to date with the
+    current inputs. Returns None if there is no build.
+
+    Parameters:
+    - out_dir (str): The output directory of the build.
+    '''
+    out_dir = Path(out_dir)
+    manifest = read_manifest(out_dir)
+    if not manifest:
+        return None
+    built = manifest['artifacts']
+    expected = artifact_hashes(hash_inputs(manifest['inputs']))
+
+    maps = {}
+    for name, entry in built.get('maps', {}).items():
+        if expected['maps'].get(name, {}).get('hash') == entry['hash']:
+            with open(out_dir / entry['file'], 'r', encoding='utf-8') as file:
+                maps[tuple(json.loads(name))] = file.read()
+    popups = None
+    if built.get('popups', {}).get('hash') == expected['popups']:
+        with open(out_dir / built['popups']['file'], 'r', encoding='utf-8') as file:
+            popups = json.load(file)
+    return {'maps': maps, 'popups': popups}
+
+
+def build_mtime(out_dir):
+    '''
+    Returns the modification time of the build manifest, or None if there is no build.
+    '''
+    path = Path(out_dir) / BUILD_MANIFEST
+    return path.stat().st_mtime_ns if path.exists() else None
+
+
+def watch(stages=STAGES, out_dir='./cache/build', webmap_path='./excavations_map.html', interval=2.0, force=False):
+    '''
+    Builds, then polls the inputs every interval seconds and rebuilds the changed artifacts.
+
+    Parameters:
+    - force (bool): Whether the first build regenerates every artifact (see build).
+    '''
+    state = None
+    while True:
+        current = {name: (entry['size'], entry['mtime']) for name, entry in hash_inputs().items()}
+        if current != state:
+            if state is not None:
+                print('Inputs changed, rebuilding')
+            build(stages, out_dir, webmap_path, force)
+            force = False
+            state = {name: (entry['size'], entry['mtime']) for name, entry in hash_inputs().items()}
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the artifacts of the excavations webmap.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES,
+                        help='Stages to run (default: all)')
+    parser.add_argument('--out', default='./cache/build', help='Output directory of the build')
+    parser.add_argument('--webmap', default='./excavations_map.html', help='Path of the base map')
+    parser.add_argument('--force', action='store_true', help='Regenerate every artifact')
+    parser.add_argument('--watch', action='store_true', help='Keep rebuilding as the inputs change')
+    parser.add_argument('--interval', type=float, default=2.0, help='Polling interval of --watch (seconds)')
+    args = parser.parse_args()
+    if args.watch:
+        watch(args.stages, args.out, args.webmap, args.interval, args.force)
+    else:
+        build(args.stages, args.out, args.webmap, args.force)
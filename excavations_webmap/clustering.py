@@ -0,0 +1,171 @@
+'''
+The following script clusters the excavation markers on the server, so that the map
+only receives the clusters and single excavations of its viewport instead of every
+marker. The clustering is hierarchical and precomputed for every zoom level: at zoom
+z the points are grouped in grid cells of CLUSTER_RADIUS pixels, and since the cell
+size halves with every zoom level, the cells (and clusters) of a zoom level are exact
+unions of those of the next one. Every cluster knows the zoom level at which it splits,
+which the map zooms to when it is clicked. Categories are clustered separately, so
+that they keep their own layers on the map.
+'''
+
+import json
+import math
+import numpy as np
+from flask import abort, request
+from feature_store import FILTER_MODES
+
+TILE_SIZE = 256
+CLUSTER_RADIUS = 60
+MIN_ZOOM, MAX_ZOOM = 13, 20
+
+
+def lonlat_to_unit(lon, lat):
+    '''
+    Projects longitudes and latitudes (arrays) to web-mercator coordinates in [0, 1].
+    '''
+    x = (np.asarray(lon, dtype=float) + 180) / 360
+    sin = np.sin(np.radians(np.asarray(lat, dtype=float)))
+    y = 0.5 - np.log((1 + sin) / (1 - sin)) / (4 * math.pi)
+    return x, y
+
+
+def unit_to_lonlat(x, y):
+    lon = np.asarray(x) * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * np.asarray(y)))))
+    return lon, lat
+
+
+class ClusterIndex:
+    '''
+    Clusters of a set of points at every zoom level from min_zoom to max_zoom. Above
+    max_zoom the points are returned unclustered.
+
+    Parameters:
+    - lon, lat (array): Coordinates of the points.
+    - ids (list): Feature id of each point.
+    - categories (list): Category of each point.
+    - radius (int): Cluster radius, in pixels.
+    - min_zoom, max_zoom (int): Zoom levels that are clustered.
+    '''
+
+    def __init__(self, lon, lat, ids, categories, radius=CLUSTER_RADIUS, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+        self.ids = list(ids)
+        self.category_names = sorted(set(categories))
+        self.radius = radius
+        self.min_zoom, self.max_zoom = min_zoom, max_zoom
+        codes = {name: code for code, name in enumerate(self.category_names)}
+        x, y = lonlat_to_unit(lon, lat)
+        count = len(self.ids)
+        self.points = {
+            'x': x, 'y': y, 'count': np.ones(count, dtype=np.int64),
+            'point': np.arange(count), 'category': np.array([codes[c] for c in categories], dtype=np.int64),
+            'expansion': np.full(count, max_zoom + 1),
+        }
+
+        # Cells of the points at max_zoom, then of the clusters of each zoom level above
+        size = self._cell_size(max_zoom)
+        cells = np.stack([self.points['category'], np.floor(x / size), np.floor(y / size)], axis=1).astype(np.int64)
+        self.levels = {}
+        children = self.points
+        for zoom in range(max_zoom, min_zoom - 1, -1):
+            level, cells = self._cluster(children, cells, zoom)
+            self.levels[zoom] = level
+            children = level
+            cells = cells // [1, 2, 2]
+
+    def _cell_size(self, zoom):
+        return self.radius / (TILE_SIZE * 2 ** zoom)
+
+    def _cluster(self, children, cells, zoom):
+        # Group the children by cell; a cluster of a single child keeps its expansion zoom
+        if len(cells) == 0:
+            empty = {key: np.array(values)[:0] for key, values in children.items()}
+            return empty, cells
+        keys, first, inverse = np.unique(cells, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        count = np.bincount(inverse, weights=children['count']).astype(np.int64)
+        level = {
+            'x': np.bincount(inverse, weights=children['x'] * children['count']) / count,
+            'y': np.bincount(inverse, weights=children['y'] * children['count']) / count,
+            'count': count,
+            'point': children['point'][first],
+            'category': keys[:, 0],
+            'expansion': np.where(np.bincount(inverse) > 1, zoom + 1, children['expansion'][first]),
+        }
+        return level, keys
+
+    def query(self, zoom, bbox=None):
+        '''
+        Returns the clusters and points of a zoom level inside a bounding box, as a list of
+        dictionaries (lon, lat, count, category, and id for single points or expansion_zoom
+        for clusters).
+
+        Parameters:
+        - zoom (int): Zoom level of the map.
+        - bbox (tuple): (west, south, east, north) bounds, or None for the whole index.
+        '''
+        zoom = max(int(zoom), self.min_zoom)
+        level = self.points if zoom > self.max_zoom else self.levels[zoom]
+        mask = np.ones(len(level['x']), dtype=bool)
+        if bbox is not None:
+            (min_x, max_x), (max_y, min_y) = lonlat_to_unit([bbox[0], bbox[2]], [bbox[1], bbox[3]])
+            mask = (level['x'] >= min_x) & (level['x'] <= max_x) & (level['y'] >= min_y) & (level['y'] <= max_y)
+        lon, lat = unit_to_lonlat(level['x'][mask], level['y'][mask])
+        items = []
+        for i, index in enumerate(np.flatnonzero(mask)):
+            item = {'lon': float(lon[i]), 'lat': float(lat[i]), 'count': int(level['count'][index]),
+                    'category': self.category_names[level['category'][index]]}
+            if item['count'] == 1:
+                item['id'] = self.ids[level['point'][index]]
+            else:
+                item['expansion_zoom'] = int(level['expansion'][index])
+            items.append(item)
+        return items
+
+
+def cluster_features(items):
+    '''
+    Converts the items of ClusterIndex.query to a GeoJSON FeatureCollection.
+    '''
+    features = []
+    for item in items:
+        properties = {key: value for key, value in item.items() if key not in ('lon', 'lat')}
+        features.append({'type': 'Feature', 'properties': properties,
+                         'geometry': {'type': 'Point', 'coordinates': [round(item['lon'], 6), round(item['lat'], 6)]}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def register_cluster_route(server, get_index, url='/clusters'):
+    '''
+    Serves the clusters of a viewport from url on a Flask server, as GeoJSON. The query
+    parameters are zoom, bbox (west,south,east,north) and the from, until and mode of the
+    timeline filter, passed to get_index (mode is None if not given). A range needs both
+    from and until.
+
+    Parameters:
+    - server (flask.Flask): The Flask server of the Dash app.
+    - get_index (callable): Function returning the ClusterIndex of (from, until, mode).
+    - url (str): URL under which the clusters are served.
+    '''
+
+    def clusters():
+        try:
+            zoom = int(request.args['zoom'])
+            bbox = [float(value) for value in request.args['bbox'].split(',')] if 'bbox' in request.args else None
+            from_id = int(request.args['from']) if request.args.get('from') else None
+            until_id = int(request.args['until']) if request.args.get('until') else None
+        except (KeyError, ValueError):
+            abort(400)
+        if bbox is not None and len(bbox) != 4:
+            abort(400)
+        if (from_id is None) != (until_id is None):
+            abort(400)
+        mode = request.args.get('mode')
+        if mode is not None and mode not in FILTER_MODES:
+            abort(400)
+        index = get_index(from_id, until_id, mode)
+        payload = json.dumps(cluster_features(index.query(zoom, bbox)), ensure_ascii=False, separators=(',', ':'))
+        return server.response_class(payload, mimetype='application/json')
+
+    server.add_url_rule(url, 'excavation_clusters', clusters)
@@ -0,0 +1,232 @@
+'''
+The following script exports the excavations map as a static site, to be served by
+any static web server or CDN without Python in the request path:
+
+- maps/: the map of the full timeline and of every period of the dropdown (and, with
+  --all-ranges, of every pair of range slider marks), named by their content hash
+- photos/: the photo thumbnails referenced by the popups
+- manifest.json: the file of every period and range, and the hash and size of every file
+- index.html: a page choosing the map of a period (or range) from the manifest
+
+As in build.py, the maps whose inputs did not change since the previous export are
+kept as they are (with the same file name), so that browsers and CDNs keep them cached.
+Every text file is written with precompressed .gz and, if the brotli package is
+installed, .br variants, to be served with e.g. nginx gzip_static/brotli_static. The
+maps reference the thumbnails under /photos, so the site is served from the root of
+its domain. The popups are embedded in the maps, since there is no /popup route, and
+the server-side clusters and vector tiles are not available.
+
+Usage:
+    python export.py [--out ./site] [--all-ranges] [--force]
+'''
+
+import argparse
+import gzip
+import hashlib
+import json
+from pathlib import Path
+import map_renderer
+from build import artifact_hashes, hash_inputs
+
+try:
+    import brotli
+except ImportError:  # Brotli variants are optional
+    brotli = None
+
+COMPRESSED_SUFFIXES = {'.html', '.json'}
+
+INDEX_TEMPLATE = '''<!DOCTYPE html>
+<html lang="el">
+<head>
+    <meta charset="utf-8">
+    <title>Διαδραστικός Χάρτης ανασκαφών στην περιοχή της Άμφισσας</title>
+    <style>
+        html, body { margin: 0; height: 100%; font-family: Roboto, sans-serif; }
+        header { padding: 8px 12px; display: flex; gap: 12px; align-items: center; }
+        iframe { border: 0; width: 100%; height: calc(100% - 52px); }
+    </style>
+</head>
+<body>
+    <header>
+        <b>Διαδραστικός Χάρτης ανασκαφών στην περιοχή της Άμφισσας</b>
+        <select id="period"><option value="">Όλες οι περίοδοι</option></select>
+        <span id="range" hidden>
+            <select id="from"></select> &ndash; <select id="until"></select>
+        </span>
+    </header>
+    <iframe id="map"></iframe>
+    <script>
+        fetch('manifest.json').then(function(response) { return response.json(); }).then(function(manifest) {
+            var frame = document.getElementById('map');
+            var period = document.getElementById('period');
+            var from = document.getElementById('from');
+            var until = document.getElementById('until');
+            Object.keys(manifest.periods).forEach(function(name) {
+                period.add(new Option(name, name));
+            });
+            if (manifest.ranges) {
+                manifest.marks.forEach(function(mark) {
+                    from.add(new Option(mark.label, mark.value));
+                    until.add(new Option(mark.label, mark.value));
+                });
+                until.selectedIndex = manifest.marks.length - 1;
+                document.getElementById('range').hidden = false;
+            }
+            function show(file) {
+                if (file) { frame.src = file; }
+            }
+            period.onchange = function() {
+                show(period.value ? manifest.periods[period.value].file : manifest.full);
+            };
+            from.onchange = until.onchange = function() {
+                var a = Number(from.value), b = Number(until.value);
+                show(manifest.ranges[Math.min(a, b) + ',' + Math.max(a, b)]);
+            };
+            show(manifest.full);
+        });
+    </script>
+</body>
+</html>
+'''
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_file(out_dir, name, data, files):
+    '''
+    Writes a file of the site with its precompressed variants, and records it in files.
+
+    Parameters:
+    - out_dir (Path): Root of the site.
+    - name (str): Path of the file in the site.
+    - data (bytes): Content of the file.
+    - files (dict): Entries of the manifest, by file name.
+    '''
+    path = out_dir / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    entry = {'sha256': _sha256(data), 'bytes': len(data)}
+    if path.suffix in COMPRESSED_SUFFIXES:
+        # A fixed mtime keeps the archives identical across exports
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        Path(f'{path}.gz').write_bytes(compressed)
+        entry['gzip'] = len(compressed)
+        if brotli is not None:
+            compressed = brotli.compress(data, quality=11)
+            Path(f'{path}.br').write_bytes(compressed)
+            entry['br'] = len(compressed)
+    files[name] = entry
+
+
+def export_keys(all_ranges=False):
+    '''
+    Returns the timeline index pairs to export, with the period names and the range
+    slider values each one is shown for.
+    '''
+    keys = {map_renderer.resolve_range(map_renderer.TIMELINE_RANGE): {'periods': [], 'ranges': []}}
+    for period in map_renderer.dropdict:
+        values = map_renderer.resolve_period(period)
+        keys.setdefault(map_renderer.resolve_range(values), {'periods': [], 'ranges': []})['periods'].append((period, values))
+    if all_ranges:
+        values = sorted(int(value) for value in map_renderer.marks)
+        for i, a in enumerate(values):
+            for b in values[i + 1:]:
+                keys.setdefault(map_renderer.resolve_range([a, b]), {'periods': [], 'ranges': []})['ranges'].append((a, b))
+    return keys
+
+
+def read_manifest(out_dir):
+    path = Path(out_dir) / 'manifest.json'
+    if not path.exists():
+        return {}
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def export(out_dir='./site', all_ranges=False, force=False):
+    '''
+    Exports the static site to out_dir and returns its manifest. Only the maps whose
+    inputs changed since the previous export are rendered again.
+
+    Parameters:
+    - out_dir (str): Root directory of the site.
+    - all_ranges (bool): Whether to also export every pair of range slider marks.
+    - force (bool): Whether to render every map, changed or not.
+    '''
+    if map_renderer.SERVER_CLUSTERS or map_renderer.VECTOR_TILES:
+        raise ValueError('The static export needs map_renderer.SERVER_CLUSTERS and VECTOR_TILES disabled')
+    # There is no /popup route on a static server
+    map_renderer.LAZY_POPUPS = False
+    out_dir = Path(out_dir)
+    previous = {} if force else read_manifest(out_dir)
+    inputs = hash_inputs(previous.get('inputs'))
+    files, maps = {}, {}
+    manifest = {'full': None, 'periods': {}, 'ranges': {} if all_ranges else None,
+                'inputs': inputs, 'maps': maps, 'files': files}
+
+    map_renderer.update_thumbnails()
+    keys = export_keys(all_ranges)
+    expected = artifact_hashes(inputs, list(keys))['maps']
+    rendered = 0
+    for key, shown in keys.items():
+        key_name = json.dumps(list(key))
+        entry = previous.get('maps', {}).get(key_name, {})
+        name = entry.get('file')
+        if entry.get('hash') == expected[key_name]['hash'] and (out_dir / name).exists():
+            files[name] = previous['files'][name]
+        else:
+            data = map_renderer.render_range(key).encode('utf-8')
+            name = 'maps/{}_{}.{}.html'.format(key[0], key[-1], _sha256(data)[:12])
+            write_file(out_dir, name, data, files)
+            rendered += 1
+        maps[key_name] = {'hash': expected[key_name]['hash'], 'file': name}
+        if key == map_renderer.resolve_range(map_renderer.TIMELINE_RANGE):
+            manifest['full'] = name
+        for period, values in shown['periods']:
+            manifest['periods'][period] = {'range': values, 'file': name}
+        for a, b in shown['ranges']:
+            manifest['ranges'][f'{a},{b}'] = name
+    if all_ranges:
+        manifest['marks'] = [{'value': int(value), 'label': mark['label'] if isinstance(mark, dict) else mark}
+                             for value, mark in sorted(map_renderer.marks.items(), key=lambda item: int(item[0]))]
+
+    # Thumbnails (already content-hashed) referenced by the popups
+    photos = map_renderer.photo_manifest()['photos']
+    for entry in photos.values():
+        for format in ['jpeg', 'webp']:
+            if entry.get(format):
+                source = Path(map_renderer.PHOTO_CACHE_DIR) / entry[format]
+                write_file(out_dir, f'photos/{entry[format]}', source.read_bytes(), files)
+
+    write_file(out_dir, 'index.html', INDEX_TEMPLATE.encode('utf-8'), files)
+    # The manifest lists every other file; it is itself written last
+    write_file(out_dir, 'manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'), {})
+
+    # Remove the files of previous exports that are not part of this one
+    for directory in ['maps', 'photos']:
+        if not (out_dir / directory).is_dir():
+            continue
+        for path in (out_dir / directory).iterdir():
+            name = f'{directory}/{path.name}'
+            for suffix in ['.gz', '.br']:
+                if name.endswith(suffix):
+                    name = name[:-len(suffix)]
+            if name not in files:
+                path.unlink()
+
+    sizes = sum(entry['bytes'] for entry in files.values())
+    print(f"Exported {len(keys)} maps ({rendered} rendered, {len(keys) - rendered} unchanged) and "
+          f"{len(photos)} thumbnails to {out_dir} ({sizes / 2 ** 20:.1f} MB"
+          f"{'' if brotli is not None else ', brotli not installed: gzip only'})")
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the excavations map as a static site.')
+    parser.add_argument('--out', default='./site', help='Root directory of the site')
+    parser.add_argument('--all-ranges', action='store_true', help='Also export every pair of range slider marks')
+    parser.add_argument('--force', action='store_true', help='Render every map')
+    args = parser.parse_args()
+    export(args.out, args.all_ranges, args.force)
@@ -0,0 +1,384 @@
+'''
+The following script is the data access layer of the excavation features. A GeoJSON
+file is kept in memory as NumPy columns and the time-range queries of the webmap are
+answered through an interval index. A GeoPackage is queried in place through SQLite,
+with the time range, category and bounding box filters run as indexed SQL.
+'''
+
+import argparse
+import os
+import sqlite3
+import struct
+import threading
+import fiona
+import numpy as np
+
+try:
+    import pyarrow
+except ImportError:  # Arrow output is optional
+    pyarrow = None
+
+FILTER_MODES = ['within', 'overlap', 'start']
+
+
+class IntervalIndex:
+    '''
+    Index over the [from_id, until_id] timeline intervals of the features. The intervals
+    are sorted by their start, so every query is a binary search followed by a
+    vectorized check of the candidate ends.
+
+    Parameters:
+    - from_ids (numpy.ndarray): Start of the interval of each feature.
+    - until_ids (numpy.ndarray): End of the interval of each feature.
+    '''
+
+    def __init__(self, from_ids, until_ids):
+        self.order = np.argsort(from_ids, kind='stable')
+        self.starts = from_ids[self.order]
+        self.ends = until_ids[self.order]
+
+    def within(self, a, b):
+        '''
+        Returns the indices of the features whose interval lies fully inside [a, b].
+        '''
+        lo = np.searchsorted(self.starts, a, side='left')
+        hi = np.searchsorted(self.starts, b, side='right')
+        candidates = slice(lo, hi)
+        return np.sort(self.order[candidates][self.ends[candidates] <= b])
+
+    def overlap(self, a, b):
+        '''
+        Returns the indices of the features whose interval overlaps [a, b].
+        '''
+        hi = np.searchsorted(self.starts, b, side='right')
+        return np.sort(self.order[:hi][self.ends[:hi] >= a])
+
+    def start(self, a, b=None):
+        '''
+        Returns the indices of the features whose interval starts at a.
+        '''
+        lo = np.searchsorted(self.starts, a, side='left')
+        hi = np.searchsorted(self.starts, a, side='right')
+        return np.sort(self.order[lo:hi])
+
+
+class FeatureStore:
+    '''
+    The excavation features of a vector file, loaded once into NumPy columns (ids,
+    coordinates and timeline bounds) next to their GeoJSON geometry and properties.
+    The file is reloaded automatically when it changes.
+
+    Parameters:
+    - path (str): Path of the excavations file.
+    '''
+
+    def __init__(self, path='./data/excavation_ruins.geojson'):
+        self.path = path
+        self._mtime = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Reloads the file if its modification time changed since it was last loaded.
+        '''
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            geometry, properties = [], []
+            with fiona.open(self.path, 'r') as src:
+                for feature in src:
+                    geometry.append({'type': feature['geometry']['type'],
+                                     'coordinates': feature['geometry']['coordinates']})
+                    properties.append(dict(feature['properties']))
+            coordinates = np.array([g['coordinates'][:2] for g in geometry], dtype=np.float64).reshape(-1, 2)
+            self.geometry, self.properties = geometry, properties
+            self.ids = np.array([p['id'] for p in properties], dtype=np.int64)
+            self.lon, self.lat = coordinates[:, 0], coordinates[:, 1]
+            self.from_ids = np.array([p['from_id'] for p in properties], dtype=np.int32)
+            self.until_ids = np.array([p['until_id'] for p in properties], dtype=np.int32)
+            self.index = IntervalIndex(self.from_ids, self.until_ids)
+            self._mtime = mtime
+
+    def generation(self):
+        '''
+        Returns the modification time of the loaded file, which changes with every reload.
+        '''
+        self.refresh()
+        return self._mtime
+
+    def query(self, a, b, mode='within'):
+        '''
+        Returns the indices of the features selected by a timeline range.
+
+        Parameters:
+        - a (int): Start of the range (timeline_dic_n index).
+        - b (int): End of the range (timeline_dic_n index).
+        - mode (str): 'within' (interval fully inside [a, b]), 'overlap' (interval
+          intersects [a, b]) or 'start' (interval starts at a).
+        '''
+        if mode not in FILTER_MODES:
+            raise ValueError(f'Unknown filter mode {mode!r}, expected one of {FILTER_MODES}')
+        self.refresh()
+        return getattr(self.index, mode)(a, b)
+
+    def select(self, a=None, b=None, mode='within'):
+        '''
+        Returns the (geometry, properties) lists of the features selected by a timeline
+        range (see query), or of every feature if no range is given. Safe to call while
+        the file is being reloaded by another thread.
+        '''
+        self.refresh()
+        with self._lock:
+            index, geometry, properties = self.index, self.geometry, self.properties
+        if a is None:
+            return list(geometry), list(properties)
+        if mode not in FILTER_MODES:
+            raise ValueError(f'Unknown filter mode {mode!r}, expected one of {FILTER_MODES}')
+        indices = getattr(index, mode)(a, b)
+        return [geometry[i] for i in indices], [properties[i] for i in indices]
+
+    def subset(self, indices):
+        '''
+        Returns the (geometry, properties) lists of the features at indices.
+        '''
+        return [self.geometry[i] for i in indices], [self.properties[i] for i in indices]
+
+    def __len__(self):
+        return len(self.properties)
+
+
+def parse_gpkg_point(blob):
+    '''
+    Returns the (x, y) coordinates of a GeoPackage binary point geometry, or None if
+    the point is empty.
+
+    Parameters:
+    - blob (bytes): The GeoPackage geometry (header, optional envelope and WKB).
+    '''
+    if blob is None:
+        return None
+    if blob[:2] != b'GP':
+        raise ValueError('Not a GeoPackage geometry')
+    flags = blob[3]
+    if flags & 0x10:
+        return None
+    # Envelope size by the envelope indicator bits of the flags
+    offset = 8 + (0, 32, 48, 48, 64)[(flags >> 1) & 0x07]
+    order = '<' if blob[offset] == 1 else '>'
+    geometry_type = struct.unpack_from(order + 'I', blob, offset + 1)[0]
+    if geometry_type % 1000 != 1:
+        raise ValueError(f'Unsupported geometry type {geometry_type}, expected a point')
+    return struct.unpack_from(order + 'dd', blob, offset + 5)
+
+
+class GeoPackageStore:
+    '''
+    The excavation features of a GeoPackage point table, queried through SQLite. The
+    time range and category filters run as SQL on indexed columns and the bounding box
+    filter through the R-tree of the geometry column, so a query only reads the matching
+    rows. It offers the same select/refresh interface as FeatureStore.
+
+    Parameters:
+    - path (str): Path of the GeoPackage.
+    - table (str): The features table. Defaults to the first table of gpkg_geometry_columns.
+    - create_indexes (bool): Whether to add the attribute indexes the queries use if the
+      GeoPackage does not have them yet. This writes to the file, which changes its
+      fingerprint and invalidates every cache built from it: add them once instead, with
+      `python feature_store.py <GeoPackage>`.
+    '''
+
+    def __init__(self, path='./data/excavation_ruins_last_update2.gpkg', table=None, create_indexes=False):
+        self.path = path
+        self._local = threading.local()
+        self._mtime = None
+        self._features = None
+        self._lock = threading.Lock()
+        connection = self._connect()
+        query = 'SELECT table_name, column_name, srs_id FROM gpkg_geometry_columns'
+        if table is not None:
+            query += ' WHERE table_name = ?'
+        row = connection.execute(query, (table,) if table is not None else ()).fetchone()
+        if row is None:
+            raise ValueError(f'No features table {table or ""} in {path}')
+        self.table, self.geometry_column, self.srs_id = row
+        self.rtree = f'rtree_{self.table}_{self.geometry_column}'
+        if not connection.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (self.rtree,)).fetchone():
+            self.rtree = None
+        if create_indexes:
+            self.create_indexes()
+        self.refresh()
+
+    def _connect(self):
+        # sqlite3 connections cannot be shared between threads; they are reopened after the
+        # file changed, in case it was replaced rather than modified in place
+        version, connection = getattr(self._local, 'connection', (None, None))
+        if connection is None or version != self._mtime:
+            if connection is not None:
+                connection.close()
+            connection = sqlite3.connect(self.path)
+            self._local.connection = (self._mtime, connection)
+        return connection
+
+    def create_indexes(self):
+        '''
+        Creates the indexes on (from_id, until_id) and category if they do not exist, and
+        the statistics SQLite needs to pick the most selective one.
+        '''
+        indexes = {
+            f'{self.table}_from_until': '(from_id, until_id)',
+            f'{self.table}_category': '(category)',
+        }
+        with self._connect() as connection:
+            existing = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            missing = [name for name in indexes if name not in existing]
+            for name in missing:
+                connection.execute(f'CREATE INDEX "{name}" ON "{self.table}" {indexes[name]}')
+            if missing:
+                connection.execute('ANALYZE')
+
+    def refresh(self):
+        '''
+        Drops the cached full feature list if the file changed since it was read.
+        '''
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self._mtime:
+            with self._lock:
+                self._mtime, self._features = mtime, None
+
+    def generation(self):
+        '''
+        Returns the modification time of the loaded file, which changes with every reload.
+        '''
+        self.refresh()
+        return self._mtime
+
+    def _query(self, columns, a=None, b=None, mode='within', categories=None, bbox=None):
+        if mode not in FILTER_MODES:
+            raise ValueError(f'Unknown filter mode {mode!r}, expected one of {FILTER_MODES}')
+        sql = f'SELECT {columns} FROM "{self.table}" AS t'
+        clauses, params = [], []
+        if bbox is not None:
+            if self.rtree is None:
+                raise ValueError(f'{self.path} has no spatial index on {self.table}')
+            sql += f' JOIN "{self.rtree}" AS r ON r.id = t.fid'
+            clauses.append('r.maxx >= ? AND r.minx <= ? AND r.maxy >= ? AND r.miny <= ?')
+            params += [bbox[0], bbox[2], bbox[1], bbox[3]]
+        if a is not None:
+            if mode == 'within':
+                # from_id <= b is implied, but bounds the index range scan on both sides
+                clauses.append('t.from_id BETWEEN ? AND ? AND t.until_id <= ?')
+                params += [a, b, b]
+            elif mode == 'overlap':
+                clauses.append('t.from_id <= ? AND t.until_id >= ?')
+                params += [b, a]
+            else:
+                clauses.append('t.from_id = ?')
+                params.append(a)
+        if categories:
+            clauses.append(f't.category IN ({", ".join("?" * len(categories))})')
+            params += list(categories)
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        return self._connect().execute(sql + ' ORDER BY t.fid', params)
+
+    def select(self, a=None, b=None, mode='within', categories=None, bbox=None):
+        '''
+        Returns the (geometry, properties) lists of the matching features, as GeoJSON.
+
+        Parameters:
+        - a (int): Start of the timeline range (timeline_dic_n index), or None for no range.
+        - b (int): End of the timeline range.
+        - mode (str): 'within', 'overlap' or 'start' (see FeatureStore.query).
+        - categories (list): Only return the features of these categories.
+        - bbox (tuple): Only return the features inside (min_x, min_y, max_x, max_y).
+        '''
+        self.refresh()
+        if a is None and categories is None and bbox is None:
+            geometry, properties = self._all_features()
+            return list(geometry), list(properties)
+        return self._features_of(self._query('t.*', a, b, mode, categories, bbox))
+
+    def _features_of(self, cursor):
+        names = [column[0] for column in cursor.description]
+        geometry, properties = [], []
+        for row in cursor:
+            values = dict(zip(names, row))
+            point = parse_gpkg_point(values.pop(self.geometry_column))
+            if point is None:
+                continue
+            values.pop('fid', None)
+            geometry.append({'type': 'Point', 'coordinates': point})
+            properties.append(values)
+        return geometry, properties
+
+    def _all_features(self):
+        with self._lock:
+            if self._features is None:
+                self._features = self._features_of(self._query('t.*'))
+            return self._features
+
+    @property
+    def geometry(self):
+        self.refresh()
+        return self._all_features()[0]
+
+    @property
+    def properties(self):
+        self.refresh()
+        return self._all_features()[1]
+
+    def columns(self, a=None, b=None, mode='within', categories=None, bbox=None, arrow=False):
+        '''
+        Returns the matching features as columns: fid, id, lon, lat, from_id, until_id and
+        category. Takes the same filters as select.
+
+        Parameters:
+        - arrow (bool): Whether to return a pyarrow.Table instead of a dictionary of NumPy
+          arrays (requires pyarrow).
+        '''
+        cursor = self._query(f't.fid, t.id, t."{self.geometry_column}", t.from_id, t.until_id, t.category',
+                             a, b, mode, categories, bbox)
+        rows = [(fid, id, parse_gpkg_point(geom), from_id, until_id, category)
+                for fid, id, geom, from_id, until_id, category in cursor]
+        rows = [row for row in rows if row[2] is not None]
+        points = np.array([row[2] for row in rows], dtype=np.float64).reshape(-1, 2)
+        columns = {
+            'fid': np.array([row[0] for row in rows], dtype=np.int64),
+            'id': np.array([row[1] for row in rows], dtype=np.int64),
+            'lon': points[:, 0],
+            'lat': points[:, 1],
+            'from_id': np.array([row[3] for row in rows], dtype=np.int32),
+            'until_id': np.array([row[4] for row in rows], dtype=np.int32),
+            'category': np.array([row[5] for row in rows], dtype=object),
+        }
+        if arrow:
+            if pyarrow is None:
+                raise ImportError('pyarrow is required for Arrow output')
+            return pyarrow.table(columns)
+        return columns
+
+    def __len__(self):
+        return self._connect().execute(f'SELECT COUNT(*) FROM "{self.table}"').fetchone()[0]
+
+
+def open_feature_store(path):
+    '''
+    Returns the feature store of an excavations file: a GeoPackageStore for a .gpkg
+    file, a FeatureStore otherwise.
+    '''
+    if path.lower().endswith('.gpkg'):
+        return GeoPackageStore(path)
+    return FeatureStore(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add the attribute indexes of the queries to a GeoPackage.')
+    parser.add_argument('path', help='Path of the GeoPackage')
+    parser.add_argument('--table', help='The features table (default: the first one)')
+    args = parser.parse_args()
+    GeoPackageStore(args.path, args.table, create_indexes=True)
+    print(f'Indexed {args.path}')
@@ -1,33 +1,208 @@
 import dash
 from dash import html
-from dash.dependencies import Output, Input
+from dash.dependencies import Output, Input, State, ClientsideFunction
 from dash import dcc
 import json
-import fiona
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import TimeoutError
+from dash.exceptions import PreventUpdate
+try:
+    import fcntl
+except ImportError:  # Windows: the warm lock is taken with msvcrt
+    fcntl = None
+    import msvcrt
+from render_cache import RenderCache
+from render_pool import RenderPool, fork_available
+from http_caching import asset_url, register_http_caching, register_static_caching
+from photo_assets import register_photo_route
+from popup_store import PopupStore, register_popup_route
+from build import build_mtime, load_build
+from clustering import register_cluster_route
+from metrics import instrument, register_gauge, register_metrics_route
+from search_index import SearchIndex, register_search_route
+from map_renderer import (FILTER_MODE, PHOTO_CACHE_DIR, TIMELINE_RANGE, VECTOR_TILES, WATCH_PATHS, dropdict, marks,
+                          cluster_index, feature_store, period_keys, render_client_map, render_popups, render_range,
+                          resolve_period, resolve_range, timeline, update_thumbnails)
 
 with open('./data/appstyles.json', 'r') as file:
     data = json.load(file)
-    
-with open('./data/marks_rangeslider.json', 'r') as file:
-    marks = json.load(file)
-
-with open('./data/marks_dropdown.json', 'r') as file:
-    dropdict = json.load(file)
-
-with open('./data/categories.json', 'r') as file:
-    categ = json.load(file)
-
-with open('./data/timeline_dic.json', 'r') as file:
-    timeline = json.load(file)
 
 # SIDEBAR_STYLE = data['SIDEBAR_STYLE']
 TOPBAR_STYLE = data['TOPBAR_STYLE']
 CONTENT_STYLE = data['CONTENT_STYLE']
 
-image_path1 = 'assets/my-image.png'
-image_path2 = 'assets/upourgeio.png'
+image_path1 = asset_url('assets/my-image.png', './assets/my-image.png')
+image_path2 = asset_url('assets/upourgeio.png', './assets/upourgeio.png')
 webmap_path = "./excavations_map.html"
 
+# Rendered map documents, keyed on the resolved timeline index pair
+RENDER_CACHE_MAX_ENTRIES = 32
+RENDER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RENDER_CACHE_WARM = True
+render_cache = RenderCache(max_entries=RENDER_CACHE_MAX_ENTRIES,
+                           max_bytes=RENDER_CACHE_MAX_BYTES,
+                           watch_paths=WATCH_PATHS)
+
+# Render the cache misses in this many worker processes (0: on the callback thread), by
+# default the cores of the machine shared among the gunicorn workers (WEB_CONCURRENCY).
+# The processes are forked: where fork is not available (Windows) or not safe (macOS),
+# the maps are rendered on the callback thread (see render_pool.fork_available).
+# A callback whose session has moved the slider again stops waiting for its render
+# (checked every RENDER_SUPERSEDE_INTERVAL seconds), which is cancelled if it has not
+# started and no other session waits for the same range
+RENDER_PROCESSES = max(1, (os.cpu_count() or 1) // int(os.environ.get('WEB_CONCURRENCY', 1)))
+RENDER_SUPERSEDE_INTERVAL = 0.05
+SESSION_ENTRIES = 10000
+# Created once the app is loaded (see below), so that its processes inherit the loaded data
+render_pool = None
+# Only the gunicorn worker holding this lock warms its render cache with the period maps
+RENDER_WARM_LOCK = './cache/render_warm.lock'
+render_warm_lock = None
+# Latest range slider request of every session (page visit), by session id
+session_requests = OrderedDict()
+session_lock = threading.Lock()
+
+# Generation of the render cache the photo thumbnails were last built for: they are built
+# at startup and after the photos change, before the maps are rendered (see refresh_thumbnails)
+thumbnails_generation = None
+thumbnails_lock = threading.Lock()
+
+# Popups served from /popup (see map_renderer.LAZY_POPUPS)
+popup_store, popup_store_generation = PopupStore(), None
+
+# Full-text search of the excavations, served from /api/search and used by the search box
+search_index, search_index_generation = None, None
+
+# Cluster indexes of the recently shown timeline ranges, served from /clusters
+# (see map_renderer.SERVER_CLUSTERS)
+CLUSTER_CACHE_ENTRIES = 16
+cluster_indexes, cluster_indexes_generation = OrderedDict(), None
+cluster_lock = threading.Lock()
+
+# Artifacts precomputed by build.py, loaded at startup if they match the data and photos.
+# With BUILD_WATCH, new builds (e.g. of `python build.py --watch`) are swapped in while running
+BUILD_DIR = './cache/build'
+BUILD_WATCH = False
+BUILD_WATCH_INTERVAL = 2.0
+# Compressed variants of the static files, written by `python build.py --stages compress`
+COMPRESSED_DIR = './cache/build/compressed'
+
+# Filter the markers in the browser (clientside callbacks) instead of re-rendering the map
+CLIENT_FILTER = False
+CLIENT_MAP_KEY = ('client',)
+
+def refresh_thumbnails():
+    '''
+    Builds the thumbnails of the changed photos if the render cache was invalidated since
+    they were last built. The renders only read their manifest (see map_renderer.photo_manifest).
+    '''
+    global thumbnails_generation
+
+    generation = render_cache.generation()
+    with thumbnails_lock:
+        if generation != thumbnails_generation:
+            update_thumbnails(generation)
+            thumbnails_generation = generation
+
+def get_popup_store():
+    '''
+    Returns the popups of every excavation by id, rebuilt whenever the data or photos change.
+    '''
+    global popup_store, popup_store_generation
+
+    refresh_thumbnails()
+    generation = render_cache.generation()
+    if generation != popup_store_generation:
+        popup_store, popup_store_generation = PopupStore(render_popups()), generation
+    return popup_store
+
+def get_search_index():
+    '''
+    Returns the search index of the excavations, rebuilt whenever the data changes.
+    '''
+    global search_index, search_index_generation
+
+    generation = render_cache.generation()
+    if generation != search_index_generation:
+        search_index, search_index_generation = SearchIndex(*feature_store.select()), generation
+    return search_index
+
+def get_cluster_index(from_id, until_id, mode):
+    '''
+    Returns the cluster index of a timeline range, rebuilt whenever the data changes.
+    '''
+    global cluster_indexes_generation
+
+    mode = FILTER_MODE if mode is None else mode
+    key = (from_id, until_id, mode)
+    generation = render_cache.generation()
+    with cluster_lock:
+        if generation != cluster_indexes_generation:
+            cluster_indexes.clear()
+            cluster_indexes_generation = generation
+        if key not in cluster_indexes:
+            cluster_indexes[key] = cluster_index(from_id, until_id, mode)
+            while len(cluster_indexes) > CLUSTER_CACHE_ENTRIES:
+                cluster_indexes.popitem(last=False)
+        cluster_indexes.move_to_end(key)
+        return cluster_indexes[key]
+
+def load_build_artifacts():
+    '''
+    Loads the artifacts of build.py that match the current data and photos into the
+    render cache and the popup store.
+    '''
+    global popup_store, popup_store_generation
+
+    build = load_build(BUILD_DIR)
+    if build is None:
+        return
+    generation = render_cache.generation()
+    for key, document in build['maps'].items():
+        render_cache.put(key, document, generation)
+    if build['popups'] is not None:
+        popup_store, popup_store_generation = PopupStore(build['popups']), generation
+    print(f"Loaded {len(build['maps'])} maps{' and the popups' if build['popups'] is not None else ''} from {BUILD_DIR}")
+
+def watch_build():
+    '''
+    Swaps in the artifacts of every new build, and reloads them after the render cache
+    was invalidated by a change of the data or photos.
+    '''
+    state = (build_mtime(BUILD_DIR), render_cache.generation())
+    while True:
+        time.sleep(BUILD_WATCH_INTERVAL)
+        current = (build_mtime(BUILD_DIR), render_cache.generation())
+        if current != state:
+            load_build_artifacts()
+            state = current
+
+def initial_map_document():
+    '''
+    Returns the map shown when the page loads: the map of every excavation to be filtered
+    in the browser, or the full timeline map (the prebuilt base map until it is rendered).
+    '''
+    if CLIENT_FILTER:
+        refresh_thumbnails()
+        return render_cache.get_or_render(CLIENT_MAP_KEY, lambda key: render_client_map())
+    document = render_cache.get(resolve_range(TIMELINE_RANGE))
+    if document is None:
+        with open(webmap_path, 'r', encoding='utf-8') as file:
+            document = file.read()
+    return document
+
+refresh_thumbnails()
+load_build_artifacts()
+get_search_index()
+if RENDER_PROCESSES and not CLIENT_FILTER and fork_available():
+    # Render the initial map before forking the render processes, so that they start with
+    # the layers, popups and thumbnail manifest memoized (a cold process renders 4-5 times slower)
+    render_cache.get_or_render(resolve_range(TIMELINE_RANGE), render_range)
+    render_pool = RenderPool(RENDER_PROCESSES, lambda: thumbnails_generation)
+
 # Define the sidebar
 sidebar = html.Div(
     className='top-bar',
@@ -97,115 +272,251 @@ sidebar = html.Div(
                         )
             ]
         ),
-   
-    ],
-    style=TOPBAR_STYLE,
-)
-content = html.Div(
-    id="page-content",
-    children=[
         html.Div(
-            className='map',
-            children=[html.Iframe(id='map', srcDoc=open(webmap_path, 'r').read(), width='100%', height='810')]
-        ),
-
-        html.Div(
-            className="row",
-            style={'justify-content': 'center'},
+            className='search',
+            style={'float': 'right', 'text-align': 'left', 'margin-right': '20px', 'margin-top': '-45px'},
             children=[
-                html.Div(
-                    className="col-md-12",
-                    style={'margin-top': '20px'},
-                    children=[
-                        dcc.RangeSlider(
-                            id='range-slider',
-                            min=-3500,
-                            max=1821,
-                            value=[-3500, 1821],
-                            marks=marks,
-                            allowCross=False,
-                            dots=False,
-                            step=None,
-                            tooltip={"placement": "bottom", "always_visible": False}
-                        )
-                    ]
-                )
+                dcc.Input(id='search', type='search', placeholder='Αναζήτηση ανασκαφών', debounce=True,
+                          style={'width': '250px', 'height': '34px', 'font-size': 16, 'font-family': 'Roboto'}),
+                html.Span(id='search-count', style={'margin-left': '8px', 'font-size': 14}),
             ]
-        )
+        ),
+   
     ],
-    style=CONTENT_STYLE
+    style=TOPBAR_STYLE,
 )
+def page_content(map_document):
+    '''
+    Builds the map and range slider part of the page around a map document.
+    '''
+    return html.Div(
+        id="page-content",
+        children=[
+            html.Div(
+                className='map',
+                children=[html.Iframe(id='map', srcDoc=map_document, width='100%', height='810')]
+            ),
 
-app = dash.Dash('excavations_API', external_stylesheets=[{'href': '/static/styles.css', 'rel': 'stylesheet'}])
-app.layout = html.Div([dcc.Location(id="url"), sidebar, content])
+            html.Div(
+                className="row",
+                style={'justify-content': 'center'},
+                children=[
+                    html.Div(
+                        className="col-md-12",
+                        style={'margin-top': '20px'},
+                        children=[
+                            dcc.RangeSlider(
+                                id='range-slider',
+                                min=-3500,
+                                max=1821,
+                                value=[-3500, 1821],
+                                marks=marks,
+                                allowCross=False,
+                                dots=False,
+                                step=None,
+                                tooltip={"placement": "bottom", "always_visible": False}
+                            )
+                        ]
+                    )
+                ]
+            )
+        ],
+        style=CONTENT_STYLE
+    )
 
-@app.callback(
-    Output('map', 'srcDoc'),
-    Input('range-slider', 'value')
-)
-def update_map_and_slider(range_values):
-    from webmap_folium import default_map
-
-    min_value, max_value = range_values[0], range_values[1]
-
-    file_path = './data/excavation_ruins.geojson'
-
-    geometry, properties = [], []
-    with fiona.open(file_path, 'r') as src:
-        for feature in src:
-            # Process each feature as needed
-            geometry.append(feature['geometry'])
-            properties.append(feature['properties'])
-
-    timeline_dic = timeline['timeline_dic_n']
-    category_colors = categ['category_colors']
-    category_icons = categ['category_icons']
-
-    user_range = [timeline_dic.get(str(min_value)), timeline_dic.get(str(max_value))]
-    
-    subset_features = []
-    for geom, props in zip(geometry, properties):
-        from_id = props['from_id']
-        until_id = props['until_id']
-
-        if len(user_range) > 1:
-            if from_id >= user_range[0] and until_id <= user_range[1]:
-                subset_features.append({'geometry': geom, 'properties': props})
-        else:
-            if from_id == user_range[0]:
-                subset_features.append({'geometry': geom, 'properties': props})
+app = dash.Dash('excavations_API', external_stylesheets=[{'href': asset_url('/static/styles.css', './static/styles.css'),
+                                                          'rel': 'stylesheet'}])
+# WSGI entry point, e.g. gunicorn --workers 4 --threads 8 flask_app:server
+server = app.server
+# Compressed responses, ETags and Cache-Control headers (see http_caching)
+register_http_caching(app.server, COMPRESSED_DIR)
+register_static_caching(app.server)
+register_photo_route(app.server, PHOTO_CACHE_DIR)
+register_popup_route(app.server, get_popup_store)
+register_cluster_route(app.server, get_cluster_index)
+register_search_route(app.server, get_search_index)
+# Callback and render stage histograms in the Prometheus format (see metrics)
+register_metrics_route(app.server)
+for name in ['entries', 'bytes', 'hits', 'misses', 'evictions', 'invalidations', 'shared', 'cancellations', 'in_flight']:
+    register_gauge(f'excavations_render_cache_{name}', f'Render cache {name}.',
+                   lambda name=name: render_cache.stats()[name])
+if VECTOR_TILES:
+    from vector_tiles import TILE_SOURCES, TileServer, register_tile_route
+    tile_server = TileServer(TILE_SOURCES, './cache/tiles')
+    register_tile_route(app.server, tile_server)
+    # Precompute the tile pyramids (zoom 13-20) without delaying the startup
+    threading.Thread(target=tile_server.build_all, daemon=True).start()
+period_ranges = {period: resolve_period(period) for period in dropdict}
 
-    subset_geometry, subset_properties = [], []
-    for feature in subset_features:
-        # Process each feature as needed
-        subset_geometry.append(feature['geometry'])
-        subset_properties.append(feature['properties'])
+def serve_layout():
+    '''
+    Builds the page for every visit, so that it shows the current map artifacts.
+    '''
+    return html.Div([
+        dcc.Location(id="url"), sidebar, page_content(initial_map_document()),
+        dcc.Store(id='session-id'),
+        dcc.Store(id='timeline-store', data=timeline['timeline_dic_n']),
+        dcc.Store(id='period-store', data=period_ranges),
+        dcc.Store(id='filter-mode', data=FILTER_MODE),
+        dcc.Store(id='map-filter'),
+        dcc.Store(id='search-results'),
+        dcc.Store(id='search-highlight'),
+    ])
 
-    # Create a Folium Map
-    webmap_path = default_map(True, subset_properties, subset_geometry, category_colors, category_icons)
+app.layout = serve_layout
 
-    return open(webmap_path, 'r').read()
+def start_request(session_id):
+    '''
+    Records a new range slider request of a session and returns its number.
+    '''
+    if session_id is None:
+        return None
+    with session_lock:
+        request = session_requests.pop(session_id, 0) + 1
+        session_requests[session_id] = request
+        while len(session_requests) > SESSION_ENTRIES:
+            session_requests.popitem(last=False)
+        return request
 
-@app.callback(
-    Output('range-slider', 'value'),
-    Input('dropdown', 'value'),
-    prevent_initial_call=True
-)
+def superseded(session_id, request):
+    if session_id is None:
+        return False
+    with session_lock:
+        return session_requests.get(session_id, request) != request
+
+@instrument('update_map_and_slider')
+def update_map_and_slider(range_values, session_id=None):
+    user_range = resolve_range(range_values)
+    refresh_thumbnails()
+    if render_pool is None:
+        return render_cache.get_or_render(user_range, render_range)
+    request = start_request(session_id)
+    future = render_cache.render_future(user_range, render_pool.submit)
+    try:
+        while True:
+            try:
+                return future.result(timeout=RENDER_SUPERSEDE_INTERVAL)
+            except TimeoutError:
+                # The map of a later request of the session replaces this one
+                if superseded(session_id, request):
+                    raise PreventUpdate
+    finally:
+        render_cache.release(user_range, future)
+
+@instrument('update_map_dropdown')
 def update_map_dropdown(selected_value):
-    user_range = dropdict[selected_value]
-    timeline_dic = timeline['timeline_dic_n']
-    keys = [key for key, value in timeline_dic.items() if value == user_range[0] or value == user_range[1]]
-    selected_marks = {key: marks[key] for key in keys if key in marks}
+    return resolve_period(selected_value)
+
+@instrument('search_map')
+def search_map(query, range_values):
+    '''
+    Searches the excavations of the selected range and returns the highlight message
+    of the map (see map_elements.SearchHighlight) and the number of results.
+    '''
+    if not query or not query.strip():
+        return {'type': 'excavations-highlight', 'ids': None, 'bounds': None}, ''
+    user_range = resolve_range(range_values)
+    index = get_search_index()
+    positions = index.search(query, user_range[0], user_range[-1], FILTER_MODE)
+    message = {'type': 'excavations-highlight', 'ids': [str(id) for id in index.ids(positions)],
+               'bounds': index.bounds(positions)}
+    return message, f'{len(positions)} αποτελέσματα'
+
+def warm_lock():
+    '''
+    Returns the open warm lock file if this process acquired it (for its lifetime), or
+    None if another process holds it.
+    '''
+    os.makedirs(os.path.dirname(RENDER_WARM_LOCK), exist_ok=True)
+    file = open(RENDER_WARM_LOCK, 'a')
+    try:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            # Locks the first byte of the (empty) file, released when the process exits
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        file.close()
+        return None
+    return file
 
-    # Get the minimum and maximum keys from selected_marks
-    min_key = min(selected_marks.keys())
-    max_key = max(selected_marks.keys())
+def warm_render_cache():
+    '''
+    Precomputes the full timeline and every period of the dropdown into the render cache,
+    in one process only: the other gunicorn workers render them when they are requested.
+    The maps are rendered one at a time, so that the slider requests are not queued
+    behind them in the render pool.
+    '''
+    global render_warm_lock
 
-    # Create a list or tuple with the lower and upper bounds
-    value = [int(min_key), int(max_key)]
-    value.sort()
+    render_warm_lock = warm_lock()
+    if render_warm_lock is None:
+        return
+    for key in period_keys():
+        refresh_thumbnails()
+        if render_pool is None:
+            render_cache.warm([key], render_range)
+            continue
+        try:
+            render_cache.warm([key], submit=render_pool.submit)
+        except RuntimeError:
+            # The render pool was shut down, the process is exiting
+            return
+    print('Render cache warmed:', render_cache.stats())
+
+if CLIENT_FILTER:
+    app.clientside_callback(
+        ClientsideFunction(namespace='excavations', function_name='filter_map'),
+        Output('map-filter', 'data'),
+        Input('range-slider', 'value'),
+        State('timeline-store', 'data'),
+        State('filter-mode', 'data')
+    )
+    app.clientside_callback(
+        ClientsideFunction(namespace='excavations', function_name='select_period'),
+        Output('range-slider', 'value'),
+        Input('dropdown', 'value'),
+        State('period-store', 'data'),
+        prevent_initial_call=True
+    )
+
+    if RENDER_CACHE_WARM:
+        threading.Thread(target=initial_map_document, daemon=True).start()
+else:
+    app.clientside_callback(
+        ClientsideFunction(namespace='excavations', function_name='session_id'),
+        Output('session-id', 'data'),
+        Input('url', 'pathname')
+    )
+    app.callback(
+        Output('map', 'srcDoc'),
+        Input('range-slider', 'value'),
+        State('session-id', 'data')
+    )(update_map_and_slider)
+    app.callback(
+        Output('range-slider', 'value'),
+        Input('dropdown', 'value'),
+        prevent_initial_call=True
+    )(update_map_dropdown)
+
+    if RENDER_CACHE_WARM:
+        threading.Thread(target=warm_render_cache, daemon=True).start()
+
+app.callback(
+    Output('search-results', 'data'),
+    Output('search-count', 'children'),
+    Input('search', 'value'),
+    Input('range-slider', 'value')
+)(search_map)
+app.clientside_callback(
+    ClientsideFunction(namespace='excavations', function_name='highlight_map'),
+    Output('search-highlight', 'data'),
+    Input('search-results', 'data')
+)
 
-    return value
+if BUILD_WATCH:
+    threading.Thread(target=watch_build, daemon=True).start()
 
 if __name__ == '__main__':
     PORT = 8081  # Set the desired port number
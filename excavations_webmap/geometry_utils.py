@@ -0,0 +1,98 @@
+'''
+The following script contains helpers that reduce the size of the vector layers
+embedded in the webmap: coordinate quantization to the precision that the map's
+zoom range can display, and optional topology-preserving simplification.
+'''
+
+import math
+
+try:
+    from shapely.geometry import mapping, shape
+except ImportError:  # simplification is optional
+    shape = None
+
+# Latitude of the Amfissa region, used to convert pixels to degrees
+MAP_LATITUDE = 38.527
+
+
+def degrees_per_pixel(zoom, latitude=MAP_LATITUDE):
+    '''
+    Returns the size of a screen pixel in degrees of latitude at a web-mercator zoom level.
+
+    Parameters:
+    - zoom (int): The zoom level.
+    - latitude (float): The latitude where the size is measured.
+    '''
+    meters_per_pixel = 156543.03392 * math.cos(math.radians(latitude)) / 2 ** zoom
+    return meters_per_pixel / 111320
+
+
+def coordinate_precision(max_zoom, latitude=MAP_LATITUDE):
+    '''
+    Returns the number of decimals that keeps coordinates within one pixel at max_zoom.
+    '''
+    return max(0, math.ceil(-math.log10(degrees_per_pixel(max_zoom, latitude))))
+
+
+def _quantize_ring(ring, decimals, closed):
+    # Returns [] for an empty ring, and for a closed ring that collapses
+    points = []
+    for coordinate in ring:
+        point = [round(coordinate[0], decimals), round(coordinate[1], decimals)]
+        # Rounding collapses nearby vertices, drop the consecutive duplicates
+        if not points or point != points[-1]:
+            points.append(point)
+    if closed and points:
+        if points[0] != points[-1]:
+            points.append(list(points[0]))
+        if len(points) < 4:
+            return []
+    return points
+
+
+def _quantize_polygon(rings, decimals):
+    # A polygon whose exterior collapses is dropped whole, its holes with it
+    rings = [_quantize_ring(ring, decimals, closed=True) for ring in rings]
+    if not rings or not rings[0]:
+        return []
+    return [rings[0]] + [ring for ring in rings[1:] if ring]
+
+
+def quantize_geometry(geometry, decimals):
+    '''
+    Rounds the coordinates of a GeoJSON geometry to a number of decimals and removes
+    the vertices that become duplicates. Holes that collapse are dropped, and so are the
+    polygons whose exterior collapses.
+
+    Parameters:
+    - geometry (dict): A GeoJSON geometry.
+    - decimals (int): Number of decimals kept.
+    '''
+    geometry_type, coordinates = geometry['type'], geometry['coordinates']
+    if geometry_type == 'Point':
+        coordinates = [round(c, decimals) for c in coordinates[:2]]
+    elif geometry_type in ('MultiPoint', 'LineString'):
+        coordinates = _quantize_ring(coordinates, decimals, closed=False)
+    elif geometry_type == 'MultiLineString':
+        coordinates = [_quantize_ring(line, decimals, closed=False) for line in coordinates]
+    elif geometry_type == 'Polygon':
+        coordinates = _quantize_polygon(coordinates, decimals)
+    elif geometry_type == 'MultiPolygon':
+        coordinates = [rings for rings in (_quantize_polygon(polygon, decimals) for polygon in coordinates) if rings]
+    return {'type': geometry_type, 'coordinates': coordinates}
+
+
+def simplify_geometry(geometry, tolerance):
+    '''
+    Simplifies a GeoJSON geometry without changing its topology (no self-intersections,
+    no collapsed holes). Requires shapely; without it the geometry is returned unchanged.
+
+    Parameters:
+    - geometry (dict): A GeoJSON geometry.
+    - tolerance (float): Maximum distance (in degrees) between the original and the
+      simplified geometry.
+    '''
+    if shape is None:
+        return geometry
+    simplified = mapping(shape(geometry).simplify(tolerance, preserve_topology=True))
+    return {'type': simplified['type'], 'coordinates': simplified['coordinates']}
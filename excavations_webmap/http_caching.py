@@ -0,0 +1,236 @@
+'''
+The following script adds response compression and HTTP caching to the Flask server
+of a Dash app, the webmap of excavations_webmap or the download app of
+rs_download_API:
+
+- the text responses (the page, the layout, the callback responses, CSS, JavaScript
+  and JSON) are compressed with brotli (if the brotli package is installed) or gzip,
+  as the browser accepts. Compressed bodies are kept in a small LRU by content hash,
+  so a response served again (such as a webmap served from its render cache) is only
+  compressed once, and the variants written ahead of time by precompress (the build
+  of the webmap) are used as they are
+- the GET responses get a strong ETag (the hash of their content) and are answered
+  with 304 Not Modified when the browser already holds them
+- the static files and assets are served with content hash ETags; requested with a
+  version parameter (v=<hash>, or the m=<mtime> Dash adds to its assets), they are
+  cached for a year as immutable, else revalidated on every use
+
+Each app keeps its own copy of this module, so that either can be packaged and
+deployed alone: a change to one copy must be made to the other (the tests of
+rs_download_API check that they are the same).
+'''
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from flask import abort, request
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # Brotli compression is optional, gzip is always available
+    brotli = None
+
+COMPRESSIBLE_TYPES = {'text/html', 'text/css', 'text/javascript', 'text/plain', 'application/javascript',
+                      'application/json', 'application/geo+json', 'image/svg+xml'}
+# Smaller responses fit in a packet anyway
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Compressed bodies kept in memory
+COMPRESSION_CACHE_BYTES = 64 * 1024 * 1024
+IMMUTABLE_MAX_AGE = 31536000
+VERSION_PARAMS = ('v', 'm')
+
+
+def content_etag(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def compress(data, encoding, gzip_level=GZIP_LEVEL, brotli_quality=BROTLI_QUALITY):
+    '''
+    Compresses data with 'br' or 'gzip'. The gzip output has no timestamp, so the same
+    data always gives the same bytes.
+    '''
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+
+def encodings():
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def precompress(data, out_dir):
+    '''
+    Writes the variants of data compressed at the highest levels to out_dir, named by the
+    content hash of data, and returns their names.
+
+    Parameters:
+    - data (bytes): The content to compress.
+    - out_dir (Path): Directory of the precompressed variants.
+    '''
+    out_dir.mkdir(parents=True, exist_ok=True)
+    etag = content_etag(data)
+    names = []
+    for encoding in encodings():
+        path = out_dir / f'{etag}.{encoding}'
+        if not path.exists():
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            Path(tmp_path).write_bytes(compress(data, encoding, gzip_level=9, brotli_quality=11))
+            os.replace(tmp_path, path)
+        names.append(path.name)
+    return names
+
+
+class CompressionCache:
+    '''
+    Least-recently-used cache of compressed bodies by (content hash, encoding), with a
+    byte limit, backed by the precompressed variants of precompressed_dir.
+
+    Parameters:
+    - max_bytes (int): Maximum total size of the cached bodies.
+    - precompressed_dir (str): Directory of the variants written by precompress, or None.
+    '''
+
+    def __init__(self, max_bytes=COMPRESSION_CACHE_BYTES, precompressed_dir=None):
+        self.max_bytes = max_bytes
+        self.precompressed_dir = Path(precompressed_dir) if precompressed_dir else None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, data, etag, encoding):
+        '''
+        Returns data (whose content hash is etag) compressed with encoding.
+        '''
+        key = (etag, encoding)
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return body
+            self.misses += 1
+        path = self.precompressed_dir / f'{etag}.{encoding}' if self.precompressed_dir else None
+        body = path.read_bytes() if path is not None and path.exists() else compress(data, encoding)
+        if len(body) <= self.max_bytes:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = body
+                    self._size += len(body)
+                while self._size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._size -= len(evicted)
+        return body
+
+
+def _compressible(response):
+    return (response.status_code == 200 and not response.direct_passthrough and not response.is_streamed
+            and 'Content-Encoding' not in response.headers and response.mimetype in COMPRESSIBLE_TYPES)
+
+
+def register_http_caching(server, precompressed_dir=None, min_size=MIN_COMPRESS_BYTES):
+    '''
+    Compresses the responses of a Flask server and adds strong ETags and conditional-GET
+    handling to its GET responses.
+
+    Parameters:
+    - server (flask.Flask): The Flask server of the Dash app.
+    - precompressed_dir (str): Directory of the variants written by precompress, or None.
+    - min_size (int): Responses smaller than this many bytes are not compressed.
+    '''
+    cache = CompressionCache(precompressed_dir=precompressed_dir)
+    server.extensions['compression_cache'] = cache
+
+    def compress_and_validate(response):
+        is_get = request.method in ('GET', 'HEAD')
+        if not _compressible(response):
+            return response.make_conditional(request) if is_get and response.get_etag()[0] else response
+        data = response.get_data()
+        etag = response.get_etag()[0] or content_etag(data)
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(encodings()) if len(data) >= min_size else None
+        if encoding is not None:
+            response.set_data(cache.get(data, etag, encoding))
+            response.headers['Content-Encoding'] = encoding
+            # Every representation has its own strong validator
+            etag = f'{etag}-{encoding}'
+        if is_get:
+            response.set_etag(etag)
+            if response.cache_control.max_age is None and not response.cache_control.no_store:
+                response.cache_control.no_cache = True
+            response = response.make_conditional(request)
+        return response
+
+    server.after_request(compress_and_validate)
+
+
+def asset_url(url, path):
+    '''
+    Returns url with the content hash of the file at path as version parameter, so that
+    it is cached as immutable and changes with the file.
+    '''
+    return f'{url}?v={file_etag(path)}'
+
+
+_file_etags = {}
+_file_lock = threading.Lock()
+
+
+def _read_file(path):
+    # Content and content hash of a file, memoized by path, size and modification time
+    stat = os.stat(path)
+    with _file_lock:
+        entry = _file_etags.get(path)
+    if entry is None or entry[0] != (stat.st_size, stat.st_mtime_ns):
+        with open(path, 'rb') as file:
+            data = file.read()
+        entry = ((stat.st_size, stat.st_mtime_ns), data, content_etag(data))
+        with _file_lock:
+            _file_etags[path] = entry
+    return entry[1], entry[2]
+
+
+def file_etag(path):
+    return _read_file(os.path.abspath(path))[1]
+
+
+def register_static_caching(server, endpoints=('static', '_dash_assets.static')):
+    '''
+    Replaces the static file views of a Flask server (its static folder and the assets
+    of Dash) by views sending content hash ETags and the Cache-Control of their version.
+
+    Parameters:
+    - server (flask.Flask): The Flask server of the Dash app.
+    - endpoints (tuple): Endpoints of the static file views.
+    '''
+    for endpoint in endpoints:
+        if endpoint not in server.view_functions:
+            continue
+        # Static folder of the app, or of the blueprint of the endpoint
+        scaffold = server if endpoint == 'static' else server.blueprints[endpoint.rsplit('.', 1)[0]]
+        directory = scaffold.static_folder
+
+        def send(filename, directory=directory):
+            path = safe_join(directory, filename)
+            if path is None or not os.path.isfile(path):
+                abort(404)
+            data, etag = _read_file(path)
+            response = server.response_class(data, mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+            response.set_etag(etag)
+            if any(name in request.args for name in VERSION_PARAMS):
+                response.cache_control.public = True
+                response.cache_control.max_age = IMMUTABLE_MAX_AGE
+                response.cache_control.immutable = True
+            else:
+                response.cache_control.no_cache = True
+            return response
+
+        server.view_functions[endpoint] = send
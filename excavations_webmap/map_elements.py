@@ -0,0 +1,391 @@
+'''
+The following script contains the custom folium elements used by the excavations
+webmap, i.e. the pieces of Leaflet javascript that folium does not provide out of the box.
+'''
+
+import json
+from branca.element import MacroElement
+from jinja2 import Template
+from folium.elements import JSCSSMixin
+from folium.map import Layer
+from folium.plugins import MarkerCluster
+
+
+def to_js_payload(data):
+    '''
+    Serializes data to compact JSON that can be inlined safely in a <script> block.
+    '''
+    payload = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    return payload.replace('</', '<\\/')
+
+
+class ExcavationMarkers(JSCSSMixin, MacroElement):
+    '''
+    Adds every excavation to the map once, from a single GeoJSON payload, and filters
+    the markers in the browser. The map listens for window messages of the form
+    {type: 'excavations-filter', from_id: int, until_id: int, mode: str} sent by the Dash
+    page, mode being one of feature_store.FILTER_MODES ('within' by default).
+
+    Parameters:
+    - features (list): GeoJSON point features carrying id, category, color, from_id,
+      until_id and popup properties.
+    - groups (dict): The folium.FeatureGroup of each category, where the clusters are placed.
+    - cluster_options (dict): Options passed to L.markerClusterGroup.
+    '''
+
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function() {
+                var map = {{ this._parent.get_name() }};
+                var data = {{ this.payload }};
+                var groups = {
+                    {%- for category, group in this.groups.items() %}
+                    {{ category|tojson }}: {{ group.get_name() }},
+                    {%- endfor %}
+                };
+                var clusters = {};
+                var markers = data.features.map(function(feature) {
+                    var p = feature.properties;
+                    var c = feature.geometry.coordinates;
+                    var marker = L.marker([c[1], c[0]], {
+                        excavationId: p.id,
+                        icon: L.AwesomeMarkers.icon({
+                            markerColor: p.color, iconColor: 'white',
+                            icon: 'location-pin', prefix: 'fa-solid', extraClasses: 'fa-rotate-0'
+                        })
+                    });
+                    if (p.popup) {
+                        marker.bindPopup(
+                            '<div style="max-height: 300px; overflow-y: auto;">' + p.popup + '</div>',
+                            {minWidth: 500, maxWidth: 600}
+                        );
+                    }
+                    marker.feature = feature;
+                    if (!(p.category in clusters)) {
+                        clusters[p.category] = L.markerClusterGroup({{ this.cluster_options|tojson }});
+                        clusters[p.category].addTo(groups[p.category] || map);
+                    }
+                    return marker;
+                });
+
+                var modes = {
+                    within: function(p, a, b) { return p.from_id >= a && p.until_id <= b; },
+                    overlap: function(p, a, b) { return p.from_id <= b && p.until_id >= a; },
+                    start: function(p, a, b) { return p.from_id === a; }
+                };
+
+                function filter(fromId, untilId, mode) {
+                    var selected = {};
+                    var match = modes[mode] || modes.within;
+                    markers.forEach(function(marker) {
+                        var p = marker.feature.properties;
+                        if (fromId == null || untilId == null || match(p, fromId, untilId)) {
+                            (selected[p.category] = selected[p.category] || []).push(marker);
+                        }
+                    });
+                    for (var category in clusters) {
+                        clusters[category].clearLayers();
+                        if (selected[category]) {
+                            clusters[category].addLayers(selected[category]);
+                        }
+                    }
+                }
+
+                filter(null, null);
+                window.addEventListener('message', function(event) {
+                    var message = event.data || {};
+                    if (message.type === 'excavations-filter') {
+                        filter(message.from_id, message.until_id, message.mode);
+                    }
+                });
+                if (window.parent !== window) {
+                    window.parent.postMessage({type: 'excavations-ready'}, '*');
+                }
+                return {filter: filter, markers: markers};
+            })();
+        {% endmacro %}
+        """)
+
+    default_js = MarkerCluster.default_js
+    default_css = MarkerCluster.default_css
+
+    def __init__(self, features, groups, cluster_options=None):
+        super().__init__()
+        self._name = 'ExcavationMarkers'
+        self.payload = to_js_payload({'type': 'FeatureCollection', 'features': features})
+        self.groups = groups
+        self.cluster_options = cluster_options or {}
+
+
+class LazyPopups(MacroElement):
+    '''
+    Binds a popup to every marker carrying an excavationId option and fetches its
+    content from url_prefix/<id> the first time it is opened, so the map document
+    does not embed the popups of the excavations.
+
+    Parameters:
+    - url_prefix (str): URL under which the popups are served (see popup_store).
+    '''
+
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var loaded = {};
+
+                function wrap(html) {
+                    return '<div style="max-height: 300px; overflow-y: auto;">' + html + '</div>';
+                }
+
+                function load(event) {
+                    var popup = event.popup;
+                    var id = event.target.options.excavationId;
+                    if (id in loaded) {
+                        popup.setContent(wrap(loaded[id]));
+                        return;
+                    }
+                    fetch({{ this.url_prefix|tojson }} + '/' + encodeURIComponent(id))
+                        .then(function(response) {
+                            if (!response.ok) { throw new Error(response.statusText); }
+                            return response.text();
+                        })
+                        .then(function(html) {
+                            loaded[id] = html;
+                            popup.setContent(wrap(html));
+                        })
+                        .catch(function() {
+                            popup.setContent(wrap('<i>Δεν ήταν δυνατή η φόρτωση των πληροφοριών.</i>'));
+                        });
+                }
+
+                function bind(layer) {
+                    if (!layer.options || layer.options.excavationId == null || layer.getPopup()) {
+                        return;
+                    }
+                    layer.bindPopup(wrap('<i>...</i>'), {minWidth: 500, maxWidth: 600});
+                    layer.on('popupopen', load);
+                }
+
+                map.eachLayer(bind);
+                map.on('layeradd', function(event) { bind(event.layer); });
+            })();
+        {% endmacro %}
+        """)
+
+    def __init__(self, url_prefix='/popup'):
+        super().__init__()
+        self._name = 'LazyPopups'
+        self.url_prefix = url_prefix
+
+
+class VectorTileLayer(JSCSSMixin, Layer):
+    '''
+    Displays a layer of Mapbox Vector Tiles (see vector_tiles.register_tile_route) with
+    Leaflet.VectorGrid. The tile features carry the index 'i' of their source feature,
+    used to pick their popup.
+
+    Parameters:
+    - url (str): Tile URL template, with {z}/{x}/{y} placeholders.
+    - layer_name (str): Name of the layer inside the tiles.
+    - style (dict): VectorGrid path style of the features.
+    - popups (list): Popup HTML of each source feature.
+    - name (str): Name displayed in the layer controls.
+    - max_native_zoom (int): Highest zoom level of the tile pyramid, overzoomed above.
+    '''
+
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.vectorGrid.protobuf({{ this.url|tojson }}, {
+                vectorTileLayerStyles: { {{ this.tile_layer|tojson }}: {{ this.style|tojson }} },
+                interactive: true,
+                maxNativeZoom: {{ this.max_native_zoom }},
+                rendererFactory: L.canvas.tile
+            }).addTo({{ this._parent.get_name() }});
+            var {{ this.get_name() }}_popups = {{ this.popups }};
+            {{ this.get_name() }}.on('click', function(event) {
+                var html = {{ this.get_name() }}_popups[event.layer.properties.i];
+                if (html) {
+                    L.popup({minWidth: 500, maxWidth: 600})
+                        .setLatLng(event.latlng).setContent(html).openOn(this._map);
+                }
+            });
+        {% endmacro %}
+        """)
+
+    default_js = [
+        ('leaflet_vectorgrid', 'https://unpkg.com/leaflet.vectorgrid@1.3.0/dist/Leaflet.VectorGrid.bundled.js'),
+    ]
+
+    def __init__(self, url, layer_name, style, popups, name=None, max_native_zoom=20, overlay=True, control=True, show=True):
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = 'VectorTileLayer'
+        self.url = url
+        self.tile_layer = layer_name
+        self.style = style
+        self.popups = to_js_payload(popups)
+        self.max_native_zoom = max_native_zoom
+
+
+class ServerClusters(JSCSSMixin, MacroElement):
+    '''
+    Displays the clusters and single excavations of the viewport, fetched from the
+    server (see clustering.register_cluster_route) whenever the map is moved or zoomed.
+    Clicking a cluster zooms to the level where it splits. The single excavations carry
+    their excavationId, for LazyPopups to fetch their popup.
+
+    Parameters:
+    - url (str): URL of the clusters, with the query parameters of the timeline filter.
+    - groups (dict): The folium.FeatureGroup of each category, where the markers are placed.
+    - category_colors (dict): Marker color of each category.
+    '''
+
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function() {
+                var map = {{ this._parent.get_name() }};
+                var url = {{ this.url|tojson }};
+                var colors = {{ this.category_colors|tojson }};
+                var groups = {
+                    {%- for category, group in this.groups.items() %}
+                    {{ category|tojson }}: {{ group.get_name() }},
+                    {%- endfor %}
+                };
+                var layers = {};
+                var latest = 0;
+
+                function layer(category) {
+                    if (!(category in layers)) {
+                        layers[category] = L.layerGroup().addTo(groups[category] || map);
+                    }
+                    return layers[category];
+                }
+
+                function marker(feature) {
+                    var p = feature.properties;
+                    var latlng = L.latLng(feature.geometry.coordinates[1], feature.geometry.coordinates[0]);
+                    if (p.count === 1) {
+                        return L.marker(latlng, {
+                            excavationId: String(p.id),
+                            icon: L.AwesomeMarkers.icon({
+                                markerColor: colors[p.category] || 'gray', iconColor: 'white',
+                                icon: 'location-pin', prefix: 'fa-solid', extraClasses: 'fa-rotate-0'
+                            })
+                        });
+                    }
+                    var size = p.count < 10 ? 'small' : p.count < 100 ? 'medium' : 'large';
+                    var cluster = L.marker(latlng, {
+                        icon: L.divIcon({
+                            html: '<div><span>' + p.count + '</span></div>',
+                            className: 'marker-cluster marker-cluster-' + size,
+                            iconSize: L.point(40, 40)
+                        })
+                    });
+                    cluster.on('click', function() { map.setView(latlng, p.expansion_zoom); });
+                    return cluster;
+                }
+
+                function update() {
+                    var bounds = map.getBounds().pad(0.25);
+                    var request = ++latest;
+                    var query = '&zoom=' + map.getZoom() + '&bbox=' + [
+                        bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()
+                    ].join(',');
+                    fetch(url + query)
+                        .then(function(response) {
+                            if (!response.ok) { throw new Error(response.statusText); }
+                            return response.json();
+                        })
+                        .then(function(data) {
+                            // A newer view was requested in the meantime
+                            if (request !== latest) { return; }
+                            for (var category in layers) {
+                                layers[category].clearLayers();
+                            }
+                            data.features.forEach(function(feature) {
+                                marker(feature).addTo(layer(feature.properties.category));
+                            });
+                        })
+                        .catch(function(error) { console.error('Clusters', error); });
+                }
+
+                map.on('moveend', update);
+                update();
+                return {update: update};
+            })();
+        {% endmacro %}
+        """)
+
+    default_css = MarkerCluster.default_css
+
+    def __init__(self, url, groups, category_colors):
+        super().__init__()
+        self._name = 'ServerClusters'
+        self.url = url
+        self.groups = groups
+        self.category_colors = category_colors
+
+
+class SearchHighlight(MacroElement):
+    '''
+    Highlights the excavations matching a search of the Dash page, without rebuilding
+    the map: the map listens for window messages of the form {type: 'excavations-highlight',
+    ids: [...], bounds: [[south, west], [north, east]]} and dims every marker whose
+    excavationId is not in ids (ids null clears the highlight), then fits the bounds of
+    the matches.
+    '''
+
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var highlighted = null;
+
+                function style(layer) {
+                    if (!layer.options || layer.options.excavationId == null || !layer.setOpacity) {
+                        return;
+                    }
+                    var match = highlighted === null || highlighted[layer.options.excavationId];
+                    layer.setOpacity(match ? 1 : 0.3);
+                    layer.setZIndexOffset(match && highlighted !== null ? 1000 : 0);
+                }
+
+                function styleAll(layer, seen) {
+                    var id = L.stamp(layer);
+                    if (seen[id]) { return; }
+                    seen[id] = true;
+                    style(layer);
+                    if (layer.getLayers) {
+                        layer.getLayers().forEach(function(child) { styleAll(child, seen); });
+                    }
+                }
+
+                function highlight(ids, bounds) {
+                    highlighted = null;
+                    if (ids) {
+                        highlighted = {};
+                        ids.forEach(function(id) { highlighted[String(id)] = true; });
+                    }
+                    var seen = {};
+                    map.eachLayer(function(layer) { styleAll(layer, seen); });
+                    if (bounds) {
+                        map.fitBounds(bounds, {maxZoom: 18, padding: [40, 40]});
+                    }
+                }
+
+                map.on('layeradd', function(event) { style(event.layer); });
+                window.addEventListener('message', function(event) {
+                    var message = event.data || {};
+                    if (message.type === 'excavations-highlight') {
+                        highlight(message.ids, message.bounds);
+                    }
+                });
+                if (window.parent !== window) {
+                    window.parent.postMessage({type: 'excavations-ready'}, '*');
+                }
+            })();
+        {% endmacro %}
+        """)
+
+    def __init__(self):
+        super().__init__()
+        self._name = 'SearchHighlight'
@@ -0,0 +1,199 @@
+'''
+The following script renders the excavation map documents and popups from the
+in-memory feature store. It is shared by the Dash app (flask_app.py), which renders
+on demand, and by the build command (build.py), which precomputes the same
+artifacts ahead of deployment.
+'''
+
+import json
+import threading
+from urllib.parse import urlencode
+from clustering import ClusterIndex
+from feature_store import open_feature_store
+from metrics import stage
+from photo_assets import build_thumbnails, load_manifest, photo_index
+from webmap_folium import clear_popups, default_map, feature_popups
+
+with open('./data/marks_rangeslider.json', 'r') as file:
+    marks = json.load(file)
+
+with open('./data/marks_dropdown.json', 'r') as file:
+    dropdict = json.load(file)
+
+with open('./data/categories.json', 'r') as file:
+    categ = json.load(file)
+
+with open('./data/timeline_dic.json', 'r') as file:
+    timeline = json.load(file)
+
+# Full extent of the range slider
+TIMELINE_RANGE = [-3500, 1821]
+
+# Inputs of the rendered documents; any change to them invalidates the rendered artifacts
+WATCH_PATHS = ['./data', './photos']
+
+# Excavation features: a GeoJSON file is kept in memory and indexed by timeline interval,
+# a GeoPackage (e.g. './data/excavation_ruins_last_update2.gpkg', a later export with 122
+# excavations against 125) is queried through SQLite (add its indexes once with
+# `python feature_store.py <GeoPackage>`).
+# FILTER_MODE selects which excavations a range shows: 'within' (fully inside the range),
+# 'overlap' (intersecting it) or 'start' (starting at its lower bound)
+EXCAVATIONS_PATH = './data/excavation_ruins.geojson'
+feature_store = open_feature_store(EXCAVATIONS_PATH)
+FILTER_MODE = 'within'
+
+# Resized, content-hashed photo thumbnails served from /photos
+PHOTO_DIR = './photos'
+PHOTO_CACHE_DIR = './cache/photos'
+PHOTO_WEBP = False
+
+# Fetch the popups on click from /popup instead of embedding them in the map document
+LAZY_POPUPS = True
+
+# Serve the infrastructure layers as vector tiles from /tiles instead of embedding them
+# in every map document (requires the 'tiles' extra: mapbox-vector-tile and shapely)
+VECTOR_TILES = False
+
+# Cluster the markers on the server and only send those of the viewport to the map,
+# fetched from /clusters (see clustering); the popups are then fetched from /popup
+SERVER_CLUSTERS = False
+
+# Thumbnail manifest read by the renders, and the generation of the inputs it was
+# loaded for (see photo_manifest)
+photo_manifest_state = (None, None)
+thumbnail_lock = threading.Lock()
+
+def resolve_range(range_values):
+    '''
+    Resolves the values of the range slider to the timeline index pair used
+    to filter the excavations (and as the render cache key).
+    '''
+    timeline_dic = timeline['timeline_dic_n']
+    min_value, max_value = range_values[0], range_values[1]
+    return (timeline_dic.get(str(min_value)), timeline_dic.get(str(max_value)))
+
+def resolve_period(selected_value):
+    '''
+    Resolves a period of the dropdown to the [min, max] values of the range slider.
+    '''
+    user_range = dropdict[selected_value]
+    timeline_dic = timeline['timeline_dic_n']
+    keys = [key for key, value in timeline_dic.items() if value == user_range[0] or value == user_range[1]]
+    selected_marks = {key: marks[key] for key in keys if key in marks}
+
+    # Get the minimum and maximum keys from selected_marks
+    min_key = min(selected_marks.keys())
+    max_key = max(selected_marks.keys())
+
+    # Create a list or tuple with the lower and upper bounds
+    value = [int(min_key), int(max_key)]
+    value.sort()
+
+    return value
+
+def period_keys():
+    '''
+    Returns the timeline index pairs of the full timeline and of every period of the dropdown.
+    '''
+    keys = [resolve_range(TIMELINE_RANGE)]
+    for period in dropdict:
+        key = resolve_range(resolve_period(period))
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+_popups_generation = None
+
+def refresh_popups():
+    '''
+    Drops the popups rendered by webmap_folium after the excavations file changed, so
+    that the popups of deleted features are not kept.
+    '''
+    global _popups_generation
+
+    generation = feature_store.generation()
+    if generation != _popups_generation:
+        clear_popups()
+        _popups_generation = generation
+
+def update_thumbnails(generation=None):
+    '''
+    Builds the thumbnails of the photos that changed (see photo_assets.build_thumbnails)
+    and returns their manifest, used by the next renders. Run by build.py and by the app
+    when it starts and after the photos change, never by a render.
+
+    Parameters:
+    - generation: Generation of the inputs the thumbnails are built for (see photo_manifest).
+    '''
+    global photo_manifest_state
+
+    with thumbnail_lock:
+        manifest = build_thumbnails(PHOTO_DIR, PHOTO_CACHE_DIR, webp=PHOTO_WEBP)
+        photo_manifest_state = (manifest, generation)
+    return manifest
+
+def photo_manifest(generation=None):
+    '''
+    Returns the manifest of the photo thumbnails written by update_thumbnails. It is read
+    once, and read again when generation (the RenderCache.generation() of the app) is
+    not the one it was read for; None keeps the manifest already read.
+    '''
+    global photo_manifest_state
+
+    with thumbnail_lock:
+        manifest, loaded = photo_manifest_state
+        if manifest is None or (generation is not None and generation != loaded):
+            manifest = load_manifest(PHOTO_CACHE_DIR)
+            photo_manifest_state = (manifest, generation)
+        return manifest
+
+def render_range(user_range):
+    '''
+    Renders the excavations map for a resolved timeline index pair and returns the document.
+    '''
+    category_colors = categ['category_colors']
+    category_icons = categ['category_icons']
+
+    mode = FILTER_MODE if len(user_range) > 1 else 'start'
+    refresh_popups()
+    with stage('select'):
+        subset_geometry, subset_properties = feature_store.select(user_range[0], user_range[-1], mode)
+    manifest = photo_manifest()
+    url = None
+    if SERVER_CLUSTERS:
+        url = '/clusters?' + urlencode({'from': _param(user_range[0]), 'until': _param(user_range[-1]), 'mode': mode})
+
+    return default_map(True, subset_properties, subset_geometry, category_colors, category_icons,
+                       photo_manifest=manifest, lazy_popups=LAZY_POPUPS, vector_tiles=VECTOR_TILES,
+                       cluster_url=url)
+
+def _param(value):
+    return '' if value is None else value
+
+def render_client_map():
+    '''
+    Renders the map once with every excavation, to be filtered in the browser.
+    '''
+    refresh_popups()
+    geometry, properties = feature_store.select()
+    return default_map(True, properties, geometry, categ['category_colors'], categ['category_icons'],
+                       client_filter=True, photo_manifest=photo_manifest(), lazy_popups=LAZY_POPUPS,
+                       vector_tiles=VECTOR_TILES)
+
+def render_popups():
+    '''
+    Returns the popup HTML of every excavation, by feature id.
+    '''
+    refresh_popups()
+    manifest = photo_manifest()
+    photos = photo_index(PHOTO_DIR)
+    _, properties = feature_store.select()
+    return {props['id']: popup for props, popup in zip(properties, feature_popups(properties, photos, manifest))}
+
+def cluster_index(from_id=None, until_id=None, mode=FILTER_MODE):
+    '''
+    Clusters the excavations selected by a timeline range (every excavation if no range is given).
+    '''
+    geometry, properties = feature_store.select(from_id, until_id, mode)
+    return ClusterIndex([g['coordinates'][0] for g in geometry], [g['coordinates'][1] for g in geometry],
+                        [p['id'] for p in properties], [p['category'] for p in properties])
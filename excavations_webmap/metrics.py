@@ -0,0 +1,272 @@
+'''
+The following script records the duration and payload size of the Dash callbacks and
+of the stages of a render (feature selection, thumbnails, layers, popups, markers and
+the HTML render), as histograms served in the Prometheus text format from a Flask
+route. Callbacks slower than SLOW_REQUEST_SECONDS can be profiled: their cProfile
+statistics are dumped to SLOW_REQUEST_DIR, to be read with pstats or snakeviz.
+
+The metrics are kept per process: under gunicorn, every worker serves its own. The
+render processes (see render_pool) capture the stages of their renders and send them
+back to the worker, which records them under the callback that submitted the render.
+'''
+
+import cProfile
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8)
+
+# Profile the callbacks and dump those slower than this many seconds (None: disabled)
+SLOW_REQUEST_SECONDS = None
+SLOW_REQUEST_DIR = './cache/slow_requests'
+
+
+class Histogram:
+    '''
+    Cumulative histogram of observed values, by label values.
+
+    Parameters:
+    - name (str): Metric name.
+    - help (str): Description of the metric.
+    - label_names (tuple): Names of the labels.
+    - buckets (tuple): Increasing upper bounds of the buckets.
+    '''
+
+    def __init__(self, name, help, label_names, buckets):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        '''
+        Returns the histogram in the Prometheus text format.
+        '''
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                labels = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, label_values))
+                for bound, count in zip(self.buckets, series['counts']):
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound:g}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series["count"]}')
+                lines.append(f'{self.name}_sum{{{labels}}} {series["sum"]:.6f}')
+                lines.append(f'{self.name}_count{{{labels}}} {series["count"]}')
+        return '\n'.join(lines)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+callback_seconds = Histogram('excavations_callback_seconds', 'Duration of the Dash callbacks.',
+                             ('callback',), SECONDS_BUCKETS)
+callback_bytes = Histogram('excavations_callback_payload_bytes', 'Size of the responses of the Dash callbacks.',
+                           ('callback',), BYTES_BUCKETS)
+stage_seconds = Histogram('excavations_stage_seconds', 'Duration of the stages of the callbacks.',
+                          ('callback', 'stage'), SECONDS_BUCKETS)
+stage_bytes = Histogram('excavations_stage_payload_bytes', 'Size of the output of the stages of the callbacks.',
+                        ('callback', 'stage'), BYTES_BUCKETS)
+HISTOGRAMS = [callback_seconds, callback_bytes, stage_seconds, stage_bytes]
+
+# Values read when the metrics are scraped (e.g. the render cache statistics), by metric name
+_gauges = {}
+
+# Callback running on each thread, the (name, seconds, size) of its stages, and whether
+# they are captured (to be recorded by another process) instead of recorded
+_current = threading.local()
+
+
+def register_gauge(name, help, read):
+    '''
+    Adds a gauge to the metrics, read from a function every time they are served.
+
+    Parameters:
+    - name (str): Metric name.
+    - help (str): Description of the metric.
+    - read (callable): Function returning the current value.
+    '''
+    _gauges[name] = (help, read)
+
+
+def _observe_stage(callback, stages, name, seconds, size):
+    stage_seconds.observe(seconds, callback or 'none', name)
+    if size is not None:
+        stage_bytes.observe(size, callback or 'none', name)
+    if stages is not None:
+        stages.append((name, seconds, size))
+
+
+def _record_stage(name, seconds, size=None):
+    stages = getattr(_current, 'stages', None)
+    if getattr(_current, 'capture', False):
+        stages.append((name, seconds, size))
+    else:
+        _observe_stage(getattr(_current, 'callback', None), stages, name, seconds, size)
+
+
+@contextmanager
+def capture_stages():
+    '''
+    Collects the stages timed inside the context without recording them. The context is
+    the list of their (name, seconds, size), to be recorded by stage_recorder.
+    '''
+    stages = []
+    _current.stages, _current.capture = stages, True
+    try:
+        yield stages
+    finally:
+        _current.stages, _current.capture = None, False
+
+
+def stage_recorder():
+    '''
+    Returns a function recording a list of captured stages (see capture_stages) as stages
+    of the callback running on the calling thread, from any thread.
+    '''
+    callback, stages = getattr(_current, 'callback', None), getattr(_current, 'stages', None)
+
+    def record(captured):
+        for name, seconds, size in captured:
+            _observe_stage(callback, stages, name, seconds, size)
+    return record
+
+
+@contextmanager
+def stage(name):
+    '''
+    Times a stage of the running callback (stages run outside of a callback, e.g. while
+    warming the render cache, are recorded under the 'none' callback). The context is a
+    dictionary where the stage may store its output size under 'bytes'.
+
+    Parameters:
+    - name (str): Name of the stage.
+    '''
+    record = {}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        _record_stage(name, time.perf_counter() - start, record.get('bytes'))
+
+
+class StageTimer:
+    '''
+    Times the consecutive stages of a function: every lap records the time since the
+    previous one (or since the timer was created) as a stage.
+    '''
+
+    def __init__(self):
+        self._last = time.perf_counter()
+
+    def lap(self, name, size=None):
+        '''
+        Records the stage that just ended, with its output size in bytes if given.
+        '''
+        now = time.perf_counter()
+        _record_stage(name, now - self._last, size)
+        self._last = now
+
+
+def _payload_size(value):
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    return len(json.dumps(value, default=str).encode('utf-8'))
+
+
+def _dump_profile(callback, seconds, profile, stages):
+    directory = Path(SLOW_REQUEST_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f'{callback}-{time.strftime("%Y%m%d-%H%M%S")}-{threading.get_ident()}.prof'
+    profile.dump_stats(path)
+    timings = ''.join(f', {name} {stage_time:.3f} s' for name, stage_time, _ in stages)
+    print(f'Slow {callback}: {seconds:.3f} s{timings}, profile written to {path}')
+
+
+def profiled(name, function, *args, **kwargs):
+    '''
+    Calls function and returns its result. With SLOW_REQUEST_SECONDS set, the call is
+    profiled and its profile is dumped (with the stages of the thread) if it is slow.
+
+    Parameters:
+    - name (str): Name of the call in the dump.
+    - function (callable): The function called with args and kwargs.
+    '''
+    if SLOW_REQUEST_SECONDS is None:
+        return function(*args, **kwargs)
+    profile = cProfile.Profile()
+    start = time.perf_counter()
+    result = profile.runcall(function, *args, **kwargs)
+    seconds = time.perf_counter() - start
+    if seconds >= SLOW_REQUEST_SECONDS:
+        _dump_profile(name, seconds, profile, getattr(_current, 'stages', None) or [])
+    return result
+
+
+def instrument(callback):
+    '''
+    Decorator recording the duration and response size of a Dash callback, and the
+    timings of the stages it runs. With SLOW_REQUEST_SECONDS set, the callback is
+    profiled and the profile of a slow call is dumped (see profiled).
+
+    Parameters:
+    - callback (str): Name of the callback in the metrics.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            _current.callback, _current.stages = callback, []
+            start = time.perf_counter()
+            try:
+                result = profiled(callback, function, *args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                _current.callback, _current.stages = None, None
+            callback_seconds.observe(seconds, callback)
+            callback_bytes.observe(_payload_size(result), callback)
+            return result
+        return wrapper
+    return decorator
+
+
+def render_metrics():
+    '''
+    Returns every metric in the Prometheus text format.
+    '''
+    parts = [histogram.render() for histogram in HISTOGRAMS]
+    for name, (help, read) in sorted(_gauges.items()):
+        parts.append(f'# HELP {name} {help}\n# TYPE {name} gauge\n{name} {read()}')
+    return '\n'.join(parts) + '\n'
+
+
+def register_metrics_route(server, url='/metrics'):
+    '''
+    Serves the metrics in the Prometheus text format from url on a Flask server.
+
+    Parameters:
+    - server (flask.Flask): The Flask server of the Dash app.
+    - url (str): URL of the metrics.
+    '''
+
+    def metrics():
+        return server.response_class(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+    server.add_url_rule(url, 'excavations_metrics', metrics)
@@ -0,0 +1,228 @@
+'''
+The following script prepares the excavation photos to be served as static assets.
+Every photo of the photos/ directory is resized once into a content-hashed thumbnail
+(optionally with a WebP variant) inside a cache directory, and a manifest maps each
+source photo to its thumbnails. The popups then reference the thumbnails by URL
+instead of inlining the full-size images in base64.
+'''
+
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from flask import send_from_directory
+from PIL import Image, ImageOps
+
+PHOTO_EXTENSIONS = ['.jpg', '.jpeg']
+MANIFEST_NAME = 'manifest.json'
+
+
+class PhotoIndex:
+    '''
+    Index of the photos of a directory by feature id. A feature may have several photos,
+    named '<id>.jpg' followed by '<id>_<suffix>.jpg' (or '<id>-<suffix>.jpg'), which are
+    returned in that order. The directory is only re-listed when its modification
+    time changes.
+
+    Parameters:
+    - photo_dir (str): Directory with the original photos.
+    '''
+
+    def __init__(self, photo_dir='./photos'):
+        self.photo_dir = Path(photo_dir)
+        self._mtime = None
+        self._photos = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        '''
+        Re-lists the directory if it changed since the last call.
+        '''
+        mtime = self.photo_dir.stat().st_mtime_ns if self.photo_dir.exists() else None
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            photos = {}
+            if mtime is not None:
+                for file in self.photo_dir.iterdir():
+                    if file.suffix.lower() not in PHOTO_EXTENSIONS:
+                        continue
+                    id, _, suffix = re.match(r'^([^_-]+)([_-]?)(.*)$', file.stem).groups()
+                    photos.setdefault(id, []).append((_natural_key(suffix), str(file)))
+            self._photos = {id: [path for _, path in sorted(files)] for id, files in photos.items()}
+            self._mtime = mtime
+
+    def photos(self, id):
+        '''
+        Returns the ordered list of photo paths of a feature id.
+        '''
+        return self._photos.get(str(id), [])
+
+
+_photo_indexes = {}
+_encoded_images = {}
+
+
+def photo_index(photo_dir='./photos'):
+    '''
+    Returns the shared, up to date PhotoIndex of a directory.
+    '''
+    key = os.path.abspath(photo_dir)
+    index = _photo_indexes.get(key)
+    if index is None:
+        index = _photo_indexes.setdefault(key, PhotoIndex(key))
+    index.refresh()
+    return index
+
+
+def encode_image(path):
+    '''
+    Returns the base64 encoding of an image file. The result is memoized and only
+    recomputed when the file size or modification time changes.
+    '''
+    stat = os.stat(path)
+    cached = _encoded_images.get(path)
+    if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+    with open(path, 'rb') as image_file:
+        encoded_image = base64.b64encode(image_file.read()).decode('utf-8')
+    _encoded_images[path] = ((stat.st_mtime_ns, stat.st_size), encoded_image)
+    return encoded_image
+
+
+def _natural_key(text):
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.split(r'(\d+)', text) if part]
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _tmp_path(path):
+    # Unique per process and thread, so concurrent builds never write the same file
+    return path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+
+
+def _save_image(image, path, format, quality):
+    # Write next to the target and rename, so a half written thumbnail is never served
+    tmp_path = _tmp_path(path)
+    image.save(tmp_path, format=format, quality=quality)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(cache_dir):
+    '''
+    Loads the photo manifest of a cache directory, or an empty one if it does not exist.
+
+    Parameters:
+    - cache_dir (str): Directory holding the thumbnails and the manifest.
+    '''
+    manifest_path = Path(cache_dir) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {'photos': {}}
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+
+def build_thumbnails(photo_dir='./photos', cache_dir='./cache/photos', size=(700, 700), quality=80, webp=False):
+    '''
+    Creates the resized thumbnails of every photo that changed since the last build
+    and returns the updated manifest.
+
+    Parameters:
+    - photo_dir (str): Directory with the original photos.
+    - cache_dir (str): Directory where the thumbnails and the manifest are written.
+    - size (tuple): Maximum (width, height) of a thumbnail.
+    - quality (int): JPEG/WebP quality of the thumbnails.
+    - webp (bool): Whether to also produce a WebP variant of each thumbnail.
+    '''
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    previous = load_manifest(cache_dir)
+    settings = {'size': list(size), 'quality': quality, 'webp': webp}
+    if {key: previous.get(key) for key in settings} != settings:
+        previous = {'photos': {}}
+
+    photos = {}
+    for source in sorted(Path(photo_dir).iterdir()):
+        if source.suffix.lower() not in PHOTO_EXTENSIONS:
+            continue
+        stat = source.stat()
+        entry = previous['photos'].get(source.name)
+        # Sources are only re-read when their size or modification time changed
+        if (entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['bytes'] == stat.st_size
+                and all((cache_dir / entry[key]).exists() for key in ('jpeg', 'webp') if key in entry)):
+            photos[source.name] = entry
+            continue
+
+        digest = hashlib.sha256((_file_digest(source) + json.dumps(settings)).encode('utf-8')).hexdigest()[:16]
+        entry = {'mtime': stat.st_mtime_ns, 'bytes': stat.st_size, 'jpeg': f'{source.stem}.{digest}.jpg'}
+        if webp:
+            entry['webp'] = f'{source.stem}.{digest}.webp'
+
+        if not all((cache_dir / entry[key]).exists() for key in ('jpeg', 'webp') if key in entry):
+            with Image.open(source) as image:
+                image = ImageOps.exif_transpose(image).convert('RGB')
+                image.thumbnail(size)
+                _save_image(image, cache_dir / entry['jpeg'], 'JPEG', quality)
+                if webp:
+                    _save_image(image, cache_dir / entry['webp'], 'WEBP', quality)
+        photos[source.name] = entry
+
+    # Drop the thumbnails that no manifest entry references anymore
+    referenced = {entry[key] for entry in photos.values() for key in ('jpeg', 'webp') if key in entry}
+    for file in cache_dir.iterdir():
+        if file.name != MANIFEST_NAME and file.name not in referenced and file.suffix != '.tmp':
+            file.unlink(missing_ok=True)
+
+    manifest = dict(settings, photos=photos)
+    tmp_path = _tmp_path(cache_dir / MANIFEST_NAME)
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(tmp_path, cache_dir / MANIFEST_NAME)
+    return manifest
+
+
+def thumbnail_html(entry, url_prefix='/photos'):
+    '''
+    Returns the popup HTML that displays the thumbnail of a manifest entry.
+
+    Parameters:
+    - entry (dict): The manifest entry of the photo.
+    - url_prefix (str): URL under which the thumbnails are served.
+    '''
+    source = ''
+    if 'webp' in entry:
+        source = f'<source srcset="{url_prefix}/{entry["webp"]}" type="image/webp">'
+    return f"""<div style="text-align: center;">
+                <picture>{source}<img src="{url_prefix}/{entry['jpeg']}" alt="Image" width="350px" loading="lazy"></picture><br><br>
+            </div>"""
+
+
+def register_photo_route(server, cache_dir='./cache/photos', url_prefix='/photos'):
+    '''
+    Serves the thumbnails of cache_dir from url_prefix on a Flask server. The file names
+    are content-hashed, so they are sent with validators and a long-lived immutable
+    Cache-Control header.
+
+    Parameters:
+    - server (flask.Flask): The Flask server of the Dash app.
+    - cache_dir (str): Directory holding the thumbnails.
+    - url_prefix (str): URL under which the thumbnails are served.
+    '''
+    cache_dir = os.path.abspath(cache_dir)
+
+    def photo(filename):
+        response = send_from_directory(cache_dir, filename, conditional=True, etag=True, max_age=31536000)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    server.add_url_rule(url_prefix + '/<path:filename>', 'excavation_photo', photo)
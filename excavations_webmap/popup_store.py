@@ -0,0 +1,65 @@
+'''
+The following script keeps the popup HTML of every excavation in memory, by feature id,
+and serves it from a Flask route. The map markers only carry the feature id and fetch
+their popup on click (see map_elements.LazyPopups).
+'''
+
+import hashlib
+from flask import abort, request
+
+
+class PopupStore:
+    '''
+    Precomputed popup documents and their ETags, by feature id.
+
+    Parameters:
+    - popups (dict): The popup HTML of each feature id.
+    '''
+
+    def __init__(self, popups=None):
+        self.popups = {}
+        self.etags = {}
+        for id, popup in (popups or {}).items():
+            self.add(id, popup)
+
+    def add(self, id, popup):
+        self.popups[str(id)] = popup
+        self.etags[str(id)] = hashlib.sha1(popup.encode('utf-8')).hexdigest()
+
+    def get(self, id):
+        '''
+        Returns the (html, etag) pair of a feature id, or None if it is unknown.
+        '''
+        id = str(id)
+        if id not in self.popups:
+            return None
+        return self.popups[id], self.etags[id]
+
+    def __len__(self):
+        return len(self.popups)
+
+
+def register_popup_route(server, get_store, url_prefix='/popup', max_age=300):
+    '''
+    Serves the popups of a PopupStore from url_prefix/<id> on a Flask server, with a
+    strong ETag, conditional-GET support and a Cache-Control max-age.
+
+    Parameters:
+    - server (flask.Flask): The Flask server of the Dash app.
+    - get_store (callable): Function returning the current PopupStore.
+    - url_prefix (str): URL under which the popups are served.
+    - max_age (int): Seconds a browser may reuse a popup without revalidating it.
+    '''
+
+    def popup(id):
+        entry = get_store().get(id)
+        if entry is None:
+            abort(404)
+        html, etag = entry
+        response = server.response_class(html, mimetype='text/html')
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        return response.make_conditional(request)
+
+    server.add_url_rule(url_prefix + '/<id>', 'excavation_popup', popup)
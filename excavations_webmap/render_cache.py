@@ -0,0 +1,262 @@
+'''
+The following script implements a bounded, in-memory LRU cache for the rendered
+excavation map documents. Entries are keyed on the resolved timeline index pair
+and the whole cache is dropped whenever one of the watched data files or photos
+changes on disk. Renders are single-flight: concurrent requests for a key that is
+being rendered wait for that render instead of starting their own.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+
+
+class RenderCache:
+    '''
+    Least-recently-used cache of rendered map documents with an entry and a byte limit.
+
+    Parameters:
+    - max_entries (int): Maximum number of documents kept in memory.
+    - max_bytes (int): Maximum total size (in bytes) of the cached documents.
+    - watch_paths (list): Files or directories whose modification invalidates the cache.
+    - check_interval (float): Minimum number of seconds between two scans of watch_paths.
+    '''
+
+    def __init__(self, max_entries=32, max_bytes=256 * 1024 * 1024, watch_paths=(), check_interval=1.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.watch_paths = [Path(path) for path in watch_paths]
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.shared = 0
+        self.cancellations = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._generation = 0
+        # Renders in progress: key -> [future, number of callers waiting for it]
+        self._inflight = {}
+        self._lock = threading.RLock()
+        self._fingerprint = self.fingerprint()
+        self._checked_at = time.monotonic()
+
+    def fingerprint(self):
+        '''
+        Returns a hashable snapshot (path, size, mtime) of every watched file.
+        '''
+        snapshot = []
+        for path in self.watch_paths:
+            if path.is_dir():
+                files = sorted(file for file in path.iterdir() if file.is_file())
+            elif path.exists():
+                files = [path]
+            else:
+                files = []
+            for file in files:
+                stat = file.stat()
+                snapshot.append((str(file), stat.st_size, stat.st_mtime_ns))
+        return tuple(snapshot)
+
+    def _check_fresh(self):
+        # Stat the watched paths at most once per check_interval
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        fingerprint = self.fingerprint()
+        if fingerprint != self._fingerprint:
+            self._fingerprint = fingerprint
+            if self._entries:
+                self.invalidations += 1
+            self._generation += 1
+            self._entries.clear()
+            self._size = 0
+
+    def get(self, key):
+        '''
+        Returns the cached document for key, or None if it is not cached.
+        '''
+        with self._lock:
+            self._check_fresh()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, document, generation=None):
+        '''
+        Stores a document and evicts the least recently used ones until both limits hold.
+        Documents larger than max_bytes, or rendered before the last invalidation
+        (generation mismatch), are not cached at all.
+        '''
+        size = len(document.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (document, size)
+            self._size += size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def _finish(self, key, future, generation):
+        with self._lock:
+            flight = self._inflight.get(key)
+            if flight is not None and flight[0] is future:
+                del self._inflight[key]
+        if not future.cancelled() and future.exception() is None:
+            self.put(key, future.result(), generation)
+
+    def _join(self, key, submit):
+        # Returns the render of key in progress, or starts one with submit(key)
+        with self._lock:
+            flight = self._inflight.get(key)
+            if flight is None:
+                generation = self._generation
+                future = submit(key)
+                flight = self._inflight[key] = [future, 0]
+                future.add_done_callback(lambda future: self._finish(key, future, generation))
+            else:
+                self.shared += 1
+            flight[1] += 1
+            return flight[0]
+
+    def render_future(self, key, submit):
+        '''
+        Returns a Future of the document for key: already resolved if it is cached, the
+        render in progress if there is one, or else a new render submitted with submit(key).
+        The document is cached when the render completes. Every call must be paired with
+        a call to release once the caller stops waiting.
+
+        Parameters:
+        - key (tuple): The resolved timeline index pair.
+        - submit (callable): Function that starts the render of a key and returns its Future.
+        '''
+        document = self.get(key)
+        if document is not None:
+            future = Future()
+            future.set_result(document)
+            return future
+        return self._join(key, submit)
+
+    def release(self, key, future):
+        '''
+        Stops waiting for a Future of render_future. A render that no other caller waits
+        for is cancelled if it has not started yet.
+        '''
+        with self._lock:
+            flight = self._inflight.get(key)
+            if flight is None or flight[0] is not future:
+                return
+            flight[1] -= 1
+            if flight[1] == 0 and future.cancel():
+                self.cancellations += 1
+
+    def _render_here(self, key, render):
+        # Joins the render of key in progress, or renders it on the calling thread
+        started = []
+
+        def submit(key):
+            future = Future()
+            started.append(future)
+            return future
+
+        future = self._join(key, submit)
+        try:
+            if started and future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(render(key))
+                except BaseException as error:
+                    future.set_exception(error)
+            return future.result()
+        finally:
+            self.release(key, future)
+
+    def get_or_render(self, key, render):
+        '''
+        Returns the cached document for key, calling render(key) to build it on a miss
+        (or waiting for the render of key already in progress).
+
+        Parameters:
+        - key (tuple): The resolved timeline index pair.
+        - render (callable): Function that returns the rendered document for a key.
+        '''
+        document = self.get(key)
+        if document is not None:
+            return document
+        return self._render_here(key, render)
+
+    def warm(self, keys, render=None, submit=None):
+        '''
+        Renders every key that is not already cached, one after the other with render, or
+        all at once with submit.
+
+        Parameters:
+        - keys (iterable): The timeline index pairs to precompute.
+        - render (callable): Function that returns the rendered document for a key.
+        - submit (callable): Function that starts the render of a key and returns its Future.
+        '''
+        if render is None and submit is None:
+            raise ValueError('warm needs a render or a submit function')
+        futures = []
+        for key in keys:
+            with self._lock:
+                self._check_fresh()
+                cached = key in self._entries
+            if cached:
+                continue
+            if submit is None:
+                self._render_here(key, render)
+            else:
+                futures.append((key, self._join(key, submit)))
+        for key, future in futures:
+            try:
+                future.result()
+            finally:
+                self.release(key, future)
+
+    def generation(self):
+        '''
+        Returns a counter that increases every time the cache is invalidated, so that
+        other artifacts derived from the watched files can follow the same lifecycle.
+        '''
+        with self._lock:
+            self._check_fresh()
+            return self._generation
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        '''
+        Returns the cache counters as a dictionary.
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'shared': self.shared,
+                'cancellations': self.cancellations,
+                'in_flight': len(self._inflight),
+            }
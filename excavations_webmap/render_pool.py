@@ -0,0 +1,103 @@
+'''
+The following script runs the map renders in a pool of worker processes, so that the
+folium builds (which hold the GIL for seconds) do not block the threads serving the
+Dash callbacks. The workers are forked when the pool is created, before the app starts
+any thread, and inherit the modules and datasets already loaded by the app; every
+worker then keeps its own memoized layers and popups, and its own copy of the thumbnail
+manifest, read again when the generation sent with a render changes (the app builds
+the thumbnails before, see map_renderer.update_thumbnails).
+
+Under gunicorn, every worker creates its own pool: the app must not be preloaded
+(--preload) in the master process, whose pool would not survive the fork of the workers.
+
+The stages of a render are timed in the worker and sent back with the document, to be
+recorded in the app's metrics under the callback that submitted the render. A slow
+render is profiled in the worker (see metrics.profiled).
+'''
+
+import multiprocessing
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor
+from metrics import capture_stages, profiled, stage_recorder
+
+
+def fork_available():
+    '''
+    Returns whether the render processes can be forked: fork does not exist on Windows,
+    and on macOS a process forked from one running threads may crash in the system
+    libraries. Without it, the maps are rendered on the threads of the app.
+    '''
+    return sys.platform != 'darwin' and 'fork' in multiprocessing.get_all_start_methods()
+
+
+def _ready():
+    return True
+
+
+def _render_range(key, generation):
+    # Imported in the worker, where it is already loaded by the forked app
+    from map_renderer import photo_manifest, render_range
+    photo_manifest(generation)
+    with capture_stages() as stages:
+        document = profiled('render_range', render_range, key)
+    return document, stages
+
+
+class _RenderFuture(Future):
+    # Future of the document of a render, resolved once its stages are recorded, and
+    # cancelled with the render
+    def __init__(self, render):
+        super().__init__()
+        self._render = render
+
+    def cancel(self):
+        return self._render.cancel()
+
+
+class RenderPool:
+    '''
+    Pool of processes rendering the map of timeline index pairs.
+
+    Parameters:
+    - processes (int): Number of worker processes.
+    - generation (callable): Returns the generation of the inputs (RenderCache.generation),
+      sent with every render so that the workers read the thumbnail manifest again when it
+      changes, or None.
+    '''
+
+    def __init__(self, processes, generation=None):
+        self.processes = processes
+        self.generation = generation
+        self._executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'))
+        # The first task forks every worker at once
+        self._executor.submit(_ready).result()
+
+    def submit(self, key):
+        '''
+        Submits the render of a timeline index pair and returns the Future of its document,
+        which can be cancelled until a worker picks it up.
+        '''
+        record = stage_recorder()
+        generation = self.generation() if self.generation is not None else None
+        render = self._executor.submit(_render_range, key, generation)
+        future = _RenderFuture(render)
+
+        def done(render):
+            if render.cancelled():
+                Future.cancel(future)
+            elif render.exception() is not None:
+                future.set_exception(render.exception())
+            else:
+                document, stages = render.result()
+                record(stages)
+                future.set_result(document)
+
+        render.add_done_callback(done)
+        return future
+
+    def shutdown(self):
+        if sys.version_info >= (3, 9):
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            # cancel_futures is new in Python 3.9: the queued renders still run
+            self._executor.shutdown(wait=False)
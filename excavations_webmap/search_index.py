@@ -0,0 +1,194 @@
+'''
+The following script implements the full-text search of the excavations: an inverted
+index over their descriptions, finds, bibliography, location, archaeologist and
+category. Texts and queries are folded the same way (accents removed, lowercase,
+final sigma as sigma), every query word matches the indexed words it is a prefix of,
+and the results can be restricted to a timeline range as in feature_store.
+'''
+
+import json
+import re
+import unicodedata
+from bisect import bisect_left
+import numpy as np
+from flask import abort, request
+from feature_store import FILTER_MODES
+
+SEARCH_FIELDS = ['description', 'evrimata', 'bibliografia', 'thesi', 'arxaiologos', 'category']
+TOKEN_PATTERN = re.compile(r'\w+')
+# Placeholder of the empty fields in the data
+EMPTY_VALUES = {None, '', '-'}
+PREFIX_CACHE_ENTRIES = 4096
+# Combining diacritical marks, left over by the canonical decomposition of accented letters
+DIACRITICS = re.compile('[\u0300-\u036f]+')
+
+
+def fold(text):
+    '''
+    Folds a text for matching: accents and other diacritics are removed and the case is
+    folded (which also maps the final sigma 'ς' to 'σ').
+    '''
+    return DIACRITICS.sub('', unicodedata.normalize('NFD', str(text))).casefold()
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(fold(text))
+
+
+class SearchIndex:
+    '''
+    Inverted index of the excavations, mapping every folded word to the sorted positions
+    of the features containing it.
+
+    Parameters:
+    - geometry (list): The GeoJSON point geometry of each feature.
+    - properties (list): The properties of each feature.
+    '''
+
+    def __init__(self, geometry, properties):
+        self.properties = properties
+        coordinates = np.array([g['coordinates'][:2] for g in geometry], dtype=np.float64).reshape(-1, 2)
+        self.lon, self.lat = coordinates[:, 0], coordinates[:, 1]
+        self.from_ids = np.array([p['from_id'] for p in properties], dtype=np.int32)
+        self.until_ids = np.array([p['until_id'] for p in properties], dtype=np.int32)
+        postings = {}
+        # Categories, archaeologists and references repeat across the features
+        value_tokens = {}
+        for position, property in enumerate(properties):
+            tokens = set()
+            for field in SEARCH_FIELDS:
+                value = property.get(field)
+                if value in EMPTY_VALUES:
+                    continue
+                if value not in value_tokens:
+                    value_tokens[value] = tokenize(value)
+                tokens.update(value_tokens[value])
+            for token in tokens:
+                postings.setdefault(token, []).append(position)
+        self.vocabulary = sorted(postings)
+        self.postings = {token: np.array(positions, dtype=np.int64) for token, positions in postings.items()}
+        self._prefixes = {}
+
+    def prefix(self, prefix):
+        '''
+        Returns the sorted positions of the features containing a word starting with prefix.
+        '''
+        positions = self._prefixes.get(prefix)
+        if positions is None:
+            start = bisect_left(self.vocabulary, prefix)
+            matches = []
+            for token in self.vocabulary[start:]:
+                if not token.startswith(prefix):
+                    break
+                matches.append(self.postings[token])
+            if len(matches) == 1:
+                positions = matches[0]
+            else:
+                mask = np.zeros(len(self.properties), dtype=bool)
+                for match in matches:
+                    mask[match] = True
+                positions = np.flatnonzero(mask)
+            if len(self._prefixes) >= PREFIX_CACHE_ENTRIES:
+                self._prefixes.clear()
+            self._prefixes[prefix] = positions
+        return positions
+
+    def search(self, query, a=None, b=None, mode='within'):
+        '''
+        Returns the sorted positions of the features matching every word of a query,
+        restricted to a timeline range if one is given.
+
+        Parameters:
+        - query (str): The words to search for.
+        - a (int): Start of the timeline range (timeline_dic_n index), or None for no start.
+        - b (int): End of the timeline range, or None for no end.
+        - mode (str): 'within', 'overlap' or 'start' (see feature_store.FeatureStore.query).
+        '''
+        tokens = tokenize(query)
+        if not tokens:
+            return np.empty(0, dtype=np.int64)
+        # Intersect the rarest words first
+        matches = sorted((self.prefix(token) for token in set(tokens)), key=len)
+        positions = matches[0]
+        for other in matches[1:]:
+            if len(positions) == 0:
+                break
+            mask = np.zeros(len(self.properties), dtype=bool)
+            mask[other] = True
+            positions = positions[mask[positions]]
+        if a is not None or b is not None:
+            # Same selection as feature_store.IntervalIndex, on the matches only; a missing
+            # bound leaves the range open on that side
+            if mode not in FILTER_MODES:
+                raise ValueError(f'Unknown filter mode {mode!r}, expected one of {FILTER_MODES}')
+            starts, ends = self.from_ids[positions], self.until_ids[positions]
+            keep = np.ones(len(positions), dtype=bool)
+            if mode == 'within':
+                if a is not None:
+                    keep &= starts >= a
+                if b is not None:
+                    keep &= (starts <= b) & (ends <= b)
+            elif mode == 'overlap':
+                if a is not None:
+                    keep &= ends >= a
+                if b is not None:
+                    keep &= starts <= b
+            elif a is not None:
+                keep &= starts == a
+            positions = positions[keep]
+        return positions
+
+    def ids(self, positions):
+        '''
+        Returns the distinct feature ids at positions, in order.
+        '''
+        return list(dict.fromkeys(self.properties[i]['id'] for i in positions))
+
+    def bounds(self, positions):
+        '''
+        Returns the [[south, west], [north, east]] bounds of the features at positions,
+        or None if there are none.
+        '''
+        if len(positions) == 0:
+            return None
+        lon, lat = self.lon[positions], self.lat[positions]
+        return [[float(lat.min()), float(lon.min())], [float(lat.max()), float(lon.max())]]
+
+    def __len__(self):
+        return len(self.properties)
+
+
+def register_search_route(server, get_index, url='/api/search', max_results=50):
+    '''
+    Serves the search from url on a Flask server, as JSON. The query parameters are q
+    (the query), the from, until and mode of the timeline filter (either bound can be
+    left out), and limit (the number of results listed, all the matching ids are returned).
+
+    Parameters:
+    - server (flask.Flask): The Flask server of the Dash app.
+    - get_index (callable): Function returning the current SearchIndex.
+    - url (str): URL of the search.
+    - max_results (int): Default number of results listed.
+    '''
+
+    def search():
+        try:
+            from_id = int(request.args['from']) if request.args.get('from') else None
+            until_id = int(request.args['until']) if request.args.get('until') else None
+            limit = int(request.args.get('limit', max_results))
+        except ValueError:
+            abort(400)
+        mode = request.args.get('mode', 'within')
+        if mode not in FILTER_MODES:
+            abort(400)
+        index = get_index()
+        positions = index.search(request.args.get('q', ''), from_id, until_id, mode)
+        results = []
+        for i in positions[:max(limit, 0)]:
+            property = index.properties[i]
+            results.append({field: property.get(field) for field in ['id', 'category', 'thesi', 'xronologia', 'description']})
+        payload = {'count': len(positions), 'ids': index.ids(positions), 'bounds': index.bounds(positions),
+                   'results': results}
+        return server.response_class(json.dumps(payload, ensure_ascii=False), mimetype='application/json')
+
+    server.add_url_rule(url, 'excavation_search', search)
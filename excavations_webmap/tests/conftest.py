@@ -0,0 +1,12 @@
+'''
+The modules of the app are flat and read their data relative to the app directory:
+the tests import them from it and run in it.
+'''
+
+import os
+import sys
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(APP_DIR))
+os.chdir(APP_DIR)
@@ -0,0 +1,29 @@
+from flask import Flask
+from clustering import ClusterIndex, register_cluster_route
+
+
+def cluster_client():
+    calls = []
+
+    def get_index(from_id, until_id, mode):
+        calls.append((from_id, until_id, mode))
+        return ClusterIndex([22.37, 22.38], [38.52, 38.53], [1, 2], ['Ναός', 'Τάφος'])
+
+    server = Flask(__name__)
+    register_cluster_route(server, get_index)
+    return server.test_client(), calls
+
+
+def test_cluster_route_passes_the_range():
+    client, calls = cluster_client()
+    assert client.get('/clusters?zoom=14&from=3&until=10&mode=overlap').status_code == 200
+    assert client.get('/clusters?zoom=14').status_code == 200
+    assert calls == [(3, 10, 'overlap'), (None, None, None)]
+
+
+def test_cluster_route_rejects_half_open_ranges_and_unknown_modes():
+    client, calls = cluster_client()
+    assert client.get('/clusters?zoom=14&from=3').status_code == 400
+    assert client.get('/clusters?zoom=14&until=10').status_code == 400
+    assert client.get('/clusters?zoom=14&from=3&until=10&mode=inside').status_code == 400
+    assert calls == []
@@ -0,0 +1,82 @@
+import json
+import shutil
+import sqlite3
+from itertools import combinations_with_replacement
+
+import pytest
+
+from feature_store import FILTER_MODES, FeatureStore, GeoPackageStore
+
+GEOJSON = './data/excavation_ruins.geojson'
+GEOPACKAGE = './data/excavation_ruins_last_update2.gpkg'
+
+with open('./data/timeline_dic.json', 'r') as file:
+    TIMELINE_IDS = sorted(set(json.load(file)['timeline_dic_n'].values()))
+RANGES = list(combinations_with_replacement(TIMELINE_IDS, 2))
+
+
+def loop_filter(properties, a, b, mode):
+    # The per-feature loop the webmap filtered with before the interval index
+    selected = []
+    for position, props in enumerate(properties):
+        from_id, until_id = props['from_id'], props['until_id']
+        if mode == 'within':
+            keep = from_id >= a and until_id <= b
+        elif mode == 'overlap':
+            keep = from_id <= b and until_id >= a
+        else:
+            keep = from_id == a
+        if keep:
+            selected.append(position)
+    return selected
+
+
+@pytest.fixture(scope='module')
+def geopackage(tmp_path_factory):
+    # A copy: opening the store must not touch the tracked file
+    path = tmp_path_factory.mktemp('gpkg') / 'excavations.gpkg'
+    shutil.copy(GEOPACKAGE, path)
+    return GeoPackageStore(str(path))
+
+
+@pytest.mark.parametrize('mode', FILTER_MODES)
+def test_interval_index_matches_the_loop(mode):
+    store = FeatureStore(GEOJSON)
+    for a, b in RANGES:
+        assert list(store.query(a, b, mode)) == loop_filter(store.properties, a, b, mode), (a, b)
+
+
+@pytest.mark.parametrize('mode', FILTER_MODES)
+def test_geopackage_query_matches_the_loop(geopackage, mode):
+    properties = geopackage.properties
+    for a, b in RANGES[::7]:
+        _, selected = geopackage.select(a, b, mode)
+        assert selected == [properties[i] for i in loop_filter(properties, a, b, mode)], (a, b)
+
+
+def test_geopackage_returns_every_row(geopackage):
+    # The GeoPackage is a later export than the GeoJSON (122 rows against 125 features):
+    # every one of its rows is read
+    with sqlite3.connect(GEOPACKAGE) as connection:
+        rows = connection.execute(f'SELECT COUNT(*) FROM "{geopackage.table}"').fetchone()[0]
+    assert len(geopackage.properties) == len(geopackage) == rows
+
+
+def test_geopackage_bbox_uses_the_rtree(geopackage):
+    assert geopackage.rtree is not None
+    geometry, _ = geopackage.select()
+    xs, ys = sorted(g['coordinates'][0] for g in geometry), sorted(g['coordinates'][1] for g in geometry)
+    bbox = (xs[len(xs) // 4], ys[len(ys) // 4], xs[3 * len(xs) // 4], ys[3 * len(ys) // 4])
+    inside = [g for g in geometry
+              if bbox[0] <= g['coordinates'][0] <= bbox[2] and bbox[1] <= g['coordinates'][1] <= bbox[3]]
+    selected, _ = geopackage.select(bbox=bbox)
+    assert 0 < len(selected) < len(geometry)
+    assert selected == inside
+
+
+def test_columns_match_select(geopackage):
+    a, b = TIMELINE_IDS[0], TIMELINE_IDS[len(TIMELINE_IDS) // 2]
+    _, properties = geopackage.select(a, b, 'overlap')
+    columns = geopackage.columns(a, b, 'overlap')
+    assert list(columns['id']) == [props['id'] for props in properties]
+    assert list(columns['from_id']) == [props['from_id'] for props in properties]
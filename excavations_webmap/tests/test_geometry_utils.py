@@ -0,0 +1,26 @@
+from geometry_utils import quantize_geometry
+
+SQUARE = [[22.0, 38.0], [22.01, 38.0], [22.01, 38.01], [22.0, 38.01], [22.0, 38.0]]
+# Smaller than the precision of one decimal: collapses when quantized
+TINY = [[22.0, 38.0], [22.0001, 38.0], [22.0001, 38.0001], [22.0, 38.0001], [22.0, 38.0]]
+HOLE = [[22.002, 38.002], [22.004, 38.002], [22.004, 38.004], [22.002, 38.002]]
+
+
+def test_collapsed_hole_is_dropped():
+    geometry = quantize_geometry({'type': 'Polygon', 'coordinates': [SQUARE, TINY]}, 3)
+    assert len(geometry['coordinates']) == 1
+    assert geometry['coordinates'][0][0] == [22.0, 38.0]
+
+
+def test_polygon_with_collapsed_exterior_is_dropped():
+    # The hole must not become the exterior
+    geometry = quantize_geometry({'type': 'Polygon', 'coordinates': [TINY, HOLE]}, 3)
+    assert geometry['coordinates'] == []
+    geometry = quantize_geometry({'type': 'MultiPolygon', 'coordinates': [[TINY, HOLE], [SQUARE]]}, 3)
+    assert len(geometry['coordinates']) == 1
+    assert geometry['coordinates'][0][0][1] == [22.01, 38.0]
+
+
+def test_empty_rings():
+    assert quantize_geometry({'type': 'LineString', 'coordinates': []}, 3)['coordinates'] == []
+    assert quantize_geometry({'type': 'Polygon', 'coordinates': [[]]}, 3)['coordinates'] == []
@@ -0,0 +1,36 @@
+from PIL import Image
+
+import map_renderer
+from photo_assets import MANIFEST_NAME, build_thumbnails
+
+
+def _photo(path, color):
+    Image.new('RGB', (40, 30), color).save(path, format='JPEG')
+
+
+def test_renders_read_the_manifest_once_per_generation(tmp_path, monkeypatch):
+    photo_dir, cache_dir = tmp_path / 'photos', tmp_path / 'cache'
+    photo_dir.mkdir()
+    _photo(photo_dir / '1.jpg', 'red')
+    monkeypatch.setattr(map_renderer, 'PHOTO_DIR', str(photo_dir))
+    monkeypatch.setattr(map_renderer, 'PHOTO_CACHE_DIR', str(cache_dir))
+    monkeypatch.setattr(map_renderer, 'photo_manifest_state', (None, None))
+
+    assert list(map_renderer.update_thumbnails(1)['photos']) == ['1.jpg']
+    # A new photo is only built by the app, and only read after the generation changed
+    _photo(photo_dir / '2.jpg', 'blue')
+    assert list(map_renderer.photo_manifest(1)['photos']) == ['1.jpg']
+    assert not list(cache_dir.glob('2.*'))
+    build_thumbnails(str(photo_dir), str(cache_dir))
+    assert list(map_renderer.photo_manifest()['photos']) == ['1.jpg']
+    assert sorted(map_renderer.photo_manifest(2)['photos']) == ['1.jpg', '2.jpg']
+
+
+def test_manifest_is_replaced_whole(tmp_path):
+    photo_dir, cache_dir = tmp_path / 'photos', tmp_path / 'cache'
+    photo_dir.mkdir()
+    _photo(photo_dir / '1.jpg', 'red')
+    build_thumbnails(str(photo_dir), str(cache_dir))
+    build_thumbnails(str(photo_dir), str(cache_dir), quality=60)
+    # Written next to the manifest and renamed over it: no temporary file is left behind
+    assert sorted(file.name for file in cache_dir.iterdir() if not file.name.startswith('1.')) == [MANIFEST_NAME]
@@ -0,0 +1,27 @@
+import webmap_folium
+
+
+class NoPhotos:
+    def photos(self, feature_id):
+        return []
+
+
+def excavation(feature_id, description):
+    return {'id': feature_id, 'category': 'Ναός', 'description': description, 'xronologia': 'Κλασική',
+            'from': '-480', 'until': '-323', 'evrimata': '', 'bibliografia': '', 'thesi': '', 'arxaiologos': ''}
+
+
+def test_popups_follow_their_content():
+    webmap_folium.clear_popups()
+    first, = webmap_folium.feature_popups([excavation(1, 'Κρηπίδα')], NoPhotos())
+    again, = webmap_folium.feature_popups([excavation(1, 'Κρηπίδα')], NoPhotos())
+    changed, = webmap_folium.feature_popups([excavation(1, 'Κίονες')], NoPhotos())
+    assert again is first
+    assert 'Κίονες' in changed and 'Κρηπίδα' not in changed
+
+
+def test_clear_popups_drops_deleted_features():
+    webmap_folium.feature_popups([excavation(1, 'Κρηπίδα'), excavation(2, 'Τοίχος')], NoPhotos())
+    webmap_folium.clear_popups()
+    webmap_folium.feature_popups([excavation(1, 'Κρηπίδα')], NoPhotos())
+    assert set(webmap_folium._popups) == {1}
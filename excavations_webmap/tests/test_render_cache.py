@@ -0,0 +1,107 @@
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+from render_cache import RenderCache
+
+
+def test_entry_limit_evicts_the_least_recently_used():
+    cache = RenderCache(max_entries=2)
+    cache.put('a', 'A')
+    cache.put('b', 'B')
+    assert cache.get('a') == 'A'
+    cache.put('c', 'C')
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == ('A', 'C')
+    assert cache.stats()['evictions'] == 1
+
+
+def test_byte_limit():
+    cache = RenderCache(max_bytes=10)
+    cache.put('a', 'x' * 6)
+    cache.put('b', 'y' * 6)
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] == 6
+    # Larger than the whole cache: not kept at all
+    cache.put('c', 'z' * 11)
+    assert cache.get('c') is None
+    assert cache.get('b') == 'y' * 6
+
+
+def test_change_of_a_watched_file_invalidates(tmp_path):
+    data = tmp_path / 'data.json'
+    data.write_text('1')
+    cache = RenderCache(watch_paths=[tmp_path], check_interval=0)
+    generation = cache.generation()
+    cache.put('a', 'A')
+    assert cache.get('a') == 'A'
+
+    data.write_text('22')
+    assert cache.get('a') is None
+    assert cache.generation() == generation + 1
+    assert cache.stats()['invalidations'] == 1
+    # Rendered before the change: not cached
+    cache.put('a', 'stale', generation)
+    assert cache.get('a') is None
+
+
+def test_concurrent_misses_share_one_render():
+    cache = RenderCache()
+    started, release, renders = threading.Event(), threading.Event(), []
+
+    def render(key):
+        renders.append(key)
+        started.set()
+        release.wait(5)
+        return 'document'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_render('a', render))) for _ in range(4)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while cache.stats()['shared'] < 3:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert renders == ['a']
+    assert results == ['document'] * 4
+    assert cache.get('a') == 'document'
+
+
+def test_render_nobody_waits_for_is_cancelled():
+    cache = RenderCache()
+    submitted = []
+
+    def submit(key):
+        submitted.append(Future())
+        return submitted[-1]
+
+    first = cache.render_future('a', submit)
+    second = cache.render_future('a', submit)
+    assert first is second and len(submitted) == 1
+    cache.release('a', first)
+    assert not first.cancelled()
+    cache.release('a', second)
+    assert first.cancelled()
+    assert cache.stats()['cancellations'] == 1
+    # The next request submits a new render
+    cache.render_future('a', submit)
+    assert len(submitted) == 2
+
+
+def test_warm_needs_a_render_function():
+    with pytest.raises(ValueError):
+        RenderCache().warm(['a'])
+
+
+def test_warm_renders_the_missing_keys_only():
+    cache = RenderCache()
+    cache.put('a', 'A')
+    rendered = []
+    cache.warm(['a', 'b'], lambda key: rendered.append(key) or key.upper())
+    assert rendered == ['b']
+    assert cache.get('b') == 'B'
@@ -0,0 +1,37 @@
+import metrics
+import render_pool
+from map_renderer import period_keys
+from render_pool import RenderPool
+
+
+def test_pooled_render_records_its_stages():
+    pool = RenderPool(1)
+
+    @metrics.instrument('pooled_render')
+    def render(key):
+        return pool.submit(key).result()
+
+    try:
+        document = render(period_keys()[0])
+    finally:
+        pool.shutdown()
+    text = metrics.render_metrics()
+    assert '"excavationId"' in document
+    for name in ['select', 'layers', 'render']:
+        assert f'excavations_stage_seconds_count{{callback="pooled_render",stage="{name}"}} 1' in text
+    assert 'excavations_stage_payload_bytes_count{callback="pooled_render",stage="render"} 1' in text
+
+
+def test_fork_is_not_used_on_macos(monkeypatch):
+    monkeypatch.setattr(render_pool.sys, 'platform', 'darwin')
+    assert not render_pool.fork_available()
+
+
+def test_shutdown_without_cancel_futures(monkeypatch):
+    pool = RenderPool(1)
+    monkeypatch.setattr(render_pool.sys, 'version_info', (3, 8, 18))
+    calls = []
+    shutdown = pool._executor.shutdown
+    monkeypatch.setattr(pool._executor, 'shutdown', lambda **kwargs: calls.append(kwargs) or shutdown(wait=True))
+    pool.shutdown()
+    assert calls == [{'wait': False}]
@@ -0,0 +1,29 @@
+from flask import Flask
+from search_index import SearchIndex, register_search_route
+
+
+def temple(feature_id, from_id, until_id):
+    geometry = {'type': 'Point', 'coordinates': [22.37 + feature_id / 1000, 38.52]}
+    properties = {'id': feature_id, 'category': 'Ναός', 'thesi': 'Άμφισσα', 'xronologia': '',
+                  'description': 'Ναός', 'from_id': from_id, 'until_id': until_id}
+    return geometry, properties
+
+
+def search_index():
+    geometry, properties = zip(temple(1, 1, 4), temple(2, 3, 6), temple(3, 5, 9))
+    return SearchIndex(list(geometry), list(properties))
+
+
+def test_half_open_ranges():
+    index = search_index()
+    assert index.ids(index.search('ναος', 3, None)) == [2, 3]
+    assert index.ids(index.search('ναος', None, 6)) == [1, 2]
+    assert index.ids(index.search('ναος', 5, None, 'overlap')) == [2, 3]
+
+
+def test_search_route_from_without_until():
+    server = Flask(__name__)
+    register_search_route(server, search_index)
+    response = server.test_client().get('/api/search?q=ναος&from=3')
+    assert response.status_code == 200
+    assert response.get_json()['ids'] == [2, 3]
@@ -0,0 +1,39 @@
+import threading
+import time
+import pytest
+
+vector_tiles = pytest.importorskip('vector_tiles')
+
+
+class SlowTileServer(vector_tiles.TileServer):
+    # Counts the pyramid builds, and holds the build of the roads until released
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.builds = []
+        self.release = threading.Event()
+
+    def build_pyramid(self, source, tiles):
+        self.builds.append(source.name)
+        if source.name == 'amfissa_roads':
+            assert self.release.wait(10)
+        super().build_pyramid(source, tiles)
+
+
+def test_layer_build_blocks_only_its_layer(tmp_path):
+    server = SlowTileServer({'amfissa_roads': './data/amfissa_roads.geojson',
+                             'ancient_wall': './data/ancient_wall.geojson'},
+                            cache_dir=str(tmp_path), min_zoom=13, max_zoom=13)
+    threads = [threading.Thread(target=server.layer, args=('amfissa_roads',)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    while 'amfissa_roads' not in server.builds:
+        time.sleep(0.01)
+    # Served while the roads are still building
+    source, _ = server.layer('ancient_wall')
+    assert source.name == 'ancient_wall'
+    assert any(thread.is_alive() for thread in threads)
+    server.release.set()
+    for thread in threads:
+        thread.join(10)
+    assert server.builds.count('amfissa_roads') == 1
+    assert server.layer('amfissa_roads')[0].name == 'amfissa_roads'
@@ -0,0 +1,292 @@
+'''
+The following script serves the infrastructure layers of the webmap (roads, buildings,
+ancient wall and fortress) as Mapbox Vector Tiles. Every layer is cut into a tile
+pyramid that is precomputed into an MBTiles (SQLite) file, and the tiles are served
+on demand from a Flask route, so the map document no longer embeds the geometries.
+'''
+
+import gzip
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+import fiona
+import mapbox_vector_tile
+from flask import abort, request
+from shapely.geometry import box, shape
+from shapely.ops import transform
+from shapely.strtree import STRtree
+
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+EARTH_HALF_CIRCUMFERENCE = 20037508.342789244
+MIN_ZOOM, MAX_ZOOM = 13, 20
+
+# Infrastructure layers served as vector tiles, by layer name
+TILE_SOURCES = {
+    'amfissa_roads': './data/amfissa_roads.geojson',
+    'amfissa_buildings': './data/amfissa_buildings.geojson',
+    'ancient_wall': './data/ancient_wall.geojson',
+    'ancient_fortess': './data/ancient_fortess.geojson',
+}
+
+
+def lonlat_to_mercator(lon, lat):
+    x = lon * EARTH_HALF_CIRCUMFERENCE / 180
+    y = math.log(math.tan((90 + lat) * math.pi / 360)) * EARTH_HALF_CIRCUMFERENCE / math.pi
+    return x, y
+
+
+def tile_bounds(z, x, y):
+    '''
+    Returns the web-mercator bounds (minx, miny, maxx, maxy) of an XYZ tile.
+    '''
+    size = 2 * EARTH_HALF_CIRCUMFERENCE / 2 ** z
+    minx = -EARTH_HALF_CIRCUMFERENCE + x * size
+    maxy = EARTH_HALF_CIRCUMFERENCE - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def tile_range(bounds, z):
+    '''
+    Returns the (min_x, min_y, max_x, max_y) XYZ tile indices covering mercator bounds at zoom z.
+    '''
+    size = 2 * EARTH_HALF_CIRCUMFERENCE / 2 ** z
+    n = 2 ** z - 1
+    min_x = int((bounds[0] + EARTH_HALF_CIRCUMFERENCE) // size)
+    max_x = int((bounds[2] + EARTH_HALF_CIRCUMFERENCE) // size)
+    min_y = int((EARTH_HALF_CIRCUMFERENCE - bounds[3]) // size)
+    max_y = int((EARTH_HALF_CIRCUMFERENCE - bounds[1]) // size)
+    return max(min_x, 0), max(min_y, 0), min(max_x, n), min(max_y, n)
+
+
+def source_fingerprint(name, path):
+    stat = os.stat(path)
+    return f'{name}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+class TileSource:
+    '''
+    A vector file (GeoJSON or GeoPackage) projected to web-mercator and split into
+    single parts that are indexed with an STR-tree for fast tile clipping.
+
+    Parameters:
+    - name (str): Name of the layer inside the tiles.
+    - path (str): Path to the vector file.
+    '''
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.parts, self.feature_ids = [], []
+        with fiona.open(path, 'r') as src:
+            for i, feature in enumerate(src):
+                geometry = transform(lonlat_to_mercator, shape(feature['geometry']))
+                for part in getattr(geometry, 'geoms', [geometry]):
+                    self.parts.append(part)
+                    self.feature_ids.append(i)
+        self.tree = STRtree(self.parts)
+        minx, miny, maxx, maxy = zip(*(part.bounds for part in self.parts))
+        self.bounds = (min(minx), min(miny), max(maxx), max(maxy))
+        self.fingerprint = source_fingerprint(name, path)
+
+    def render(self, z, x, y):
+        '''
+        Encodes the tile z/x/y of the layer. Returns None if no geometry falls in it.
+        '''
+        bounds = tile_bounds(z, x, y)
+        pixel = (bounds[2] - bounds[0]) / TILE_EXTENT
+        clip = box(*bounds).buffer(TILE_BUFFER * pixel, join_style=2)
+        features = []
+        for index in self.tree.query(clip):
+            part = self.parts[index].simplify(pixel, preserve_topology=True).intersection(clip)
+            if part.is_empty:
+                continue
+            features.append({'geometry': part, 'properties': {'i': self.feature_ids[index]}})
+        if not features:
+            return None
+        return mapbox_vector_tile.encode(
+            {'name': self.name, 'features': features},
+            default_options={'quantize_bounds': bounds, 'extents': TILE_EXTENT},
+        )
+
+
+class MBTiles:
+    '''
+    Minimal MBTiles (SQLite) tile store. Tiles are stored gzip-compressed, with the
+    TMS row numbering of the specification.
+
+    Parameters:
+    - path (str): Path of the .mbtiles file.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+            connection.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, '
+                               'tile_row INTEGER, tile_data BLOB, PRIMARY KEY (zoom_level, tile_column, tile_row))')
+
+    def _connect(self):
+        # sqlite3 connections cannot be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path)
+        return connection
+
+    def get_metadata(self, name):
+        row = self._connect().execute('SELECT value FROM metadata WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_metadata(self, values):
+        with self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)', list(values.items()))
+
+    def get(self, z, x, y):
+        row = self._connect().execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+            (z, x, 2 ** z - 1 - y)).fetchone()
+        return row[0] if row else None
+
+    def put_many(self, tiles):
+        '''
+        Stores (z, x, y, data) tuples, data being the uncompressed tile.
+        '''
+        with self._connect() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+                ((z, x, 2 ** z - 1 - y, gzip.compress(data)) for z, x, y, data in tiles))
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM tiles')
+
+
+class TileServer:
+    '''
+    Serves the tiles of several layers, each from its own MBTiles cache. A cache is
+    (re)built when its source file changed; tiles outside the precomputed zoom range
+    are rendered on demand and added to the cache.
+
+    Parameters:
+    - sources (dict): Path of the vector file of each layer name.
+    - cache_dir (str): Directory of the MBTiles files.
+    - min_zoom (int): Lowest zoom level of the precomputed pyramid.
+    - max_zoom (int): Highest zoom level of the precomputed pyramid.
+    '''
+
+    def __init__(self, sources, cache_dir='./cache/tiles', min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+        self.sources = dict(sources)
+        self.cache_dir = cache_dir
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self._layers = {}
+        # Future of the layers being loaded (or built), by name
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def layer(self, name):
+        '''
+        Returns the (TileSource, MBTiles) pair of a layer, building its pyramid if needed.
+        A layer is loaded once at a time, outside of the lock: the requests for it wait for
+        the load in progress, and the requests for the other layers are not blocked.
+        '''
+        fingerprint = source_fingerprint(name, self.sources[name])
+        with self._lock:
+            source, tiles = self._layers.get(name, (None, None))
+            if source is not None and source.fingerprint == fingerprint:
+                return source, tiles
+            future = self._loading.get(name)
+            loading = future is None
+            if loading:
+                future = self._loading[name] = Future()
+        if not loading:
+            return future.result()
+        try:
+            source = TileSource(name, self.sources[name])
+            tiles = MBTiles(os.path.join(self.cache_dir, f'{name}.mbtiles'))
+            if tiles.get_metadata('source') != source.fingerprint:
+                self.build_pyramid(source, tiles)
+            with self._lock:
+                self._layers[name] = (source, tiles)
+            future.set_result((source, tiles))
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self._lock:
+                del self._loading[name]
+        return source, tiles
+
+    def build_pyramid(self, source, tiles):
+        '''
+        Renders every non-empty tile of a layer between min_zoom and max_zoom into its cache.
+        '''
+        tiles.clear()
+        count = 0
+        for z in range(self.min_zoom, self.max_zoom + 1):
+            min_x, min_y, max_x, max_y = tile_range(source.bounds, z)
+            rendered = []
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    data = source.render(z, x, y)
+                    if data is not None:
+                        rendered.append((z, x, y, data))
+            tiles.put_many(rendered)
+            count += len(rendered)
+        tiles.set_metadata({
+            'name': source.name, 'format': 'pbf', 'source': source.fingerprint,
+            'minzoom': str(self.min_zoom), 'maxzoom': str(self.max_zoom),
+            'json': '{"vector_layers": [{"id": "%s", "fields": {"i": "Number"}}]}' % source.name,
+        })
+        print(f'Built {count} tiles for layer {source.name}')
+
+    def build_all(self):
+        for name in self.sources:
+            self.layer(name)
+
+    def get(self, name, z, x, y):
+        '''
+        Returns the gzip-compressed tile of a layer, or None if the tile is empty.
+        '''
+        source, tiles = self.layer(name)
+        data = tiles.get(z, x, y)
+        if data is not None or self.min_zoom <= z <= self.max_zoom:
+            return data
+        rendered = source.render(z, x, y)
+        if rendered is None:
+            return None
+        tiles.put_many([(z, x, y, rendered)])
+        return tiles.get(z, x, y)
+
+
+def register_tile_route(server, tile_server, url_prefix='/tiles', max_age=86400):
+    '''
+    Serves the tiles of a TileServer from url_prefix/<layer>/<z>/<x>/<y>.pbf on a Flask server.
+
+    Parameters:
+    - server (flask.Flask): The Flask server of the Dash app.
+    - tile_server (TileServer): The tile server.
+    - url_prefix (str): URL under which the tiles are served.
+    - max_age (int): Seconds a browser may reuse a tile without revalidating it.
+    '''
+
+    def tile(layer, z, x, y):
+        if layer not in tile_server.sources:
+            abort(404)
+        data = tile_server.get(layer, z, x, y)
+        if data is None:
+            return server.response_class(status=204)
+        response = server.response_class(data, mimetype='application/vnd.mapbox-vector-tile')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(hashlib.sha1(data).hexdigest())
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        return response.make_conditional(request)
+
+    server.add_url_rule(url_prefix + '/<layer>/<int:z>/<int:x>/<int:y>.pbf', 'vector_tile', tile)
@@ -9,12 +9,50 @@ email: antkoutrou@protonmail.com
 
 import folium
 import fiona
+import functools
+import hashlib
+import jinja2
 from folium.plugins import Fullscreen, FastMarkerCluster, MeasureControl
 import json
+import os
 from pathlib import Path 
-import base64
-
-def create_popup_content(category, description, xronologia, apo, mexri, evrimata, bibliografia, thesi, arxaiologos, id, img_files):
+from map_elements import ExcavationMarkers, LazyPopups, SearchHighlight, ServerClusters, VectorTileLayer
+from photo_assets import encode_image, photo_index, thumbnail_html
+from geometry_utils import coordinate_precision, degrees_per_pixel, quantize_geometry, simplify_geometry
+from metrics import StageTimer
+
+# Popup of an excavation, compiled once. The fields are inserted as HTML, like the data expects
+POPUP_TEMPLATE = jinja2.Environment(autoescape=False).from_string("""
+                            <div style="text-align: center;"><h3><b>{{ category }}</b></h3></div>
+                            <div style="text-align: right;">{{ xronologia }}, </div>
+                            <div style="text-align: right;">{{ apo }} - {{ mexri }}</div><br>
+                            <div style="text-align: center;"><u>Περιγραφή</u></div>
+                            {{ description }}<br><br>
+                    {% for image in images %}{{ image }}{% endfor %}
+{%- if evrimata is not none and evrimata != '-' and evrimata != '' %}
+                                        <div style="text-align: center;"><u>Ευρήματα</u></div>
+                                        {{ evrimata }}<br><br>
+{%- endif %}
+                                    <div style="text-align: center;">Αρχαιολόγος: <b>{{ arxaiologos }}</b></div><br><br>
+                                    <div style="text-align: right;"><small>&#x1F4CD; {{ thesi }}</small></div>
+                                    <div style="text-align: right;"><small>&#x1F4D6; {{ bibliografia }}</small></div>
+                                    """)
+
+def image_html(file_path, photo_manifest=None):
+    '''
+    Returns the popup HTML of a photo: its served thumbnail if the manifest has one,
+    otherwise the photo inlined in base64.
+    '''
+    entry = photo_manifest['photos'].get(Path(file_path).name) if photo_manifest else None
+    if entry is not None:
+        return thumbnail_html(entry)
+    # Encode the image data in base64
+    encoded_image = encode_image(file_path)
+    return f"""<div style="text-align: center;">
+            <img src="data:image/jpeg;base64,{encoded_image}" alt="Image" width="350px"><br><br>
+        </div>"""
+
+def create_popup_content(category, description, xronologia, apo, mexri, evrimata, bibliografia, thesi, arxaiologos, id, img_files, photo_manifest=None):
     '''
     Generates HTML content for a popup window with archaeological information.
 
@@ -29,84 +67,208 @@ def create_popup_content(category, description, xronologia, apo, mexri, evrimata
     - thesi (str): The geographical location of the find.
     - arxaiologos (str): The archaeologist associated with the find.
     - id (str): The unique identifier of the find.
-    - img_files (list): A list of file paths to images associated with the find.
+    - img_files (list): The file paths of the images of the find, in display order
+      (see photo_assets.PhotoIndex).
+    - photo_manifest (dict): Thumbnail manifest of photo_assets.build_thumbnails. Images found
+      in it are referenced by URL, the rest are inlined in base64.
     '''
-    popup_content = f"""
-                            <div style="text-align: center;"><h3><b>{category}</b></h3></div>
-                            <div style="text-align: right;">{xronologia}, </div>
-                            <div style="text-align: right;">{apo} - {mexri}</div><br>
-                            <div style="text-align: center;"><u>Περιγραφή</u></div>
-                            {description}<br><br>    
-                    """
-    for file_path in img_files:
-        path = Path(file_path)
-        if path.stem == id:
-            selected_file = file_path
-            with open(selected_file, 'rb') as image_file:
-                image_data = image_file.read()
-            # Encode the image data in base64
-            encoded_image = base64.b64encode(image_data).decode('utf-8')
-            
-            popup_content = popup_content + f"""<div style="text-align: center;">
-                <img src="data:image/jpeg;base64,{encoded_image}" alt="Image" width="350px"><br><br>
-            </div>""" 
-
-    if evrimata is not None and evrimata != '-' and evrimata != "":
-        popup_content = popup_content + f"""
-                                        <div style="text-align: center;"><u>Ευρήματα</u></div>
-                                        {evrimata}<br><br>
-                                        """
-        
-    popup_content = popup_content + f"""
-                                    <div style="text-align: center;">Αρχαιολόγος: <b>{arxaiologos}</b></div><br><br> 
-                                    <div style="text-align: right;"><small>&#x1F4CD; {thesi}</small></div>
-                                    <div style="text-align: right;"><small>&#x1F4D6; {bibliografia}</small></div>
-                                    """
-    
-    return popup_content
+    return POPUP_TEMPLATE.render(
+        category=category, description=description, xronologia=xronologia, apo=apo, mexri=mexri,
+        evrimata=evrimata, bibliografia=bibliografia, thesi=thesi, arxaiologos=arxaiologos, id=id,
+        images=[image_html(file_path, photo_manifest) for file_path in img_files],
+    )
+
+def feature_popup(property, photos, photo_manifest=None):
+    '''
+    Generates the popup content of an excavation feature from its properties.
+
+    Parameters:
+    - property (dict): The properties of the excavation feature.
+    - photos (photo_assets.PhotoIndex): Index of the photos by feature id.
+    - photo_manifest (dict): Thumbnail manifest of photo_assets.build_thumbnails.
+    '''
+    return create_popup_content(
+        property['category'], property['description'], property['xronologia'],
+        property['from'], property['until'], property['evrimata'], property['bibliografia'],
+        property['thesi'], property['arxaiologos'], str(property['id']),
+        photos.photos(property['id']), photo_manifest
+    )
+
+# Rendered popups by feature id, with the content digest they were rendered from. Cleared
+# (clear_popups) when the excavations file changes, so that deleted features do not stay
+_popups = {}
+
+def clear_popups():
+    '''
+    Drops every rendered popup.
+    '''
+    _popups.clear()
+
+def _popup_digest(property, files, thumbnails):
+    content = json.dumps([property, files, thumbnails], sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def feature_popups(properties, photos, photo_manifest=None):
+    '''
+    Returns the popup content of every feature, in one pass. A popup is only rendered
+    again when the properties of its feature or its photos changed; otherwise the
+    cached fragment is reused.
 
-def input_vector(geojson_path, desname, feature_group, colorn):
+    Parameters:
+    - properties (list): The properties of the excavation features.
+    - photos (photo_assets.PhotoIndex): Index of the photos by feature id.
+    - photo_manifest (dict): Thumbnail manifest of photo_assets.build_thumbnails.
+    '''
+    manifest_photos = photo_manifest['photos'] if photo_manifest else {}
+    popups = []
+    for property in properties:
+        files = photos.photos(property['id'])
+        # Thumbnail names are content-hashed, so they change with the photos
+        thumbnails = [manifest_photos.get(os.path.basename(file), {}).get('jpeg') for file in files]
+        key = _popup_digest(property, [str(file) for file in files], thumbnails)
+        cached = _popups.get(property['id'])
+        if cached is None or cached[0] != key:
+            cached = _popups[property['id']] = (key, feature_popup(property, photos, photo_manifest))
+        popups.append(cached[1])
+    return popups
+
+# Zoom level up to which the basemaps have native tiles; vector layers are quantized for it
+VECTOR_MAX_ZOOM = 20
+
+_vector_layers = {}
+
+def load_vector_layer(geojson_path, desname, decimals, simplify_tolerance=None):
+    '''
+    Reads a vector file into a single FeatureCollection with quantized (and optionally
+    simplified) coordinates, where each feature carries only its popup HTML. The result
+    is memoized until the file changes.
+
+    Parameters:
+        geojson_path: str. Path to geojson file
+        desname: str. Name to be displayed on the map
+        decimals: int. Number of coordinate decimals kept
+        simplify_tolerance: float. Simplification tolerance in degrees, or None
+
+    Returns the collection and a dictionary with its size before and after (in bytes).
+    '''
+    mtime = Path(geojson_path).stat().st_mtime_ns
+    key = (geojson_path, desname, decimals, simplify_tolerance)
+    cached = _vector_layers.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1], cached[2]
+
+    raw_features, features = [], []
+    with fiona.open(geojson_path, 'r') as file:
+        for feature in file:
+            geometry = {'type': feature['geometry']['type'], 'coordinates': feature['geometry']['coordinates']}
+            properties = dict(feature['properties'])
+            raw_features.append({'type': 'Feature', 'geometry': geometry, 'properties': properties})
+
+            if simplify_tolerance:
+                geometry = simplify_geometry(geometry, simplify_tolerance)
+            geometry = quantize_geometry(geometry, decimals)
+            popup_style = 'font-size: 15px;'  # Adjust the font size as needed
+            popup_content = f'<div style="{popup_style}"><b>{desname}</b>: {properties["description"]}</div>'
+            if properties.get('bibliography'):
+                popup_content = popup_content + f'<br><br><div style="text-align: right;"><small>&#x1F4D6; {properties["bibliography"]}</small></div>'
+            features.append({'type': 'Feature', 'geometry': geometry, 'properties': {'popup': popup_content}})
+
+    collection = {'type': 'FeatureCollection', 'features': features}
+    report = {
+        'features': len(features),
+        'raw_bytes': len(json.dumps({'type': 'FeatureCollection', 'features': raw_features}).encode('utf-8')),
+        'bytes': len(json.dumps(collection).encode('utf-8')),
+    }
+    report['saved_bytes'] = report['raw_bytes'] - report['bytes']
+    _vector_layers[key] = (mtime, collection, report)
+    return collection, report
+
+def input_vector(geojson_path, desname, feature_group, colorn, max_zoom=VECTOR_MAX_ZOOM, simplify=False, report=None):
     '''
     This function takes a geojson path and inputs it in an existing 
-    previously generated map
+    previously generated map, as a single layer with a shared style
 
     Parameters:
         geojson_path: str. Path to geojson file
         desname: str. Name to be displayed on the map
         feature_group: folium.featuregroup. Feature group that belongs
         colorn: str. Color to use for visualization
+        max_zoom: int. Highest zoom level the coordinates must stay accurate (to one pixel) for
+        simplify: bool. Whether to simplify the geometries by up to one pixel at max_zoom
+            (topology-preserving, requires shapely)
+        report: dict. If given, the layer size report is stored in it under desname
     '''
+    decimals = coordinate_precision(max_zoom)
+    tolerance = degrees_per_pixel(max_zoom) if simplify else None
+    collection, layer_report = load_vector_layer(geojson_path, desname, decimals, tolerance)
+    if report is not None:
+        report[desname] = layer_report
+
+    element = folium.GeoJson(collection, name=desname,
+                             style_function=lambda x: {"fillColor": colorn, "color": "lightgray"},
+                             popup=folium.GeoJsonPopup(fields=['popup'], labels=False, min_width=500, max_width=600),
+                             overlay=True, control=True, show=False)
+    element.add_to(feature_group)
 
-    with fiona.open(geojson_path, 'r') as file:
-        features = list(file)
+    return element
 
-    name = geojson_path.split('/')[-1].split('.')[0].split('_')[-1]
 
-    for feature in features:
-        geometry = feature['geometry']
-        properties = feature['properties']
+def input_vector_tiles(geojson_path, desname, feature_group, colorn, url_prefix='/tiles'):
+    '''
+    This function adds a vector file to an existing map as a layer of vector tiles
+    served from url_prefix (see vector_tiles.register_tile_route). The tile layer is
+    named after the file, as in vector_tiles.TILE_SOURCES
 
-        element = folium.GeoJson(geometry, name=desname, style_function=lambda x: {"fillColor": colorn, "color": "lightgray"}, overlay=True, control=True, show=False)
-        popup_style = 'font-size: 15px;'  # Adjust the font size as needed
-        popup_content = f'<div style="{popup_style}"><b>{desname}</b>: {properties["description"]}</div>'
-        if 'bibliography' in properties:
-            popup_content = popup_content + f'<br><br><div style="text-align: right;"><small>&#x1F4D6; {properties["bibliography"]}</small></div>'
-        popup = folium.Popup(popup_content, min_width=500, max_width=600)
-        element.add_child(popup)
-        element.add_to(feature_group)
+    Parameters:
+        geojson_path: str. Path to geojson file
+        desname: str. Name to be displayed on the map
+        feature_group: folium.featuregroup. Feature group that belongs
+        colorn: str. Color to use for visualization
+        url_prefix: str. URL under which the tiles are served
+    '''
+    layer_name = Path(geojson_path).stem
+    collection, _ = load_vector_layer(geojson_path, desname, coordinate_precision(VECTOR_MAX_ZOOM))
+    element = VectorTileLayer(
+        url_prefix + '/' + layer_name + '/{z}/{x}/{y}.pbf', layer_name,
+        style={'fill': True, 'fillColor': colorn, 'fillOpacity': 0.2, 'color': 'lightgray', 'weight': 3},
+        popups=[feature['properties']['popup'] for feature in collection['features']],
+        name=desname, max_native_zoom=VECTOR_MAX_ZOOM, show=False,
+    )
+    element.add_to(feature_group)
 
     return element
 
 
-def default_map(landmarks:True, properties, geometry, category_colors, category_icons):
+def default_map(landmarks:True, properties, geometry, category_colors, category_icons, client_filter=False, photo_manifest=None, lazy_popups=False, vector_tiles=False, cluster_url=None, outpath=None, report=None):
     '''
     This function creates an empty folium map, with specific parameters
     in order to display the landmarks.
 
     Parameters
         landmarks: bool. Whether to load landmarks or not.
+        client_filter: bool. Whether to ship the landmarks as one GeoJSON payload that is
+            filtered in the browser (see map_elements.ExcavationMarkers) instead of
+            rendering only the given subset as folium markers.
+        photo_manifest: dict. Thumbnail manifest of photo_assets.build_thumbnails; when given,
+            the popups reference the served thumbnails instead of inlining the photos.
+        lazy_popups: bool. Whether the markers only carry the feature id and fetch their popup
+            on click from the /popup route (see popup_store) instead of embedding it.
+        vector_tiles: bool. Whether the infrastructure layers are loaded as vector tiles from
+            the /tiles route (see vector_tiles) instead of being embedded as GeoJSON.
+        cluster_url: str. If given, the landmarks are not embedded: the clusters and landmarks
+            of the viewport are fetched from this URL of the /clusters route (see clustering),
+            and their popups from the /popup route.
+        outpath: str. If given, the map is also saved to this path.
+        report: dict. If given, the size report of every embedded infrastructure layer is
+            stored in it by layer name (see load_vector_layer). The emitted size of the
+            layers is also recorded as the payload of the 'layers' stage (see metrics).
+
+    Returns the HTML document of the map.
     '''
 
+    # Per-stage timings of the render (see metrics)
+    stages = StageTimer()
+
     ''' 1. Set up a map '''
     map = folium.Map(location=(38.527, 22.378), tiles=None, 
                 width = '100%', height='100%', 
@@ -137,24 +299,32 @@ def default_map(landmarks:True, properties, geometry, category_colors, category_
     tile4 = folium.TileLayer('cartodb positron', name="Cartodb")
     tile4.add_to(feature_group1)
     feature_group1.add_to(map)
+    stages.lap('basemaps')
 
     # Add the infrastructure to basemap
     feature_group2 = folium.map.FeatureGroup(name='Υποδομή', show = True)
+    # Size of the embedded layers after quantization (see load_vector_layer)
+    layer_report = {}
+    if vector_tiles:
+        add_layer = input_vector_tiles
+    else:
+        add_layer = functools.partial(input_vector, report=layer_report)
     # Add roads of amfissa
-    roads = input_vector("./data/amfissa_roads.geojson", "Οδικό Δίκτυο", feature_group2, "darkblue")
+    roads = add_layer("./data/amfissa_roads.geojson", "Οδικό Δίκτυο", feature_group2, "darkblue")
     # Add the buildings polygons
-    buildings = input_vector("./data/amfissa_buildings.geojson", "Αστικό Δίκτυο", feature_group2, "darkorange")
+    buildings = add_layer("./data/amfissa_buildings.geojson", "Αστικό Δίκτυο", feature_group2, "darkorange")
     # Add the ancient wall
-    wall = input_vector("./data/ancient_wall.geojson", "Αρχαία Οχύρωση", feature_group2, "darkred")
+    wall = add_layer("./data/ancient_wall.geojson", "Αρχαία Οχύρωση", feature_group2, "darkred")
     # Add the ancient fortess
-    fortess = input_vector("./data/ancient_fortess.geojson", "Αρχαίο Κάστρο", feature_group2, "darkgreen")
+    fortess = add_layer("./data/ancient_fortess.geojson", "Αρχαίο Κάστρο", feature_group2, "darkgreen")
     # Place Feature Group to map
     feature_group2.add_to(map)
+    stages.lap('layers', sum(report['bytes'] for report in layer_report.values()) if layer_report else None)
+    if report is not None:
+        report.update(layer_report)
 
-    # Load images directory
-    img_dir = Path.cwd() / "photos"
-    # Filter the files in the directory by extension
-    img_files = [str(file) for file in img_dir.iterdir() if file.suffix.lower() in ['.jpg', '.jpeg']]
+    # Load the photo index (photos by feature id) of the images directory
+    photos = photo_index(Path.cwd() / "photos")
     
     '''4. Add the desired NON-FIXED feature groups'''
     if landmarks:
@@ -175,49 +345,76 @@ def default_map(landmarks:True, properties, geometry, category_colors, category_
         for _, value in folium_groups.items():
             ls.append(value)
 
-        # Create a MarkerCluster layer
-        # Create a MarkerCluster for each category
-        category_clusters = {}
-
-        for m, property in enumerate(properties):
-            category = property['category']
-            description, xronologia, apo, mexri, evrimata, arxaiologos = (
-                property['description'],
-                property['xronologia'],
-                property['from'],
-                property['until'],
-                property['evrimata'],
-                property['arxaiologos'],
-            )
-            bibliografia, thesi, id = property['bibliografia'], property['thesi'], str(property['id'])
-            color = category_colors.get(category, 'gray')
-            icon = category_icons.get(category, 'info-sign')
-            # Define what to be displayed in the popup window
-            popup_content = create_popup_content(
-                category, description, xronologia, apo, mexri, evrimata, bibliografia, thesi, arxaiologos, id, img_files
-            )
-            iframe = folium.IFrame(popup_content)
-            popupwin = folium.Popup(iframe, min_width=500, max_width=600)
-            marker = folium.Marker(
-                location=[geometry[m]['coordinates'][1], geometry[m]['coordinates'][0]],
-                name=category,
-                popup=popupwin,
-                icon=folium.Icon(color=color, icon='location-pin', prefix='fa-solid')
-            )
-
-            # Check if a FastMarkerCluster for the category already exists, otherwise create a new one
-            if category in category_clusters:
-                marker_cluster = category_clusters[category]
-            else:
-                marker_cluster = FastMarkerCluster([], options={'spiderfyOnMaxZoom': True, 'showCoverageOnHover': False, 'zoomToBoundsOnClick': True}, name=category)
-                category_clusters[category] = marker_cluster
-
-            # Add the marker to the corresponding category FastMarkerCluster
-            marker_cluster.add_child(marker)
-
-        # Add the FastMarkerClusters to the category_layers
-        for category, marker_cluster in category_clusters.items():
-            marker_cluster.add_to(category_layers[category])
+        cluster_options = {'spiderfyOnMaxZoom': True, 'showCoverageOnHover': False, 'zoomToBoundsOnClick': True}
+        # Popups of every landmark, rendered in one pass (reusing the unchanged ones)
+        popups = None if lazy_popups or cluster_url else feature_popups(properties, photos, photo_manifest)
+        stages.lap('popups')
+
+        if client_filter:
+            # Ship every landmark once; the time filter runs in the browser
+            features = []
+            for m, property in enumerate(properties):
+                category = property['category']
+                features.append({
+                    'type': 'Feature',
+                    'geometry': {'type': 'Point', 'coordinates': [round(c, 6) for c in geometry[m]['coordinates'][:2]]},
+                    'properties': {
+                        'id': str(property['id']),
+                        'category': category,
+                        'color': category_colors.get(category, 'gray'),
+                        'from_id': property['from_id'],
+                        'until_id': property['until_id'],
+                    },
+                })
+                if popups is not None:
+                    features[-1]['properties']['popup'] = popups[m]
+            ExcavationMarkers(features, category_layers, cluster_options).add_to(map)
+        elif cluster_url:
+            # Clustered on the server; the map only holds the markers of its viewport
+            ServerClusters(cluster_url, category_layers, category_colors).add_to(map)
+        else:
+            # Create a MarkerCluster layer
+            # Create a MarkerCluster for each category
+            category_clusters = {}
+
+            for m, property in enumerate(properties):
+                category = property['category']
+                color = category_colors.get(category, 'gray')
+                icon = category_icons.get(category, 'info-sign')
+                # Define what to be displayed in the popup window
+                popupwin = None
+                if popups is not None:
+                    popup_content = popups[m]
+                    # Rendered inline (not in a data-URI IFrame) so the thumbnail URLs resolve
+                    popupwin = folium.Popup(f'<div style="max-height: 300px; overflow-y: auto;">{popup_content}</div>',
+                                            min_width=500, max_width=600)
+                marker = folium.Marker(
+                    location=[geometry[m]['coordinates'][1], geometry[m]['coordinates'][0]],
+                    name=category,
+                    popup=popupwin,
+                    icon=folium.Icon(color=color, icon='location-pin', prefix='fa-solid'),
+                    excavation_id=str(property['id'])
+                )
+
+                # Check if a FastMarkerCluster for the category already exists, otherwise create a new one
+                if category in category_clusters:
+                    marker_cluster = category_clusters[category]
+                else:
+                    marker_cluster = FastMarkerCluster([], options=cluster_options, name=category)
+                    category_clusters[category] = marker_cluster
+
+                # Add the marker to the corresponding category FastMarkerCluster
+                marker_cluster.add_child(marker)
+
+            # Add the FastMarkerClusters to the category_layers
+            for category, marker_cluster in category_clusters.items():
+                marker_cluster.add_to(category_layers[category])
+
+        if lazy_popups or cluster_url:
+            LazyPopups().add_to(map)
+        # Highlights the results of the search box of the Dash page
+        SearchHighlight().add_to(map)
+        stages.lap('markers')
 
     '''5. Add everything to the webmap'''
     # Create lists of layer objects for each group
@@ -258,27 +455,32 @@ def default_map(landmarks:True, properties, geometry, category_colors, category_
     map.add_child(grouped_control1)
     map.add_child(grouped_control2)
     map.add_child(grouped_control3)
-    outpath = "./excavations_map.html"
-    map.save(outpath)
-
-    return outpath
-
-
-# Read the data for the webmap
-file_path = './data/excavation_ruins.geojson'
-geometry, properties = [], []
-with fiona.open(file_path) as src:
-    for feature in src:
-        # Process each feature as needed
-        geometry.append(feature['geometry'])
-        properties.append(feature['properties'])
-
-# Load the JSON file
-with open('./data/categories.json', 'r') as file:
-    data = json.load(file)
-
- # Access the dictionaries
-category_colors = data['category_colors']
-category_icons = data['category_icons']
-
-map = default_map(True, properties, geometry, category_colors, category_icons)
\ No newline at end of file
+    # Rendered in memory, so that concurrent renders never share a file
+    document = map.get_root().render()
+    stages.lap('render', len(document.encode('utf-8')))
+    if outpath is not None:
+        with open(outpath, 'w', encoding='utf-8') as file:
+            file.write(document)
+
+    return document
+
+
+if __name__ == '__main__':
+    # Read the data for the webmap
+    file_path = './data/excavation_ruins.geojson'
+    geometry, properties = [], []
+    with fiona.open(file_path) as src:
+        for feature in src:
+            # Process each feature as needed
+            geometry.append(feature['geometry'])
+            properties.append(feature['properties'])
+
+    # Load the JSON file
+    with open('./data/categories.json', 'r') as file:
+        data = json.load(file)
+
+    # Access the dictionaries
+    category_colors = data['category_colors']
+    category_icons = data['category_icons']
+
+    default_map(True, properties, geometry, category_colors, category_icons, outpath="./excavations_map.html")
@@ -0,0 +1,396 @@
+'''
+The following script implements the asyncio download core shared by all the download
+jobs of the app. One event loop, running in a background thread, downloads the files
+of every job with aiohttp:
+
+- the downloads of all the jobs share one bandwidth limit (a token bucket of
+  DOWNLOAD_RATE bytes per second), whose waiters are served in turn, chunk by chunk
+- the connections (DOWNLOAD_CONNECTIONS, at most PER_HOST_LIMIT per host) are handed
+  to the jobs in rotation, so a product of hundreds of files does not hold back a job
+  submitted after it
+- every job records its progress (files and bytes done, rate) and the events of its
+  files, to be polled by the Dash callbacks
+
+As in download_engine, files are written to .part files, resumed with HTTP Range
+requests guarded by If-Range, verified against their MD5 checksum when known and
+renamed once complete.
+'''
+
+import asyncio
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import deque
+import aiohttp
+from download_engine import (PART_SUFFIX, RETRIES, ChecksumError, discard_validator, file_md5, response_validator,
+                             resume_headers, save_validator)
+
+DOWNLOAD_CONNECTIONS = 16
+PER_HOST_LIMIT = 8
+# Bytes per second shared by all the downloads (None: unlimited)
+DOWNLOAD_RATE = None
+CHUNK_SIZE = 256 * 1024
+TIMEOUT = aiohttp.ClientTimeout(sock_connect=10, sock_read=60)
+# Events kept per job
+JOB_EVENTS = 100
+# Finished jobs kept for their progress to be read
+FINISHED_JOBS = 100
+# Next to the part of a file named by the server (and to the file once downloaded), the
+# name the server gave it
+NAME_SUFFIX = '.name'
+
+
+class TokenBucket:
+    '''
+    Bandwidth limiter: every byte consumes a token, and tokens are added at rate per
+    second up to capacity. Consumers wait in turn (first come, first served).
+
+    Parameters:
+    - rate (float): Tokens (bytes) added per second, or None for no limit.
+    - capacity (float): Maximum number of tokens saved up (default: one second of rate).
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity or 0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = min(self.tokens, self.capacity or 0)
+        self._updated = time.monotonic()
+
+    async def consume(self, amount):
+        '''
+        Waits until amount tokens are available and takes them.
+        '''
+        async with self._lock:
+            while amount > 0 and self.rate:
+                self._refill()
+                take = min(amount, self.capacity)
+                if self.tokens < take:
+                    await asyncio.sleep((take - self.tokens) / self.rate)
+                    self._refill()
+                self.tokens -= take
+                amount -= take
+
+
+class Job:
+    '''
+    Files downloaded together (e.g. a product), with their progress.
+
+    Parameters:
+    - name (str): Name of the job shown to the user.
+    '''
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.status = 'preparing'
+        self.error = None
+        self.files = []
+        self.pending = deque()
+        self.active = {}
+        self.tasks = set()
+        self.done = 0
+        self.skipped = 0
+        self.failed = []
+        self.bytes = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.finish = None
+        self.events = deque(maxlen=JOB_EVENTS)
+
+    def event(self, type, **fields):
+        self.events.append(dict(fields, type=type, time=time.time()))
+
+    def snapshot(self):
+        '''
+        Returns the progress of the job as a dictionary.
+        '''
+        elapsed = (self.finished or time.time()) - self.started if self.started else 0
+        return {
+            'id': self.id, 'name': self.name, 'status': self.status, 'error': self.error,
+            'files': len(self.files), 'done': self.done, 'skipped': self.skipped, 'failed': len(self.failed),
+            'bytes': self.bytes, 'rate': self.bytes / elapsed if elapsed else 0.0,
+            'active': [dict(file, path=os.path.basename(path)) for path, file in self.active.items()],
+            'events': list(self.events),
+        }
+
+
+class DownloadManager:
+    '''
+    Runs the download jobs on an event loop in a background thread. Its methods can be
+    called from any thread.
+
+    Parameters:
+    - connections (int): Files downloaded at the same time, across all the jobs.
+    - rate (float): Bytes per second shared by all the downloads, or None for no limit.
+    - per_host_limit (int): Maximum number of connections to one host.
+    - chunk_size (int): Size (in bytes) of the chunks read from the responses.
+    '''
+
+    def __init__(self, connections=DOWNLOAD_CONNECTIONS, rate=DOWNLOAD_RATE, per_host_limit=PER_HOST_LIMIT,
+                 chunk_size=CHUNK_SIZE):
+        self.connections = connections
+        self.per_host_limit = per_host_limit
+        self.chunk_size = chunk_size
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        threading.Thread(target=self._run, args=(rate,), daemon=True).start()
+        self._started.wait()
+
+    def _run(self, rate):
+        asyncio.set_event_loop(self._loop)
+        self._bucket = TokenBucket(rate)
+        self._wake = asyncio.Event()
+        # Jobs with files waiting for a connection, in the order they get the next one
+        self._rotation = deque()
+        self._loop.create_task(self._dispatch())
+        self._started.set()
+        self._loop.run_forever()
+
+    def submit(self, name, prepare, finish=None):
+        '''
+        Starts a job and returns its id.
+
+        Parameters:
+        - name (str): Name of the job shown to the user.
+        - prepare (callable): Function returning the files of the job, as a list of
+          dictionaries with url, path, and optionally md5 and headers. A path ending with
+          a separator is a directory, the file being named by the server. It runs in a
+          thread, and may block (e.g. to download a manifest or to log in).
+        - finish (callable): Function called (in a thread) once the job has ended.
+        '''
+        job = Job(name)
+        with self._lock:
+            self.jobs[job.id] = job
+            finished = [id for id, other in self.jobs.items() if other.finished]
+            for id in finished[:max(0, len(finished) - FINISHED_JOBS)]:
+                del self.jobs[id]
+        asyncio.run_coroutine_threadsafe(self._prepare(job, prepare, finish), self._loop)
+        return job.id
+
+    def progress(self, job_id):
+        '''
+        Returns the progress of a job (see Job.snapshot), or None if it is unknown.
+        '''
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        return asyncio.run_coroutine_threadsafe(self._snapshot(job), self._loop).result()
+
+    def cancel(self, job_id):
+        '''
+        Stops a job: its files waiting for a connection are dropped and its downloads are
+        cancelled, their parts kept to be resumed. Returns once no file of the job is being
+        written anymore, True if the job was running.
+        '''
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        return asyncio.run_coroutine_threadsafe(self._cancel(job), self._loop).result()
+
+    def set_rate(self, rate):
+        '''
+        Changes the bandwidth limit (bytes per second, None for no limit) of all the downloads.
+        '''
+        self._loop.call_soon_threadsafe(self._bucket.set_rate, rate)
+
+    async def _snapshot(self, job):
+        return job.snapshot()
+
+    async def _cancel(self, job):
+        if job.finished or job.status == 'cancelled':
+            return False
+        job.status, job.error = 'cancelled', 'cancelled'
+        job.pending.clear()
+        if job in self._rotation:
+            self._rotation.remove(job)
+        tasks = list(job.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        job.active.clear()
+        # A job still preparing is finished once its files are known (see _prepare)
+        if job.started:
+            await self._finish(job)
+        return True
+
+    async def _prepare(self, job, prepare, finish):
+        job.finish = finish
+        try:
+            job.files = list(await self._loop.run_in_executor(None, prepare))
+        except Exception as error:
+            job.status, job.error = 'failed', str(error)
+            job.event('job_failed', error=job.error)
+            await self._finish(job)
+            return
+        if job.status == 'cancelled':
+            await self._finish(job)
+            return
+        job.pending.extend(job.files)
+        job.status, job.started = 'downloading', time.time()
+        job.event('job_started', files=len(job.files))
+        if job.pending:
+            self._rotation.append(job)
+            self._wake.set()
+        else:
+            await self._finish(job)
+
+    async def _finish(self, job):
+        # Runs once, even if the last files of the job end at the same time
+        if job.finished:
+            return
+        job.finished = time.time()
+        if job.status not in ('failed', 'cancelled'):
+            job.status = 'failed' if job.failed else 'done'
+            job.error = f'{len(job.failed)} files failed' if job.failed else None
+        job.event('job_' + job.status, bytes=job.bytes, seconds=job.finished - (job.started or job.created))
+        if job.finish is not None:
+            try:
+                await self._loop.run_in_executor(None, job.finish)
+            except Exception as error:
+                print('Finishing job {n} failed: {e}'.format(n=job.name, e=error))
+
+    async def _dispatch(self):
+        # Hands every free connection to the next job of the rotation
+        connector = aiohttp.TCPConnector(limit=self.connections, limit_per_host=self.per_host_limit)
+        async with aiohttp.ClientSession(connector=connector, timeout=TIMEOUT) as session:
+            slots = asyncio.Semaphore(self.connections)
+            while True:
+                await slots.acquire()
+                while not self._rotation:
+                    self._wake.clear()
+                    await self._wake.wait()
+                job = self._rotation.popleft()
+                file = job.pending.popleft()
+                if job.pending:
+                    self._rotation.append(job)
+                # Active as soon as it leaves pending, so that the job is not seen as ended
+                # before its task runs
+                job.active[file['path']] = {'url': file['url'], 'bytes': 0}
+                task = self._loop.create_task(self._download(session, job, file))
+                job.tasks.add(task)
+                task.add_done_callback(lambda task, job=job: (job.tasks.discard(task), slots.release()))
+
+    async def _download(self, session, job, file):
+        path = file['path']
+        progress = job.active[path]
+        job.event('file_started', path=path)
+        try:
+            written = await self._fetch_file(session, file, progress, job)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ChecksumError) as error:
+            job.failed.append((file['url'], path, str(error)))
+            job.event('file_failed', path=path, error=str(error))
+        else:
+            job.done += 1
+            if written == 0:
+                job.skipped += 1
+            job.event('file_done', path=path, bytes=written)
+        finally:
+            del job.active[path]
+        if not job.pending and not job.active:
+            await self._finish(job)
+
+    async def _part_digest(self, part_path):
+        if not os.path.exists(part_path):
+            return hashlib.md5()
+
+        def digest():
+            result = hashlib.md5()
+            with open(part_path, 'rb') as part:
+                for chunk in iter(lambda: part.read(self.chunk_size), b''):
+                    result.update(chunk)
+            return result
+        return await self._loop.run_in_executor(None, digest)
+
+    async def _is_complete(self, session, file, path):
+        # Whether the file at path is whole, as download_engine.DownloadEngine._is_complete
+        md5 = file.get('md5')
+        if md5 is not None:
+            return await self._loop.run_in_executor(None, file_md5, path) == md5.lower()
+        async with session.head(file['url'], headers=file.get('headers') or {}, allow_redirects=True) as response:
+            if not response.ok:
+                return False
+            length = response.headers.get('Content-Length')
+            if length is None or response.headers.get('Content-Encoding'):
+                return True
+            return int(length) == os.path.getsize(path)
+
+    async def _fetch_file(self, session, file, progress, job):
+        # Downloads a file as download_engine.DownloadEngine.download; returns the bytes downloaded
+        url, path, md5 = file['url'], file['path'], file.get('md5')
+        directory, name = os.path.split(path)
+        # Files named by the server resume from a part named after their URL. The name given
+        # by the first response is kept next to it (a resumed response may not repeat it)
+        # and stays after the download, so that the file is found again without a request
+        stem = os.path.join(directory, '.' + hashlib.sha1(url.encode('utf-8')).hexdigest()[:16])
+        part_path = path + PART_SUFFIX if name else stem + PART_SUFFIX
+        server_named = not name
+        if server_named and os.path.exists(stem + NAME_SUFFIX):
+            with open(stem + NAME_SUFFIX, 'r', encoding='utf-8') as name_file:
+                name = name_file.read().strip()
+        final_path = os.path.join(directory, name) if name else None
+        # A server-named file is only ever renamed whole; a file at a given path may have
+        # been left truncated by an older downloader, and is checked
+        if final_path and os.path.exists(final_path) and (
+                (server_named and file.get('md5') is None) or await self._is_complete(session, file, final_path)):
+            return 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        written = 0
+        for attempt in range(2):
+            for retry in range(RETRIES + 1):
+                resume = resume_headers(part_path, md5)
+                digest = await self._part_digest(part_path)
+                headers = dict(file.get('headers') or {}, **resume)
+                try:
+                    async with session.get(url, headers=headers) as response:
+                        if (server_named and not name and response.content_disposition is not None
+                                and response.content_disposition.filename):
+                            name = os.path.basename(response.content_disposition.filename)
+                            with open(stem + NAME_SUFFIX, 'w', encoding='utf-8') as name_file:
+                                name_file.write(name)
+                        if resume and response.status == 416:
+                            break
+                        response.raise_for_status()
+                        mode = 'ab' if resume and response.status == 206 else 'wb'
+                        if mode == 'wb':
+                            digest = hashlib.md5()
+                            save_validator(part_path, response_validator(response.headers))
+                        with open(part_path, mode) as out_file:
+                            async for chunk in response.content.iter_chunked(self.chunk_size):
+                                await self._bucket.consume(len(chunk))
+                                out_file.write(chunk)
+                                digest.update(chunk)
+                                written += len(chunk)
+                                progress['bytes'] += len(chunk)
+                                job.bytes += len(chunk)
+                    break
+                except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if retry == RETRIES:
+                        raise
+            if md5 is None or digest.hexdigest() == md5.lower():
+                final_path = os.path.join(directory, name or os.path.basename(part_path)[1:-len(PART_SUFFIX)])
+                os.replace(part_path, final_path)
+                discard_validator(part_path)
+                return written
+            os.remove(part_path)
+            discard_validator(part_path)
+        raise ChecksumError(f'{url}: the MD5 checksum of the file is not {md5}')
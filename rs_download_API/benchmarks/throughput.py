@@ -0,0 +1,121 @@
+'''
+Throughput benchmark of the download engine. A local HTTP server stands in for the
+storage bucket: it answers every request after a fixed latency and sends each response
+at a capped rate, as a remote server does per connection. A product of many files is
+downloaded with the previous sequential downloader (a new connection per file, 10 KB
+chunks) and with the engine at every worker count, and the throughput of each is
+reported with the number of connections opened.
+
+Usage (from the rs_download_API directory):
+    python benchmarks/throughput.py --files 200 --size 262144 --latency 0.05 --workers 1 2 4 8 16
+'''
+
+import argparse
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from download_engine import CHUNK_SIZE, DownloadEngine  # noqa: E402
+
+
+class ProductServer(ThreadingHTTPServer):
+    '''
+    HTTP server of files of a fixed size, with a latency per request and a rate cap per
+    connection, counting the connections it accepts.
+    '''
+    daemon_threads = True
+
+    def __init__(self, size, latency, rate):
+        self.size, self.latency, self.rate = size, latency, rate
+        self.payload = bytes(range(256)) * (size // 256) + bytes(size % 256)
+        self.connections = 0
+        self._lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), ProductHandler)
+
+    def get_request(self):
+        with self._lock:
+            self.connections += 1
+        return super().get_request()
+
+
+class ProductHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(server.size))
+        self.end_headers()
+        block = 64 * 1024
+        for start in range(0, server.size, block):
+            data = server.payload[start:start + block]
+            self.wfile.write(data)
+            if server.rate:
+                time.sleep(len(data) / server.rate)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def sequential_download(links):
+    # The downloader before the engine: a new connection per file and 10 KB chunks
+    for url, path in links:
+        data = requests.get(url, stream=True)
+        with open(path, 'wb') as out_file:
+            for chunk in data.iter_content(chunk_size=100 * 100):
+                out_file.write(chunk)
+
+
+def run(server, files, workers, chunk_size):
+    '''
+    Downloads files from server (sequentially if workers is None) and returns the
+    elapsed time and the number of connections opened.
+    '''
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    out_dir = Path(tempfile.mkdtemp())
+    links = [(f'{url}/GRANULE/IMG_DATA/B{i:04d}.jp2', str(out_dir / f'B{i:04d}.jp2')) for i in range(files)]
+    connections = server.connections
+    try:
+        start = time.perf_counter()
+        if workers is None:
+            sequential_download(links)
+        else:
+            _, failures = DownloadEngine(workers, chunk_size, per_host_limit=workers).download_all(links)
+            if failures:
+                raise RuntimeError(f'{len(failures)} downloads failed: {failures[0][2]}')
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(out_dir)
+    return elapsed, server.connections - connections
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the download engine against a local server.')
+    parser.add_argument('--files', type=int, default=200, help='Number of files of the product')
+    parser.add_argument('--size', type=int, default=256 * 1024, help='Size of every file, in bytes')
+    parser.add_argument('--latency', type=float, default=0.05, help='Latency of every request, in seconds')
+    parser.add_argument('--rate', type=float, default=20 * 2 ** 20, help='Rate cap per connection, in bytes/s (0: none)')
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4, 8, 16], help='Worker counts to test')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Chunk size of the engine, in bytes')
+    args = parser.parse_args()
+
+    server = ProductServer(args.size, args.latency, args.rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    total_mb = args.files * args.size / 2 ** 20
+    print(f'{args.files} files, {total_mb:.1f} MB, {args.latency * 1000:.0f} ms latency')
+    print(f"{'downloader':<14}{'time (s)':>10}{'MB/s':>10}{'speedup':>10}{'connections':>13}")
+    reference = None
+    for workers in [None] + args.workers:
+        elapsed, connections = run(server, args.files, workers, args.chunk_size)
+        reference = reference or elapsed
+        name = 'sequential' if workers is None else f'{workers} workers'
+        print(f'{name:<14}{elapsed:>10.2f}{total_mb / elapsed:>10.1f}{reference / elapsed:>9.1f}x{connections:>13}')
+    server.shutdown()
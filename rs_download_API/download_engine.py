@@ -0,0 +1,267 @@
+'''
+The following script downloads the files of a product concurrently: a bounded pool
+of threads shares one connection-pooled requests session (keep-alive, retries of the
+transient errors), streams every file in large chunks, and limits the number of
+concurrent requests to each host, so that a product of hundreds of small files is
+not bound by the latency of one request after the other.
+
+Every file is written to a .part file next to it and renamed once complete (and, when
+its MD5 checksum is known, verified), so a file at its final path is always whole. An
+interrupted download resumes from its .part file with an HTTP Range request, and a
+file already present and verified is not downloaded again: by its checksum, or without
+one, by its size against the Content-Length of a HEAD request (a file left truncated
+by an older downloader writing to the final path is downloaded again).
+
+The validator of the response a part was started from (its strong ETag, or else its
+Last-Modified date) is saved next to it, and a resume sends it as If-Range: a file that
+changed on the server since is downloaded again from the start instead of being
+appended to the old bytes. A part without a validator or checksum is not resumed.
+'''
+
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DOWNLOAD_WORKERS = 8
+# Concurrent requests to the same host, across all the downloads of an engine
+PER_HOST_LIMIT = 8
+CHUNK_SIZE = 1024 * 1024
+# Seconds to connect, and to wait for data from the server
+TIMEOUT = (10, 60)
+RETRIES = 3
+PART_SUFFIX = '.part'
+VALIDATOR_SUFFIX = '.validator'
+
+
+class ChecksumError(Exception):
+    '''
+    Raised when a downloaded file does not match its MD5 checksum.
+    '''
+
+
+def file_md5(path, chunk_size=CHUNK_SIZE):
+    digest = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def response_validator(headers):
+    '''
+    Returns the validator of a response that If-Range accepts: its strong ETag, else its
+    Last-Modified date, or None if it has neither.
+    '''
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def save_validator(part_path, validator):
+    '''
+    Saves the validator of the response a part is downloaded from, next to the part.
+    '''
+    if validator is None:
+        discard_validator(part_path)
+        return
+    with open(part_path + VALIDATOR_SUFFIX, 'w') as file:
+        file.write(validator)
+
+
+def load_validator(part_path):
+    try:
+        with open(part_path + VALIDATOR_SUFFIX, 'r') as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def discard_validator(part_path):
+    try:
+        os.remove(part_path + VALIDATOR_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+def resume_headers(part_path, md5=None):
+    '''
+    Returns the Range and If-Range headers resuming the download of a part, or no headers
+    (after removing the part) if it cannot be resumed safely: without a validator nor a
+    checksum, bytes of another version of the file could not be detected.
+
+    Parameters:
+    - part_path (str): Path of the part.
+    - md5 (str): Expected MD5 checksum of the file, if known.
+    '''
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if not offset:
+        return {}
+    validator = load_validator(part_path)
+    if validator is None and md5 is None:
+        os.remove(part_path)
+        return {}
+    headers = {'Range': f'bytes={offset}-'}
+    if validator is not None:
+        headers['If-Range'] = validator
+    return headers
+
+
+def make_session(pool_size=DOWNLOAD_WORKERS, retries=RETRIES):
+    '''
+    Returns a requests session keeping up to pool_size connections alive per host, and
+    retrying the failed connections and the 429/5xx responses with a backoff.
+    '''
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=('GET', 'HEAD'))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class DownloadEngine:
+    '''
+    Concurrent file downloader.
+
+    Parameters:
+    - workers (int): Number of files downloaded at the same time.
+    - chunk_size (int): Size (in bytes) of the chunks read from the responses.
+    - per_host_limit (int): Maximum number of concurrent requests to one host.
+    - session (requests.Session): Session to download with (default: make_session()).
+    '''
+
+    def __init__(self, workers=DOWNLOAD_WORKERS, chunk_size=CHUNK_SIZE, per_host_limit=PER_HOST_LIMIT, session=None):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.per_host_limit = per_host_limit
+        self.session = session or make_session(max(workers, per_host_limit))
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+
+    def _host_slot(self, url):
+        host = urlsplit(url).netloc
+        with self._hosts_lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._hosts[host]
+
+    def _fetch(self, url, part_path, digest, on_chunk, md5=None):
+        # Appends the rest of url to part_path (all of it if the server ignores the Range,
+        # or if the file changed since the part was started), calling on_chunk with the size
+        # of every chunk. digest holds the hash of the bytes already in part_path; returns
+        # the digest of the whole part
+        headers = resume_headers(part_path, md5)
+        with self.session.get(url, stream=True, timeout=TIMEOUT, headers=headers) as response:
+            if headers and response.status_code == 416:
+                # Nothing left after offset: the part is complete
+                return digest
+            response.raise_for_status()
+            mode = 'ab' if headers and response.status_code == 206 else 'wb'
+            if mode == 'wb':
+                digest = hashlib.md5()
+                save_validator(part_path, response_validator(response.headers))
+            with open(part_path, mode) as out_file:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    out_file.write(chunk)
+                    digest.update(chunk)
+                    on_chunk(len(chunk))
+        return digest
+
+    def _is_complete(self, url, path, md5=None):
+        # Whether the file at path is whole: it matches md5, or without a checksum, its size
+        # is the Content-Length of url (trusted if the server does not tell the length of
+        # the bytes it sends)
+        if md5 is not None:
+            return file_md5(path, self.chunk_size) == md5.lower()
+        response = self.session.head(url, timeout=TIMEOUT, allow_redirects=True)
+        if not response.ok:
+            return False
+        length = response.headers.get('Content-Length')
+        if length is None or response.headers.get('Content-Encoding'):
+            return True
+        return int(length) == os.path.getsize(path)
+
+    def download(self, url, path, md5=None, on_progress=None):
+        '''
+        Downloads url to path, resuming a previous partial download, and returns the number
+        of bytes downloaded. A file already at path is kept if it matches md5 (or without a
+        checksum, the Content-Length of url). Raises requests.RequestException if the download fails, and
+        ChecksumError if the file does not match md5 even when downloaded from scratch.
+
+        Parameters:
+        - url (str): URL of the file.
+        - path (str): Destination of the file.
+        - md5 (str): Expected MD5 checksum (hexadecimal) of the file, if known.
+        - on_progress (callable): Called with the size of every chunk downloaded.
+        '''
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        part_path = path + PART_SUFFIX
+        written = 0
+
+        def on_chunk(size):
+            nonlocal written
+            written += size
+            if on_progress is not None:
+                on_progress(size)
+
+        with self._host_slot(url):
+            if os.path.exists(path) and self._is_complete(url, path, md5):
+                return 0
+            for attempt in range(2):
+                # Resume after the connections dropped in the middle of a response
+                for retry in range(RETRIES + 1):
+                    digest = hashlib.md5()
+                    if os.path.exists(part_path):
+                        with open(part_path, 'rb') as file:
+                            for chunk in iter(lambda: file.read(self.chunk_size), b''):
+                                digest.update(chunk)
+                    try:
+                        digest = self._fetch(url, part_path, digest, on_chunk, md5)
+                        break
+                    except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                        if retry == RETRIES:
+                            raise
+                if md5 is None or digest.hexdigest() == md5.lower():
+                    os.replace(part_path, path)
+                    discard_validator(part_path)
+                    return written
+                # A corrupt part: start over once
+                os.remove(part_path)
+                discard_validator(part_path)
+        raise ChecksumError(f'{url}: the MD5 checksum of the file is not {md5}')
+
+    def download_all(self, links, on_done=None, checksums=None):
+        '''
+        Downloads every (url, path) pair of links concurrently. Returns the total number of
+        bytes downloaded and the list of (url, path, error) of the failed downloads.
+
+        Parameters:
+        - links (list): The (url, path) pairs to download.
+        - on_done (callable): Called with (url, path, bytes downloaded) after every download
+          (0 bytes for a file that was already there).
+        - checksums (dict): Expected MD5 checksum of the files, by path.
+        '''
+        checksums = checksums or {}
+        total, failures = 0, []
+        with ThreadPoolExecutor(self.workers) as executor:
+            futures = {executor.submit(self.download, url, path, checksums.get(path)): (url, path) for url, path in links}
+            for future in as_completed(futures):
+                url, path = futures[future]
+                try:
+                    written = future.result()
+                except (requests.RequestException, OSError, ChecksumError) as error:
+                    failures.append((url, path, error))
+                    continue
+                total += written
+                if on_done is not None:
+                    on_done(url, path, written)
+        return total, failures
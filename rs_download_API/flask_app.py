@@ -2,7 +2,6 @@ import dash
 from dash import callback_context, dcc, html
 from pyproj import CRS
 import landsatxplore.api
-from landsatxplore.earthexplorer import EarthExplorer
 from dash.dependencies import Output, Input, State
 from datetime import date
 from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt
@@ -12,11 +11,36 @@ import geopandas
 from shapely.geometry import Polygon
 import pandas as pd
 import numpy as np
-from rs_utils import draw_map, download_sentinel
+from rs_utils import JOB_KINDS, draw_map
+from job_queue import JobConflict, JobQueue, secret_store, start_workers
+from search_cache import SearchCache, search_query
+from http_caching import register_http_caching, register_static_caching
 
 app = dash.Dash('download_imgs_API')
+# Compressed responses, ETags and Cache-Control headers (see http_caching)
+register_http_caching(app.server)
+register_static_caching(app.server)
 m = draw_map(zoom=4)
 
+# Downloads of every user, queued in JOB_DB and run by DOWNLOAD_WORKERS worker processes
+# sharing the connections and bandwidth of the server (see job_queue); their progress is
+# polled every DOWNLOAD_POLL_INTERVAL milliseconds
+JOB_DB = './download_jobs.sqlite'
+DOWNLOAD_WORKERS = 2  # started with the development server; else run python job_queue.py
+DOWNLOAD_CONNECTIONS = 16  # per worker
+DOWNLOAD_RATE = None  # bytes per second, None for no limit
+DOWNLOAD_POLL_INTERVAL = 1000
+# The EarthExplorer passwords of the Landsat jobs are kept in memory, shared with the
+# workers the development server starts (see job_queue.secret_store): with another
+# server, only the Sentinel jobs can be queued
+job_queue = JobQueue(JOB_DB)
+
+# Results of the searches of every user, kept SEARCH_TTL seconds (see search_cache)
+SEARCH_DB = './search_cache.sqlite'
+SEARCH_TTL = 3600
+LANDSAT_MAX_RESULTS = 100
+search_cache = SearchCache(SEARCH_DB, ttl=SEARCH_TTL)
+
 app.layout = html.Div(children=[
     html.Div(
         className="study-browser-banner row",
@@ -202,6 +226,15 @@ app.layout = html.Div(children=[
                             "text-align": "center",
                         },
                     ),
+                    html.Div(
+                        id="download-error",
+                        style={
+                            "width": "100%",
+                            "text-align": "center",
+                        },
+                    ),
+                    dcc.Store(id="download-jobs", data=[]),
+                    dcc.Interval(id="download-interval", interval=DOWNLOAD_POLL_INTERVAL, disabled=True),
                 ],
             ),
             html.Div(
@@ -227,6 +260,12 @@ app.layout = html.Div(children=[
 ])
 
 
+def print_search_stats():
+    stats = search_cache.stats()
+    print('Search cache: {h} hits, {n} filtered, {m} misses ({r:.0%} hit rate), {e} searches, {mb:.1f} MB'.format(
+        h=stats['hits'], n=stats['narrowed'], m=stats['misses'], r=stats['hit_rate'], e=stats['entries'],
+        mb=stats['bytes'] / 2 ** 20))
+
 @app.callback(
     [Output('map', 'srcDoc'),
     Output('textarea', 'children')],
@@ -260,13 +299,15 @@ def search(btn2,selecdrop,start_date, end_date,value,usr,pas):
             cloudcover = (0,value)
             
             footprint = geojson_to_wkt(read_geojson(geojson_path))
-            pp = api.query(footprint,
+            query = search_query('sentinel', 'Sentinel-2', 'S2MSI1C', footprint, startdate, enddate, value)
+            pp = search_cache.search(query, lambda: api.query(footprint,
                         date=(startdate, enddate),
                         platformname='Sentinel-2',
                         area_relation = 'Intersects',#Intersects
                         producttype= 'S2MSI1C',
                         cloudcoverpercentage=cloudcover,
-                        processinglevel = 'Level-1C') #Level-1C because Level-2A we need to change google storage folder
+                        processinglevel = 'Level-1C')) #Level-1C because Level-2A we need to change google storage folder
+            print_search_stats()
             products = list(pp.items())
             areas = api.to_geodataframe(pp)
             base_map = draw_map(zoom=8)
@@ -300,11 +341,13 @@ def search(btn2,selecdrop,start_date, end_date,value,usr,pas):
             enddate = end
             s=[]
             footprint = geojson_to_wkt(read_geojson(geojson_path))
-            pp = api.query(footprint,
+            query = search_query('sentinel', 'Sentinel-1', 'SLC', footprint, startdate, enddate)
+            pp = search_cache.search(query, lambda: api.query(footprint,
                         date=(startdate, enddate),
                         platformname='Sentinel-1',
                         producttype='SLC',
-                        area_relation = 'Intersects') #Level-1C because Level-2A we need to change google storage folder
+                        area_relation = 'Intersects')) #Level-1C because Level-2A we need to change google storage folder
+            print_search_stats()
             products = list(pp.items())
             areas = api.to_geodataframe(pp)
             base_map = draw_map(zoom=8)
@@ -332,7 +375,6 @@ def search(btn2,selecdrop,start_date, end_date,value,usr,pas):
 #Search Landsat-8            
     if btn2 is not None and btn2> 0 and selecdrop=='L8': 
         if 'btn-nclicks-2' in changed_id:
-            api = landsatxplore.api.API(usr,pas)
             cloudcover = value
             dataset='landsat_8_c1'
             products = []
@@ -342,7 +384,12 @@ def search(btn2,selecdrop,start_date, end_date,value,usr,pas):
             area = read_geojson(geojson_path)['features'][0]["geometry"]["coordinates"][0]
             xmin, ymin, xmax, ymax  = pd.DataFrame(area).iloc[:,0].min(), pd.DataFrame(area).iloc[:,1].min(), pd.DataFrame(area).iloc[:,0].max(), pd.DataFrame(area).iloc[:,1].max()
             footprint = (xmin, ymin, xmax, ymax)
-            tmp = api.search(dataset,start_date=startd,end_date=endd,max_cloud_cover=cloudcover, bbox = footprint)
+            query = search_query('landsat', dataset, None, footprint, startd, endd, cloudcover)
+            # Logged in only to search; results truncated at max_results cannot answer narrower searches
+            tmp = search_cache.search(query,
+                                      lambda: landsatxplore.api.API(usr,pas).search(dataset,start_date=startd,end_date=endd,max_cloud_cover=cloudcover, bbox = footprint, max_results=LANDSAT_MAX_RESULTS),
+                                      complete=lambda scenes: len(scenes) < LANDSAT_MAX_RESULTS)
+            print_search_stats()
             
             lon_list, lat_list, polygon = [], [], []
             
@@ -386,11 +433,13 @@ def search(btn2,selecdrop,start_date, end_date,value,usr,pas):
             enddate = end
             s=[]
             footprint = geojson_to_wkt(read_geojson(geojson_path))
-            pp = api.query(footprint,
+            query = search_query('sentinel', 'Sentinel-3', 'SL_1_RBT___', footprint, startdate, enddate)
+            pp = search_cache.search(query, lambda: api.query(footprint,
                         date=(startdate, enddate),
                         platformname='Sentinel-3',
                         producttype='SL_1_RBT___',
-                        area_relation = 'Intersects') 
+                        area_relation = 'Intersects'))
+            print_search_stats()
             
             products = list(pp.items())
             areas = api.to_geodataframe(pp)
@@ -419,15 +468,17 @@ def search(btn2,selecdrop,start_date, end_date,value,usr,pas):
         raise dash.exceptions.PreventUpdate
     
 @app.callback(
-  [Output('placeholder', 'children')],
+  [Output('download-jobs', 'data'),
+   Output('download-error', 'children')],
    [Input('download_button', 'n_clicks'),
    State('dropdown', 'value'),
    State('productid', 'value'),
    State('outputfolder', 'value'),
    State('username','value'),
-   State('password','value')])
+   State('password','value'),
+   State('download-jobs', 'data')])
 
-def download(btn,selecdrop,desired_prod,outdir,usr,pas):
+def download(btn,selecdrop,desired_prod,outdir,usr,pas,jobs):
     usr=str(usr)
     pas=str(pas) 
     changed_id = [p['prop_id'] for p in callback_context.triggered][0]
@@ -445,8 +496,8 @@ def download(btn,selecdrop,desired_prod,outdir,usr,pas):
         t2 = desired_prod[-19:-18]
         t3 = desired_prod[-18:-16]
         download_url = 'http://storage.googleapis.com/gcp-public-data-sentinel-2/tiles/'+t1+'/'+t2+'/'+t3+'/'+desired_prod+'.SAFE'
-        download_sentinel(download_url, s2_folder)
-        return ['Download Complete']
+        job_id = job_queue.enqueue('sentinel', desired_prod, {'scene': download_url, 'dst': os.path.abspath(s2_folder)})
+        return [add_job(jobs, job_id), '']
     
     elif btn is not None and btn> 0 and selecdrop=='S1': 
         if 'download_button' in changed_id:
@@ -462,8 +513,8 @@ def download(btn,selecdrop,desired_prod,outdir,usr,pas):
         t2 = desired_prod[-19:-18]
         t3 = desired_prod[-18:-16]
         download_url = 'http://storage.googleapis.com/gcp-public-data-sentinel-2/tiles/'+t1+'/'+t2+'/'+t3+'/'+desired_prod+'.SAFE'
-        download_sentinel(download_url, s2_folder)
-        return ['Download Complete']
+        job_id = job_queue.enqueue('sentinel', desired_prod, {'scene': download_url, 'dst': os.path.abspath(s2_folder)})
+        return [add_job(jobs, job_id), '']
     
     
     elif btn is not None and btn> 0 and selecdrop=='S3': 
@@ -478,7 +529,6 @@ def download(btn,selecdrop,desired_prod,outdir,usr,pas):
     
     elif btn is not None and btn> 0 and selecdrop=='L8': 
         if 'download_button' in changed_id:
-            ee = EarthExplorer(usr, pas)
             scene = str(desired_prod)
             outputdir = outdir + '/Landsat-8/'
             if not os.path.exists(outputdir):
@@ -487,14 +537,67 @@ def download(btn,selecdrop,desired_prod,outdir,usr,pas):
             else:
                 print ("Directory %s already exists" % outputdir)
 
-            ee.download(scene_id=scene, output_dir=outputdir)
-            ee.logout()
-        return ['Download Complete']
+            try:
+                job_id = job_queue.enqueue('landsat', scene, {'username': usr, 'password': pas, 'scene_id': scene,
+                                                              'output_dir': os.path.abspath(outputdir)})
+            except JobConflict as error:
+                return [jobs, str(error)]
+            except ValueError:
+                return [jobs, 'Landsat downloads need the workers started with the app']
+        return [add_job(jobs, job_id), '']
     
     else:
         raise dash.exceptions.PreventUpdate
 
+def add_job(jobs, job_id):
+    # A product already requested (by any user) is the same job
+    return jobs if job_id in jobs else jobs + [job_id]
+
+def format_progress(job):
+    '''
+    Returns the status of a download job (see job_queue.JobQueue.get) as text.
+    '''
+    name, progress = job['name'], job['progress']
+    if job['status'] == 'queued':
+        if job['attempts'] and job['error']:
+            return 'Retrying {n} (attempt {a}/{m}) after: {e}'.format(
+                n=name, a=job['attempts'] + 1, m=job['max_attempts'], e=job['error'])
+        return 'Queued {n}'.format(n=name)
+    if job['status'] == 'failed' and (progress is None or not progress['files']):
+        return 'Download Failed ({e}) | {n}'.format(e=job['error'], n=name)
+    if progress is None or progress['status'] == 'preparing':
+        return 'Preparing {n} ...'.format(n=name)
+    status = 'downloading' if job['status'] == 'running' else job['status']
+    text = '{n}: {d}/{f} files, {mb:.1f} MB at {r:.1f} MB/s'.format(
+        n=name, d=progress['done'], f=progress['files'], mb=progress['bytes'] / 2 ** 20, r=progress['rate'] / 2 ** 20)
+    if progress['skipped']:
+        text += ', {s} already downloaded'.format(s=progress['skipped'])
+    if status == 'downloading':
+        return 'Downloading ' + text
+    if status == 'done':
+        return 'Download Complete | ' + text
+    return 'Download Failed ({e}) | {t}'.format(e=job['error'], t=text)
+
+@app.callback(
+  [Output('placeholder', 'children'),
+   Output('download-interval', 'disabled')],
+   [Input('download-interval', 'n_intervals'),
+   Input('download-jobs', 'data')])
+
+def download_progress(n_intervals, jobs):
+    lines, running = [], False
+    for job_id in jobs or []:
+        job = job_queue.get(job_id)
+        if job is None:
+            continue
+        lines.append(format_progress(job))
+        running = running or job['status'] in ('queued', 'running')
+    return '\n'.join(lines), not running
+
 if __name__ == '__main__':    
     PORT = 8084 # Set the desired port number
     ADDRESS = '127.0.0.1'  # Set the desired IP address or leave it as None for the default address
+    job_queue.secrets = secret_store()
+    start_workers(JOB_DB, JOB_KINDS, DOWNLOAD_WORKERS, connections=DOWNLOAD_CONNECTIONS, rate=DOWNLOAD_RATE,
+                  secrets=job_queue.secrets)
     app.run_server(debug=True, use_reloader=False,port=PORT, host=ADDRESS)
\ No newline at end of file
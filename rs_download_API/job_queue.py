@@ -0,0 +1,441 @@
+'''
+The following script implements the persistent queue of the download jobs. The jobs are
+rows of an SQLite database, so the web app only enqueues a job and returns, and the
+downloads are run by worker processes (each with an async_downloads.DownloadManager)
+that outlive the requests and are restarted independently of the app:
+
+- a request for a product that is already queued or downloading gets the id of that
+  job instead of a new one. A job logs in with the account of the user who requested
+  it: the request of another account for the same product is rejected (JobConflict)
+  until the job ends
+- a worker claims a job with a lease that it renews with the progress of the job every
+  PROGRESS_INTERVAL seconds. The jobs of a worker that stopped (crashed, or killed with
+  the server) are queued again once their lease expires, and resume from the files
+  already downloaded
+- a failed job is retried up to MAX_ATTEMPTS times, after RETRY_DELAY seconds doubled
+  at every attempt
+
+The secret parameters of a job (SECRET_PARAMS, e.g. the password it logs in with) are
+never written to the database: they are kept in memory, in a mapping shared by the app
+and its workers (see secret_store), and dropped when the job ends. The workers run
+apart from the app have no access to them, and only take the jobs without secrets; the
+jobs whose secrets were lost (the app restarted) fail, to be requested again. The
+database is created readable by its owner only.
+
+Usage (from the rs_download_API directory, to run the workers apart from the app):
+    python job_queue.py --workers 2 --connections 16
+'''
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+JOB_DB = './download_jobs.sqlite'
+# Jobs downloaded at the same time by a worker process
+WORKER_JOBS = 4
+MAX_ATTEMPTS = 3
+# Seconds before the first retry of a failed job, doubled at every attempt
+RETRY_DELAY = 30
+# Seconds between the progress updates (and lease renewals) of a worker
+PROGRESS_INTERVAL = 1.0
+# Seconds after its last update before the job of a silent worker is queued again
+LEASE_SECONDS = 60
+# Seconds the ended jobs are kept for their status to be read
+KEEP_SECONDS = 7 * 24 * 3600
+# Parameters of a job kept in memory only, never in the database
+SECRET_PARAMS = ('password',)
+# Parameter naming the account a job logs in with, left out of the deduplication key
+ACCOUNT_PARAM = 'username'
+# Events of the files kept with the progress of a job
+PROGRESS_EVENTS = 20
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    params TEXT NOT NULL,
+    key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_after REAL NOT NULL,
+    worker TEXT,
+    heartbeat REAL,
+    progress TEXT,
+    error TEXT,
+    secrets INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_key ON jobs (key) WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, run_after);
+'''
+
+
+class JobConflict(Exception):
+    '''
+    Raised when a product is requested with another account than the one of the job
+    already downloading it.
+    '''
+
+
+def job_key(kind, params):
+    '''
+    Returns the deduplication key of a job: the hash of its kind and parameters, without
+    its account and secrets.
+    '''
+    params = {name: value for name, value in params.items() if name not in SECRET_PARAMS + (ACCOUNT_PARAM,)}
+    return hashlib.sha256(json.dumps([kind, params], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def secret_store():
+    '''
+    Returns a mapping shared with the worker processes started afterwards (a
+    multiprocessing.Manager dictionary), to keep the secret parameters of the jobs in
+    memory (see JobQueue).
+    '''
+    return multiprocessing.Manager().dict()
+
+
+class JobQueue:
+    '''
+    SQLite-backed queue of download jobs, shared by the app and the worker processes.
+    Every call opens its own connection, so an instance can be used from any thread.
+
+    Parameters:
+    - path (str): Path of the database, created if missing.
+    - max_attempts (int): Attempts of a job before it is marked as failed.
+    - retry_delay (float): Seconds before the first retry of a failed job.
+    - lease (float): Seconds without update before a running job is queued again.
+    - secrets (dict): Secret parameters of the jobs by id (see secret_store), or None to
+      neither queue nor claim jobs with secrets.
+    '''
+
+    def __init__(self, path=JOB_DB, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY, lease=LEASE_SECONDS,
+                 secrets=None):
+        self.path = path
+        self.secrets = secrets
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
+        created = not os.path.exists(path)
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._migrate(conn)
+        finally:
+            conn.close()
+        if created:
+            os.chmod(path, 0o600)
+
+    def _migrate(self, conn):
+        # Databases created before the secrets were kept in memory: remove them from the
+        # params, the active jobs that had some fail when claimed (see claim)
+        if 'secrets' in [column['name'] for column in conn.execute('PRAGMA table_info(jobs)')]:
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('ALTER TABLE jobs ADD COLUMN secrets INTEGER NOT NULL DEFAULT 0')
+        for row in conn.execute('SELECT id, params FROM jobs').fetchall():
+            params = json.loads(row['params'])
+            public = {name: value for name, value in params.items() if name not in SECRET_PARAMS}
+            conn.execute('UPDATE jobs SET params = ?, secrets = ? WHERE id = ?',
+                         (json.dumps(public), int(len(public) < len(params)), row['id']))
+        conn.execute('COMMIT')
+
+    def _connect(self):
+        # Autocommit: the transactions are explicit (see _transaction)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        # Takes the write lock at once, so reading then writing a job is atomic
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def enqueue(self, kind, name, params):
+        '''
+        Queues a job and returns its id, or the id of the identical job (see job_key)
+        already queued or running. Raises JobConflict if that job logs in with another
+        account, and ValueError if the job has secrets but the queue has no secret store.
+
+        Parameters:
+        - kind (str): Kind of the job, naming the function that makes its downloads (see run_worker).
+        - name (str): Name of the job shown to the user.
+        - params (dict): Keyword arguments of the function of the job (JSON serializable).
+        '''
+        secrets = {name: value for name, value in params.items() if name in SECRET_PARAMS}
+        params = {name: value for name, value in params.items() if name not in SECRET_PARAMS}
+        if secrets and self.secrets is None:
+            raise ValueError('A job with secret parameters needs a secret store shared with the workers')
+        key = job_key(kind, params)
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT id, params FROM jobs WHERE key = ? AND status IN ('queued', 'running')",
+                               (key,)).fetchone()
+            if row is not None:
+                if json.loads(row['params']).get(ACCOUNT_PARAM) != params.get(ACCOUNT_PARAM):
+                    raise JobConflict(f'{name} is already being downloaded with another account')
+                job_id = row['id']
+            else:
+                job_id = uuid.uuid4().hex[:12]
+            # Stored before the job can be claimed (and renewed for a job that lost them)
+            if secrets:
+                self.secrets[job_id] = secrets
+            if row is None:
+                conn.execute('INSERT INTO jobs (id, kind, name, params, key, status, max_attempts, run_after, secrets,'
+                             " created, updated) VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?, ?)",
+                             (job_id, kind, name, json.dumps(params), key, self.max_attempts, now, int(bool(secrets)),
+                              now, now))
+        return job_id
+
+    def get(self, job_id):
+        '''
+        Returns the status of a job as a dictionary (id, kind, name, params without the
+        secret ones, status, attempts, max_attempts, run_after, error, created, updated, and
+        progress: the last async_downloads.Job.snapshot of its download, or None), or None
+        if it is unknown.
+        '''
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        job = {name: row[name] for name in ('id', 'kind', 'name', 'status', 'attempts', 'max_attempts',
+                                            'run_after', 'error', 'created', 'updated')}
+        job['params'] = json.loads(row['params'])
+        job['progress'] = json.loads(row['progress']) if row['progress'] else None
+        return job
+
+    def counts(self):
+        '''
+        Returns the number of jobs by status.
+        '''
+        conn = self._connect()
+        try:
+            return dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        finally:
+            conn.close()
+
+    def _end(self, conn, row, status, error, now, progress=None, retry=True):
+        # Ends a job (or queues it again if it has attempts left), dropping its secrets when it ends
+        if retry and status == 'failed' and row['attempts'] < row['max_attempts']:
+            status = 'queued'
+            run_after = now + self.retry_delay * 2 ** max(0, row['attempts'] - 1)
+        else:
+            run_after = row['run_after']
+            if self.secrets is not None:
+                self.secrets.pop(row['id'], None)
+        conn.execute('UPDATE jobs SET status = ?, run_after = ?, worker = NULL, error = ?,'
+                     ' progress = COALESCE(?, progress), updated = ? WHERE id = ?',
+                     (status, run_after, error, progress, now, row['id']))
+
+    def recover(self):
+        '''
+        Queues again (or fails, if they have no attempts left) the running jobs whose lease
+        has expired, and deletes the jobs ended more than KEEP_SECONDS ago. Returns the
+        number of jobs recovered.
+        '''
+        now = time.time()
+        with self._transaction() as conn:
+            stale = conn.execute("SELECT * FROM jobs WHERE status = 'running' AND heartbeat < ?",
+                                 (now - self.lease,)).fetchall()
+            for row in stale:
+                print('Recovering job {n} of worker {w}'.format(n=row['name'], w=row['worker']))
+                self._end(conn, row, 'failed', 'The worker of the job stopped', now)
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?", (now - KEEP_SECONDS,))
+        return len(stale)
+
+    def claim(self, worker):
+        '''
+        Takes the oldest queued job that is due, for worker, and returns it as a dictionary
+        (id, kind, name, params with the secret ones, attempts), or None if there is none.
+        Without a secret store, only the jobs without secrets are taken; the jobs whose
+        secrets are missing from the store fail without retry.
+        '''
+        now = time.time()
+        with self._transaction() as conn:
+            while True:
+                row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' AND run_after <= ?"
+                                   + (' AND secrets = 0' if self.secrets is None else '')
+                                   + ' ORDER BY run_after, created LIMIT 1', (now,)).fetchone()
+                if row is None:
+                    return None
+                params = json.loads(row['params'])
+                if not row['secrets']:
+                    break
+                secrets = self.secrets.get(row['id'])
+                if secrets is not None:
+                    params.update(secrets)
+                    break
+                self._end(conn, row, 'failed', 'The credentials of the job were lost, request it again', now,
+                          retry=False)
+            conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, heartbeat = ?,"
+                         ' updated = ? WHERE id = ?', (worker, now, now, row['id']))
+        return {'id': row['id'], 'kind': row['kind'], 'name': row['name'], 'params': params,
+                'attempts': row['attempts'] + 1}
+
+    def update(self, job_id, worker, progress):
+        '''
+        Records the progress of a job and renews its lease. Returns False if the job is no
+        longer held by worker (its lease expired).
+        '''
+        now = time.time()
+        progress = dict(progress, events=progress.get('events', [])[-PROGRESS_EVENTS:])
+        conn = self._connect()
+        try:
+            cursor = conn.execute("UPDATE jobs SET progress = ?, heartbeat = ?, updated = ?"
+                                  " WHERE id = ? AND worker = ? AND status = 'running'",
+                                  (json.dumps(progress), now, now, job_id, worker))
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def finish(self, job_id, worker, progress=None, error=None):
+        '''
+        Ends a job held by worker: done if its download succeeded (progress['status'] is
+        'done'), else failed, to be retried if it has attempts left.
+
+        Parameters:
+        - job_id (str): Id of the job.
+        - worker (str): Id of the worker holding the job.
+        - progress (dict): Last async_downloads.Job.snapshot of the download, or None.
+        - error (str): Error of a job whose download could not start.
+        '''
+        now = time.time()
+        status = 'done' if progress is not None and progress['status'] == 'done' else 'failed'
+        error = error or (progress or {}).get('error')
+        if progress is not None:
+            progress = json.dumps(dict(progress, events=progress.get('events', [])[-PROGRESS_EVENTS:]))
+        with self._transaction() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ? AND worker = ? AND status = 'running'",
+                               (job_id, worker)).fetchone()
+            if row is not None:
+                self._end(conn, row, status, error, now, progress)
+
+    def release(self, worker):
+        '''
+        Queues again at once the jobs held by a worker that is stopping, without counting
+        their attempt.
+        '''
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = 'queued', attempts = attempts - 1, worker = NULL, run_after = ?,"
+                         " updated = ? WHERE worker = ? AND status = 'running'", (now, now, worker))
+
+
+def run_worker(path, job_kinds, jobs=WORKER_JOBS, connections=None, rate=None, secrets=None):
+    '''
+    Runs the jobs of the queue at path until the process is stopped (SIGTERM or SIGINT),
+    then queues its unfinished jobs again.
+
+    Parameters:
+    - path (str): Path of the queue database.
+    - job_kinds (dict): Function of every kind of job, called with the params of a job
+      and returning the prepare and finish functions of its download (see
+      async_downloads.DownloadManager.submit).
+    - jobs (int): Jobs downloaded at the same time.
+    - connections (int): Connections of the worker (default: async_downloads.DOWNLOAD_CONNECTIONS).
+    - rate (float): Bytes per second of the worker, or None for no limit.
+    - secrets (dict): Secret store of the app enqueuing the jobs (see secret_store), or
+      None to take only the jobs without secrets.
+    '''
+    # Imported here, so that the app enqueuing the jobs does not need aiohttp
+    from async_downloads import DOWNLOAD_CONNECTIONS, DownloadManager
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    queue = JobQueue(path, secrets=secrets)
+    manager = DownloadManager(connections=connections or DOWNLOAD_CONNECTIONS, rate=rate)
+    worker = '{h}:{p}'.format(h=socket.gethostname(), p=os.getpid())
+    # Id of the download of every job of the worker
+    running = {}
+    print('Download worker {w} started'.format(w=worker))
+    try:
+        while True:
+            queue.recover()
+            while len(running) < jobs:
+                job = queue.claim(worker)
+                if job is None:
+                    break
+                print('Starting job {n} (attempt {a})'.format(n=job['name'], a=job['attempts']))
+                try:
+                    prepare, finish = job_kinds[job['kind']](**job['params'])
+                except Exception as error:
+                    queue.finish(job['id'], worker, error=str(error))
+                    continue
+                running[job['id']] = manager.submit(job['name'], prepare, finish)
+            for job_id, download_id in list(running.items()):
+                progress = manager.progress(download_id)
+                if progress['status'] in ('done', 'failed'):
+                    queue.finish(job_id, worker, progress)
+                    del running[job_id]
+                elif not queue.update(job_id, worker, progress):
+                    # Taken over by another worker after a lost lease: stop writing the parts
+                    # it resumes. The files completed so far stay and are skipped
+                    manager.cancel(download_id)
+                    del running[job_id]
+            time.sleep(PROGRESS_INTERVAL)
+    except (KeyboardInterrupt, SystemExit):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        queue.release(worker)
+        print('Download worker {w} stopped'.format(w=worker))
+
+
+def start_workers(path, job_kinds, processes=2, jobs=WORKER_JOBS, connections=None, rate=None, secrets=None):
+    '''
+    Starts processes worker processes (see run_worker) and returns them. The rate is
+    shared equally by the workers.
+    '''
+    workers = []
+    for _ in range(processes):
+        worker = multiprocessing.Process(target=run_worker, daemon=True,
+                                         args=(path, job_kinds, jobs, connections, rate / processes if rate else None,
+                                               secrets))
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the download workers of the queue.')
+    parser.add_argument('--db', default=JOB_DB, help='Path of the queue database')
+    parser.add_argument('--workers', type=int, default=2, help='Number of worker processes')
+    parser.add_argument('--jobs', type=int, default=WORKER_JOBS, help='Jobs downloaded at the same time per worker')
+    parser.add_argument('--connections', type=int, default=None, help='Connections per worker')
+    parser.add_argument('--rate', type=float, default=None, help='Bytes per second of all the workers (default: no limit)')
+    args = parser.parse_args()
+
+    from rs_utils import JOB_KINDS
+    # Stopped, the workers queue their jobs again (on SIGINT themselves, on SIGTERM when terminated at exit)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    workers = start_workers(args.db, JOB_KINDS, args.workers, args.jobs, args.connections, args.rate)
+    try:
+        for process in workers:
+            process.join()
+    except KeyboardInterrupt:
+        for process in workers:
+            process.join()
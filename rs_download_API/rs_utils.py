@@ -1,10 +1,17 @@
 import os
+import xml.etree.ElementTree as ET
 import requests
 from google.cloud import bigquery
 from google.oauth2 import service_account
-import urllib
 import folium
 from folium.plugins import MeasureControl, Draw, MousePosition
+from landsatxplore.earthexplorer import DATA_PRODUCTS, EE_DOWNLOAD_URL, EarthExplorer
+from landsatxplore.util import guess_dataset
+from download_engine import CHUNK_SIZE, DOWNLOAD_WORKERS, PER_HOST_LIMIT, DownloadEngine
+
+# Engine of the downloads that do not ask for their own settings, so that they share
+# its pooled connections
+default_engine = DownloadEngine()
 
 def query_sentinel(key_json, project_id, start, end, tile, cloud=100.):
     BASE_URL = 'http://storage.googleapis.com/'
@@ -24,24 +31,30 @@ def query_sentinel(key_json, project_id, start, end, tile, cloud=100.):
             good_scenes.append(row['base_url'].replace('gs://', BASE_URL))
     return good_scenes
 
-def download_file(url, dst_name):
+def download_file(url, dst_name, engine=None):
     try:
-        data = requests.get(url, stream=True)
-        with open(dst_name, 'wb') as out_file:
-            for chunk in data.iter_content(chunk_size=100 * 100):
-                out_file.write(chunk)
-    except:
+        (engine or default_engine).download(url, dst_name)
+    except (requests.RequestException, OSError):
         print ('\t ... {f} FAILED!'.format(f=url.split('/')[-1]))
-    return
+        return False
+    return True
+
+def refresh_file(url, dst_name, engine=None):
+    '''
+    Downloads a file that has no checksum to verify it against (e.g. manifest.safe) again
+    for every request: a copy already downloaded may be outdated. An interrupted download
+    still resumes from its part.
+    '''
+    if os.path.exists(dst_name):
+        os.remove(dst_name)
+    return download_file(url, dst_name, engine)
 
-def make_safe_dirs(scene, outpath):
+def make_safe_dirs(scene, outpath, engine=None):
     scene_name = os.path.basename(scene)
     scene_path = os.path.join(outpath, scene_name)
     manifest = os.path.join(scene_path, 'manifest.safe')
     manifest_url = scene + '/manifest.safe'
-    if os.path.exists(manifest):
-        os.remove(manifest)
-    download_file(manifest_url, manifest)
+    refresh_file(manifest_url, manifest, engine)
     with open(manifest, 'r') as f:
         manifest_lines = f.read().split()
     download_links = []
@@ -79,27 +92,120 @@ def make_safe_dirs(scene, outpath):
             os.makedirs(os.path.join(scene_path, extra_dir))
         if(extra_dir == 'rep_info'):
             url = scene +'/rep_info/S2_User_Product_Level-1C_Metadata.xsd'
-            urllib.request.urlretrieve(url, os.path.join(scene_path, extra_dir)+'/S2_User_Product_Level-1C_Metadata.xsd')
+            refresh_file(url, os.path.join(scene_path, extra_dir)+'/S2_User_Product_Level-1C_Metadata.xsd', engine)
 
     return download_links
 
-def download_sentinel(scene, dst):
+def manifest_checksums(manifest, scene_path):
+    '''
+    Returns the MD5 checksums listed in the manifest.safe of a product, by the local path
+    of their files.
+
+    Parameters:
+    - manifest (str): Path of the manifest.safe file.
+    - scene_path (str): Local .SAFE directory of the product.
+    '''
+    checksums = {}
+    for element in ET.parse(manifest).iter():
+        if not element.tag.endswith('byteStream'):
+            continue
+        href, md5 = None, None
+        for child in element:
+            if child.tag.endswith('fileLocation'):
+                href = child.get('href')
+            elif child.tag.endswith('checksum') and child.get('checksumName', '').upper() == 'MD5':
+                md5 = (child.text or '').strip().lower()
+        if href and md5:
+            local_path = os.path.join(scene_path, *[part for part in href.split('/') if part not in ('', '.')])
+            checksums[os.path.normpath(local_path)] = md5
+    return checksums
+
+def download_sentinel(scene, dst, workers=DOWNLOAD_WORKERS, chunk_size=CHUNK_SIZE, per_host_limit=PER_HOST_LIMIT):
+    '''
+    Downloads the files of a SAFE product concurrently. The files already downloaded and
+    matching their checksum in manifest.safe are kept, and interrupted downloads resume
+    where they stopped, so running it again only downloads the missing bytes.
+
+    Parameters:
+    - scene (str): URL of the .SAFE directory of the product.
+    - dst (str): Directory where the .SAFE directory is created.
+    - workers (int): Number of files downloaded at the same time.
+    - chunk_size (int): Size (in bytes) of the chunks read from the responses.
+    - per_host_limit (int): Maximum number of concurrent requests to one host.
+    '''
+    if (workers, chunk_size, per_host_limit) == (default_engine.workers, default_engine.chunk_size, default_engine.per_host_limit):
+        engine = default_engine
+    else:
+        engine = DownloadEngine(workers, chunk_size, per_host_limit)
     scene_name = scene.split('/')[-1]
     scene_path = os.path.join(dst, scene_name)
     if not os.path.exists(scene_path):
         os.mkdir(scene_path)
     print ('Downloading scene {s} ...'.format(s=scene_name))
-    download_links = sorted(make_safe_dirs(scene, dst))
-    p = []
-    for l in download_links:
-        if not os.path.exists(os.path.dirname(l[1])):
-            os.makedirs(os.path.dirname(l[1]))
-        if os.path.exists(l[1]):
-            os.remove(l[1])
-        if l[1].endswith('.jp2'):
-            print ('\t ... *{b}'.format(b=l[1].split('_')[-1]))
-        if download_file(l[0], l[1]) is False:
-            print ('\t ... {f} failed to download! Download for this scene is cancelled here!'.format(f=l[0]))       
+    download_links = sorted(make_safe_dirs(scene, dst, engine))
+    checksums = manifest_checksums(os.path.join(scene_path, 'manifest.safe'), scene_path)
+    checksums = {path: checksums.get(os.path.normpath(path)) for _, path in download_links}
+    skipped = []
+
+    def on_done(url, path, written):
+        if written == 0:
+            skipped.append(path)
+        elif path.endswith('.jp2'):
+            print ('\t ... *{b}'.format(b=path.split('_')[-1]))
+
+    total, failures = engine.download_all(download_links, on_done, checksums)
+    for url, path, error in failures:
+        print ('\t ... {f} failed to download! ({e})'.format(f=url, e=error))
+    print ('Downloaded {n} files ({mb:.1f} MB) of scene {s}, {k} already verified'.format(
+        n=len(download_links) - len(failures) - len(skipped), mb=total / 2 ** 20, s=scene_name, k=len(skipped)))
+    return not failures
+
+def sentinel_job(scene, dst):
+    '''
+    Returns the prepare and finish functions of an async_downloads.DownloadManager job
+    downloading a SAFE product from the Google Cloud Storage.
+
+    Parameters:
+    - scene (str): URL of the .SAFE directory of the product.
+    - dst (str): Directory where the .SAFE directory is created.
+    '''
+    def prepare():
+        scene_path = os.path.join(dst, scene.split('/')[-1])
+        os.makedirs(scene_path, exist_ok=True)
+        download_links = sorted(make_safe_dirs(scene, dst))
+        checksums = manifest_checksums(os.path.join(scene_path, 'manifest.safe'), scene_path)
+        return [{'url': url, 'path': path, 'md5': checksums.get(os.path.normpath(path))} for url, path in download_links]
+    return prepare, None
+
+def landsat_job(username, password, scene_id, output_dir):
+    '''
+    Returns the prepare and finish functions of an async_downloads.DownloadManager job
+    downloading a Landsat scene from EarthExplorer, with the cookies of a login session
+    that is closed once the job ends.
+
+    Parameters:
+    - username, password (str): EarthExplorer credentials.
+    - scene_id (str): Landsat product identifier.
+    - output_dir (str): Directory where the scene archive is written.
+    '''
+    session = {}
+
+    def prepare():
+        ee = session['ee'] = EarthExplorer(username, password)
+        dataset = guess_dataset(scene_id)
+        entity_id = ee.api.get_entity_id(scene_id, dataset)
+        url = EE_DOWNLOAD_URL.format(data_product_id=DATA_PRODUCTS[dataset], entity_id=entity_id)
+        cookies = '; '.join('{n}={v}'.format(n=cookie.name, v=cookie.value) for cookie in ee.session.cookies)
+        # The archive is named by the server
+        return [{'url': url, 'path': os.path.join(output_dir, ''), 'headers': {'Cookie': cookies}}]
+
+    def finish():
+        if 'ee' in session:
+            session['ee'].logout()
+    return prepare, finish
+
+# Functions of the kinds of download jobs of job_queue, called with the params of a job
+JOB_KINDS = {'sentinel': sentinel_job, 'landsat': landsat_job}
 
 def draw_map(zoom):
     base_map = folium.Map(location=[37.9838, 23.7275],tiles='cartodbpositron',zoom_start = zoom) 
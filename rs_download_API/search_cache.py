@@ -0,0 +1,275 @@
+'''
+The following script implements the persistent cache of the product searches (the
+SentinelAPI queries and the landsatxplore searches), shared by all the users and
+processes of the app through an SQLite database:
+
+- a search is keyed on its platform, product type, footprint (the hash of its
+  normalized geometry), date range and maximum cloud cover
+- a search within the date range and cloud cover of a cached one (with the same
+  platform, product type and footprint) is answered by filtering the cached results
+- the results are kept for SEARCH_TTL seconds, and the least recently used ones are
+  evicted beyond SEARCH_CACHE_BYTES
+- the hits (exact or filtered) and misses are counted, across processes
+
+The results are stored pickled, in a database created readable by its owner only.
+'''
+
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+from collections import OrderedDict
+from datetime import date, datetime
+from shapely import wkt
+
+SEARCH_DB = './search_cache.sqlite'
+# Seconds a search result is used (new acquisitions appear in the archives)
+SEARCH_TTL = 3600
+SEARCH_CACHE_BYTES = 64 * 1024 * 1024
+# Decimals of the footprint coordinates (about 10 cm)
+FOOTPRINT_DECIMALS = 6
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS searches (
+    id INTEGER PRIMARY KEY,
+    family TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    cloud REAL,
+    complete INTEGER NOT NULL,
+    results BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS searches_family ON searches (family, start, end);
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+'''
+
+
+def footprint_hash(footprint):
+    '''
+    Returns the hash of a footprint: a WKT geometry (SentinelAPI) or a (xmin, ymin, xmax,
+    ymax) bounding box (landsatxplore), with its coordinates rounded to FOOTPRINT_DECIMALS.
+    '''
+    if isinstance(footprint, str):
+        normalized = wkt.dumps(wkt.loads(footprint), rounding_precision=FOOTPRINT_DECIMALS)
+    else:
+        normalized = json.dumps([round(float(value), FOOTPRINT_DECIMALS) for value in footprint])
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def _iso_date(value):
+    # 'YYYYMMDD' (SentinelAPI), 'YYYY-MM-DD' (landsatxplore) or a date, as 'YYYY-MM-DD'
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    value = str(value)
+    return value if '-' in value else '{y}-{m}-{d}'.format(y=value[:4], m=value[4:6], d=value[6:8])
+
+
+def search_query(kind, platform, product_type, footprint, start, end, cloud=None):
+    '''
+    Returns the normalized search query used as key of the cache.
+
+    Parameters:
+    - kind (str): 'sentinel' (SentinelAPI.query) or 'landsat' (landsatxplore search).
+    - platform (str): Platform (or landsatxplore dataset) of the search.
+    - product_type (str): Product type of the search, or None.
+    - footprint: WKT geometry or (xmin, ymin, xmax, ymax) bounding box of the search.
+    - start, end (str): Date range of the search ('YYYYMMDD' or 'YYYY-MM-DD').
+    - cloud (float): Maximum cloud cover of the search, or None.
+    '''
+    family = [kind, platform, product_type, footprint_hash(footprint)]
+    return {'kind': kind, 'family': hashlib.sha256(json.dumps(family).encode('utf-8')).hexdigest(),
+            'start': _iso_date(start), 'end': _iso_date(end), 'cloud': None if cloud is None else float(cloud)}
+
+
+def _landsat_date(scene):
+    value = scene.get('acquisitionDate') or scene.get('acquisition_date')
+    if value is None:
+        return None
+    return value if isinstance(value, datetime) else datetime.fromisoformat(_iso_date(value)[:10])
+
+
+def _cloud(value):
+    return None if value is None else float(value)
+
+
+def _filter_sentinel(products, keep):
+    return OrderedDict((product_id, product) for product_id, product in products.items()
+                       if keep(product.get('beginposition'), _cloud(product.get('cloudcoverpercentage'))))
+
+
+def _filter_landsat(scenes, keep):
+    return [scene for scene in scenes if keep(_landsat_date(scene), _cloud(scene.get('cloudCover')))]
+
+
+# Filters of the results of every kind of search: they keep the results for which keep
+# (called with the date and cloud cover of a result) is true
+RESULT_FILTERS = {'sentinel': _filter_sentinel, 'landsat': _filter_landsat}
+
+
+def narrow(kind, results, query, cached_cloud):
+    '''
+    Returns the results of a search filtered to the date range and cloud cover of query,
+    or None if a result lacks the date or cloud cover to filter on. Both providers include
+    the bounds: SentinelAPI up to the start of the end date, landsatxplore the whole end date.
+
+    Parameters:
+    - kind (str): Kind of the search (see search_query).
+    - results: Results of the cached search.
+    - query (dict): Narrower search (see search_query).
+    - cached_cloud (float): Maximum cloud cover of the cached search, or None.
+    '''
+    start, end = datetime.fromisoformat(query['start']), datetime.fromisoformat(query['end'])
+    cloud = query['cloud'] if query['cloud'] is not None and query['cloud'] != cached_cloud else None
+
+    def keep(acquired, cloud_cover):
+        if acquired is None or (cloud is not None and cloud_cover is None):
+            raise ValueError('The result cannot be filtered')
+        return start <= acquired.replace(tzinfo=None) <= end and (cloud is None or cloud_cover <= cloud)
+
+    try:
+        return RESULT_FILTERS[kind](results, keep)
+    except ValueError:
+        return None
+
+
+class SearchCache:
+    '''
+    Persistent cache of search results. Every call opens its own connection, so an
+    instance can be used from any thread.
+
+    Parameters:
+    - path (str): Path of the database, created if missing.
+    - ttl (float): Seconds a search result is used.
+    - max_bytes (int): Maximum total size of the (compressed) cached results.
+    '''
+
+    def __init__(self, path=SEARCH_DB, ttl=SEARCH_TTL, max_bytes=SEARCH_CACHE_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        created = not os.path.exists(path)
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+        if created:
+            os.chmod(path, 0o600)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _count(self, conn, name):
+        conn.execute('INSERT INTO counters (name, value) VALUES (?, 1)'
+                     ' ON CONFLICT (name) DO UPDATE SET value = value + 1', (name,))
+
+    def get(self, query):
+        '''
+        Returns the results of a search (see search_query), from the same search or by
+        filtering a broader one, or None if it is not cached.
+        '''
+        now = time.time()
+        cloud = query['cloud']
+        conn = self._connect()
+        try:
+            # The same search first, then the smallest broader one whose results are complete
+            rows = conn.execute(
+                'SELECT id, start, end, cloud, results FROM searches'
+                ' WHERE family = ? AND start <= ? AND end >= ? AND (cloud IS NULL OR cloud >= ?) AND created >= ?'
+                ' AND (complete OR (start = ? AND end = ? AND cloud IS ?))'
+                ' ORDER BY start = ? AND end = ? AND cloud IS ? DESC, size',
+                (query['family'], query['start'], query['end'], cloud, now - self.ttl,
+                 query['start'], query['end'], cloud, query['start'], query['end'], cloud)).fetchall()
+            for row in rows:
+                results = pickle.loads(zlib.decompress(row['results']))
+                exact = (row['start'], row['end'], row['cloud']) == (query['start'], query['end'], cloud)
+                if not exact:
+                    results = narrow(query['kind'], results, query, row['cloud'])
+                    if results is None:
+                        continue
+                conn.execute('UPDATE searches SET used = ? WHERE id = ?', (now, row['id']))
+                self._count(conn, 'hits' if exact else 'narrowed')
+                return results
+            self._count(conn, 'misses')
+            return None
+        finally:
+            conn.close()
+
+    def put(self, query, results, complete=True):
+        '''
+        Caches the results of a search (see search_query).
+
+        Parameters:
+        - query (dict): The search.
+        - results: Its results (picklable).
+        - complete (bool): False if the results were truncated by the provider, so they
+          cannot answer narrower searches.
+        '''
+        now = time.time()
+        blob = zlib.compress(pickle.dumps(results, pickle.HIGHEST_PROTOCOL))
+        if len(blob) > self.max_bytes:
+            return
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM searches WHERE created < ? OR (family = ? AND start = ? AND end = ? AND cloud IS ?)',
+                         (now - self.ttl, query['family'], query['start'], query['end'], query['cloud']))
+            conn.execute('INSERT INTO searches (family, start, end, cloud, complete, results, size, created, used)'
+                         ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (query['family'], query['start'], query['end'], query['cloud'], int(complete), blob,
+                          len(blob), now, now))
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM searches').fetchone()[0]
+            for row in conn.execute('SELECT id, size FROM searches ORDER BY used').fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute('DELETE FROM searches WHERE id = ?', (row['id'],))
+                self._count(conn, 'evictions')
+                total -= row['size']
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def search(self, query, fetch, complete=None):
+        '''
+        Returns the results of a search from the cache, or from fetch (called without
+        arguments) which are then cached.
+
+        Parameters:
+        - query (dict): The search (see search_query).
+        - fetch (callable): Function running the search at the provider.
+        - complete (callable): Function telling if results are complete (see put), or None if always.
+        '''
+        results = self.get(query)
+        if results is None:
+            results = fetch()
+            self.put(query, results, complete is None or complete(results))
+        return results
+
+    def stats(self):
+        '''
+        Returns the counters of the cache (hits, narrowed, misses, evictions), its hit rate
+        (exact and filtered hits over all lookups), number of entries and size in bytes.
+        '''
+        conn = self._connect()
+        try:
+            stats = {'hits': 0, 'narrowed': 0, 'misses': 0, 'evictions': 0}
+            stats.update(conn.execute('SELECT name, value FROM counters').fetchall())
+            stats['entries'], stats['bytes'] = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM searches').fetchone()
+        finally:
+            conn.close()
+        lookups = stats['hits'] + stats['narrowed'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['narrowed']) / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,77 @@
+'''
+The modules of the app are flat: the tests import them from the app directory. The
+downloads are tested against a local HTTP server (the server fixture).
+'''
+
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+class FileServer(ThreadingHTTPServer):
+    '''
+    Serves the bytes of files, by URL path, with their ETag (honouring Range and If-Range)
+    and an optional Content-Disposition filename. Every request is logged as its
+    (method, path, Range, If-Range).
+    '''
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FileHandler)
+        self.files = {}
+        self.requests = []
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.server_port}{path}'
+
+    def serve(self, path, body, etag='"1"', filename=None):
+        self.files[path] = {'body': body, 'etag': etag, 'filename': filename}
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        range_header, if_range = self.headers.get('Range'), self.headers.get('If-Range')
+        self.server.requests.append((self.command, self.path, range_header, if_range))
+        file = self.server.files.get(self.path)
+        if file is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body, start = file['body'], 0
+        if range_header and (if_range is None or if_range == file['etag']):
+            start = int(range_header.split('=')[1].rstrip('-'))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        else:
+            self.send_response(200)
+        self.send_header('ETag', file['etag'])
+        if file['filename'] and not start:
+            self.send_header('Content-Disposition', f'attachment; filename="{file["filename"]}"')
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body[start:])
+
+
+@pytest.fixture
+def server():
+    server = FileServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
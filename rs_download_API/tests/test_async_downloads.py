@@ -0,0 +1,50 @@
+import time
+import pytest
+
+pytest.importorskip('aiohttp')
+from async_downloads import DownloadManager  # noqa: E402
+
+
+def wait(manager, job_id):
+    while manager.progress(job_id)['status'] not in ('done', 'failed', 'cancelled'):
+        time.sleep(0.02)
+    return manager.progress(job_id)
+
+
+def test_server_named_file_is_not_downloaded_again(server, tmp_path):
+    server.serve('/download/scene', b'L' * 10000, filename='LC08_scene.tar')
+    manager = DownloadManager()
+    files = [{'url': server.url('/download/scene'), 'path': str(tmp_path) + '/'}]
+    first = wait(manager, manager.submit('scene', lambda: files))
+    assert first['status'] == 'done'
+    assert (tmp_path / 'LC08_scene.tar').read_bytes() == b'L' * 10000
+    requests = len(server.requests)
+
+    second = wait(manager, manager.submit('scene', lambda: files))
+    assert (second['status'], second['skipped']) == ('done', 1)
+    assert len(server.requests) == requests
+
+
+def test_job_finishes_once_after_every_file(server, tmp_path):
+    for i in range(30):
+        server.serve(f'/f{i}', b'x' * 100)
+    finished = []
+    manager = DownloadManager(connections=4)
+    files = [{'url': server.url(f'/f{i}'), 'path': str(tmp_path / f'f{i}')} for i in range(30)]
+    progress = wait(manager, manager.submit('files', lambda: files, lambda: finished.append(True)))
+    time.sleep(0.2)
+    assert progress['done'] == 30
+    assert finished == [True]
+
+
+def test_truncated_file_is_downloaded_again(server, tmp_path):
+    server.serve('/whole', b'w' * 5000)
+    server.serve('/short', b's' * 5000)
+    (tmp_path / 'whole').write_bytes(b'w' * 5000)
+    (tmp_path / 'short').write_bytes(b's' * 1000)
+    manager = DownloadManager()
+    files = [{'url': server.url(path), 'path': str(tmp_path / path[1:])} for path in ('/whole', '/short')]
+    progress = wait(manager, manager.submit('files', lambda: files))
+    assert (progress['status'], progress['skipped']) == ('done', 1)
+    assert (tmp_path / 'short').read_bytes() == b's' * 5000
+    assert [request[:2] for request in server.requests if request[1] == '/whole'] == [('HEAD', '/whole')]
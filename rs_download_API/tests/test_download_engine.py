@@ -0,0 +1,56 @@
+import hashlib
+
+import pytest
+
+from download_engine import PART_SUFFIX, VALIDATOR_SUFFIX, ChecksumError, DownloadEngine
+
+BODY = bytes(range(256)) * 40
+
+
+def test_part_is_resumed_with_range_and_if_range(server, tmp_path):
+    server.serve('/file', BODY, etag='"v1"')
+    path = tmp_path / 'file'
+    (tmp_path / ('file' + PART_SUFFIX)).write_bytes(BODY[:4000])
+    (tmp_path / ('file' + PART_SUFFIX + VALIDATOR_SUFFIX)).write_text('"v1"')
+
+    written = DownloadEngine().download(server.url('/file'), str(path), hashlib.md5(BODY).hexdigest())
+    assert written == len(BODY) - 4000
+    assert path.read_bytes() == BODY
+    assert server.requests == [('GET', '/file', 'bytes=4000-', '"v1"')]
+    assert sorted(file.name for file in tmp_path.iterdir()) == ['file']
+
+
+def test_part_of_a_changed_file_is_restarted(server, tmp_path):
+    # The If-Range validator does not match: the server sends the whole file (200)
+    server.serve('/file', BODY, etag='"v2"')
+    path = tmp_path / 'file'
+    (tmp_path / ('file' + PART_SUFFIX)).write_bytes(b'old bytes' * 100)
+    (tmp_path / ('file' + PART_SUFFIX + VALIDATOR_SUFFIX)).write_text('"v1"')
+
+    written = DownloadEngine().download(server.url('/file'), str(path))
+    assert written == len(BODY)
+    assert path.read_bytes() == BODY
+    assert server.requests == [('GET', '/file', 'bytes=900-', '"v1"')]
+
+
+def test_checksum_mismatch_is_downloaded_once_more(server, tmp_path):
+    server.serve('/file', BODY)
+    path = tmp_path / 'file'
+    with pytest.raises(ChecksumError):
+        DownloadEngine().download(server.url('/file'), str(path), '0' * 32)
+    assert [request[:3] for request in server.requests] == [('GET', '/file', None)] * 2
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_existing_file_is_checked_against_content_length(server, tmp_path):
+    server.serve('/file', BODY)
+    path = tmp_path / 'file'
+    path.write_bytes(BODY)
+    engine = DownloadEngine()
+    assert engine.download(server.url('/file'), str(path)) == 0
+    assert [request[0] for request in server.requests] == ['HEAD']
+
+    # Left truncated by a downloader writing to the final path
+    path.write_bytes(BODY[:1000])
+    assert engine.download(server.url('/file'), str(path)) == len(BODY)
+    assert path.read_bytes() == BODY
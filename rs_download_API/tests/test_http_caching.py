@@ -0,0 +1,37 @@
+import gzip
+import os
+
+import pytest
+from flask import Flask
+
+from http_caching import register_http_caching
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEBMAP_COPY = os.path.join(APP_DIR, '..', 'excavations_webmap', 'http_caching.py')
+
+
+@pytest.mark.skipif(not os.path.exists(WEBMAP_COPY), reason='excavations_webmap is not checked out')
+def test_copy_matches_the_webmap_module():
+    path = os.path.join(APP_DIR, 'http_caching.py')
+    assert not os.path.islink(path)
+    with open(path, 'rb') as ours, open(WEBMAP_COPY, 'rb') as theirs:
+        assert ours.read() == theirs.read()
+
+
+def test_responses_are_compressed_and_revalidated():
+    server = Flask(__name__)
+    body = 'x' * 4096
+
+    @server.route('/page')
+    def page():
+        return body
+
+    register_http_caching(server)
+    client = server.test_client()
+    response = client.get('/page', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data).decode() == body
+    etag = response.headers['ETag']
+
+    response = client.get('/page', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 304
@@ -0,0 +1,135 @@
+import json
+import sqlite3
+import time
+
+import pytest
+
+from job_queue import JobConflict, JobQueue
+
+LANDSAT = {'username': 'alice', 'password': 'hunter2', 'scene_id': 'LC08_X', 'output_dir': '/tmp/landsat'}
+
+
+@pytest.fixture
+def db(tmp_path):
+    return str(tmp_path / 'jobs.sqlite')
+
+
+def test_password_is_never_written_to_the_database(db, tmp_path):
+    secrets = {}
+    queue = JobQueue(db, secrets=secrets)
+    job_id = queue.enqueue('landsat', 'LC08_X', LANDSAT)
+    for path in tmp_path.iterdir():
+        with open(path, 'rb') as file:
+            assert b'hunter2' not in file.read()
+    assert queue.get(job_id)['params'] == {'username': 'alice', 'scene_id': 'LC08_X', 'output_dir': '/tmp/landsat'}
+
+    job = queue.claim('worker-1')
+    assert job['params'] == LANDSAT
+    queue.finish(job_id, 'worker-1', {'status': 'done', 'events': []})
+    assert queue.get(job_id)['status'] == 'done'
+    assert job_id not in secrets
+
+
+def test_jobs_with_secrets_need_a_store(db):
+    with pytest.raises(ValueError):
+        JobQueue(db).enqueue('landsat', 'LC08_X', LANDSAT)
+
+
+def test_worker_without_store_takes_only_jobs_without_secrets(db):
+    JobQueue(db, secrets={}).enqueue('landsat', 'LC08_X', LANDSAT)
+    queue = JobQueue(db)
+    sentinel_id = queue.enqueue('sentinel', 'S2_X', {'scene': 'http://example/S2_X.SAFE', 'dst': '/tmp/s2'})
+    assert queue.claim('worker-1')['id'] == sentinel_id
+    assert queue.claim('worker-1') is None
+
+
+def test_job_with_lost_secrets_fails_without_retry(db):
+    job_id = JobQueue(db, secrets={}).enqueue('landsat', 'LC08_X', LANDSAT)
+    queue = JobQueue(db, secrets={})
+    assert queue.claim('worker-1') is None
+    job = queue.get(job_id)
+    assert job['status'] == 'failed'
+    assert 'request it again' in job['error']
+
+
+def test_duplicate_active_job_is_not_queued_again(db):
+    queue = JobQueue(db, secrets={})
+    job_id = queue.enqueue('landsat', 'LC08_X', LANDSAT)
+    assert queue.enqueue('landsat', 'LC08_X', dict(LANDSAT, password='changed')) == job_id
+    assert queue.secrets[job_id]['password'] == 'changed'
+    assert queue.counts() == {'queued': 1}
+
+    queue.claim('worker-1')
+    queue.finish(job_id, 'worker-1', {'status': 'done', 'events': []})
+    assert queue.enqueue('landsat', 'LC08_X', LANDSAT) != job_id
+
+
+def test_active_job_of_another_account_is_refused(db):
+    queue = JobQueue(db, secrets={})
+    job_id = queue.enqueue('landsat', 'LC08_X', LANDSAT)
+    with pytest.raises(JobConflict):
+        queue.enqueue('landsat', 'LC08_X', dict(LANDSAT, username='bob', password='other'))
+    assert queue.secrets[job_id]['password'] == 'hunter2'
+
+
+def test_expired_lease_queues_the_job_again(db):
+    queue = JobQueue(db, retry_delay=0, lease=0.05)
+    job_id = queue.enqueue('sentinel', 'S2_X', {'scene': 'http://example/S2_X.SAFE', 'dst': '/tmp/s2'})
+    queue.claim('worker-1')
+    assert queue.recover() == 0
+    time.sleep(0.1)
+    assert queue.recover() == 1
+    job = queue.get(job_id)
+    assert job['status'] == 'queued'
+    assert job['error'] == 'The worker of the job stopped'
+
+    assert queue.claim('worker-2')['attempts'] == 2
+    # The first worker no longer holds the job
+    assert not queue.update(job_id, 'worker-1', {'status': 'downloading', 'events': []})
+    assert queue.update(job_id, 'worker-2', {'status': 'downloading', 'events': []})
+
+
+def test_failed_job_is_retried_with_backoff(db):
+    queue = JobQueue(db, max_attempts=3, retry_delay=10)
+    job_id = queue.enqueue('sentinel', 'S2_X', {'scene': 'http://example/S2_X.SAFE', 'dst': '/tmp/s2'})
+    delays = []
+    for attempt in range(1, 3):
+        conn = sqlite3.connect(db)
+        conn.execute('UPDATE jobs SET run_after = 0 WHERE id = ?', (job_id,))
+        conn.commit()
+        conn.close()
+        assert queue.claim('worker-1')['attempts'] == attempt
+        before = time.time()
+        queue.finish(job_id, 'worker-1', error='timeout')
+        job = queue.get(job_id)
+        assert job['status'] == 'queued'
+        delays.append(job['run_after'] - before)
+        assert queue.claim('worker-1') is None
+    assert delays[0] == pytest.approx(10, abs=1)
+    assert delays[1] == pytest.approx(20, abs=1)
+
+    conn = sqlite3.connect(db)
+    conn.execute('UPDATE jobs SET run_after = 0 WHERE id = ?', (job_id,))
+    conn.commit()
+    conn.close()
+    queue.claim('worker-1')
+    queue.finish(job_id, 'worker-1', error='timeout')
+    assert queue.get(job_id)['status'] == 'failed'
+
+
+def test_old_database_is_cleared_of_its_secrets(db):
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, name TEXT NOT NULL,'
+                 ' params TEXT NOT NULL, key TEXT NOT NULL, status TEXT NOT NULL,'
+                 ' attempts INTEGER NOT NULL DEFAULT 0, max_attempts INTEGER NOT NULL, run_after REAL NOT NULL,'
+                 ' worker TEXT, heartbeat REAL, progress TEXT, error TEXT, created REAL NOT NULL,'
+                 ' updated REAL NOT NULL)')
+    conn.execute("INSERT INTO jobs VALUES ('old', 'landsat', 'LC08_X', ?, 'key', 'queued', 0, 3, 0,"
+                 ' NULL, NULL, NULL, NULL, 0, 0)', (json.dumps(LANDSAT),))
+    conn.commit()
+    conn.close()
+
+    queue = JobQueue(db, secrets={})
+    assert 'password' not in queue.get('old')['params']
+    assert queue.claim('worker-1') is None
+    assert queue.get('old')['status'] == 'failed'
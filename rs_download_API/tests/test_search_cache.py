@@ -0,0 +1,99 @@
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('shapely')
+from search_cache import SearchCache, search_query  # noqa: E402
+
+AREA = 'POLYGON ((22.3 38.5, 22.4 38.5, 22.4 38.6, 22.3 38.5))'
+BBOX = (22.3, 38.5, 22.4, 38.6)
+
+
+def sentinel_query(start, end, cloud=None):
+    return search_query('sentinel', 'Sentinel-2', 'S2MSI1C', AREA, start, end, cloud)
+
+
+def landsat_query(start, end, cloud=None):
+    return search_query('landsat', 'landsat_ot_c2_l2', None, BBOX, start, end, cloud)
+
+
+def products():
+    return OrderedDict((f'p{day}', {'beginposition': datetime(2023, 5, day, 10), 'cloudcoverpercentage': day * 3})
+                       for day in range(1, 31))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SearchCache(str(tmp_path / 'searches.sqlite'))
+
+
+def test_same_search_is_a_hit(cache):
+    query = sentinel_query('20230501', '20230531', 100)
+    assert cache.get(query) is None
+    cache.put(query, products())
+    assert cache.get(dict(query)) == products()
+    # Another footprint is another search
+    other = search_query('sentinel', 'Sentinel-2', 'S2MSI1C', 'POINT (22 38)', '20230501', '20230531', 100)
+    assert cache.get(other) is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 2, 1)
+
+
+def test_narrower_search_filters_a_cached_one(cache):
+    cache.put(sentinel_query('20230501', '20230531', 100), products())
+    results = cache.get(sentinel_query('20230510', '20230520', 45))
+    assert list(results) == [f'p{day}' for day in range(10, 16)]
+    assert cache.stats()['narrowed'] == 1
+
+
+def test_narrower_landsat_search_includes_its_end_date(cache):
+    scenes = [{'entity_id': day, 'acquisitionDate': f'2023-05-{day:02d} 09:30:00', 'cloudCover': 10}
+              for day in range(1, 31)]
+    cache.put(landsat_query('2023-05-01', '2023-05-31', 50), scenes)
+    results = cache.get(landsat_query('2023-05-10', '2023-05-12', 50))
+    assert results is not None
+    assert [scene['entity_id'] for scene in results] == [10, 11, 12]
+
+
+def test_truncated_results_answer_the_same_search_only(cache):
+    query = sentinel_query('20230501', '20230531', 100)
+    cache.put(query, products(), complete=False)
+    assert cache.get(sentinel_query('20230510', '20230520', 100)) is None
+    assert cache.get(query) == products()
+
+
+def test_results_without_cloud_cover_are_not_filtered_on_it(cache):
+    cache.put(sentinel_query('20230501', '20230531'), OrderedDict(p={'beginposition': datetime(2023, 5, 3)}))
+    assert cache.get(sentinel_query('20230501', '20230531', 20)) is None
+    assert list(cache.get(sentinel_query('20230502', '20230504'))) == ['p']
+
+
+def test_expired_results_are_not_used(tmp_path):
+    cache = SearchCache(str(tmp_path / 'searches.sqlite'), ttl=0.05)
+    query = sentinel_query('20230501', '20230531')
+    cache.put(query, products())
+    time.sleep(0.1)
+    assert cache.get(query) is None
+    # Dropped by the next put
+    cache.put(sentinel_query('20230601', '20230630'), products())
+    assert cache.stats()['entries'] == 1
+
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+    cache = SearchCache(str(tmp_path / 'searches.sqlite'), max_bytes=25000)
+    queries = [sentinel_query(f'2023{month:02d}01', f'2023{month:02d}28') for month in range(1, 4)]
+    for query in queries[:2]:
+        cache.put(query, os.urandom(10000))
+        time.sleep(0.01)
+    assert cache.get(queries[0]) is not None
+    cache.put(queries[2], os.urandom(10000))
+    assert cache.get(queries[1]) is None
+    assert cache.get(queries[0]) is not None and cache.get(queries[2]) is not None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_database_is_private(cache):
+    assert os.stat(cache.path).st_mode & 0o777 == 0o600
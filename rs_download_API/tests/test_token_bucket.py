@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip('aiohttp')
+from async_downloads import TokenBucket  # noqa: E402
+
+
+def elapsed(coroutine):
+    start = time.monotonic()
+    asyncio.run(coroutine)
+    return time.monotonic() - start
+
+
+def test_no_limit_does_not_wait():
+    async def consume():
+        bucket = TokenBucket(None)
+        await bucket.consume(10 ** 9)
+    assert elapsed(consume()) < 0.05
+
+
+def test_rate_limits_past_the_saved_tokens():
+    async def consume():
+        bucket = TokenBucket(100000, capacity=10000)
+        # The first 10000 bytes are saved up, the 40000 others take 0.4 s
+        for _ in range(5):
+            await bucket.consume(10000)
+    assert 0.35 < elapsed(consume()) < 0.8
+
+
+def test_amounts_larger_than_the_capacity_are_taken_in_parts():
+    async def consume():
+        bucket = TokenBucket(100000, capacity=10000)
+        await bucket.consume(30000)
+        assert bucket.tokens < 10000
+    assert 0.15 < elapsed(consume()) < 0.6
+
+
+def test_waiting_consumers_are_served_in_turn():
+    order = []
+
+    async def consumer(bucket, name):
+        await bucket.consume(5000)
+        order.append((name, time.monotonic()))
+
+    async def run():
+        bucket = TokenBucket(100000, capacity=5000)
+        await bucket.consume(5000)
+        await asyncio.gather(*(consumer(bucket, name) for name in 'abc'))
+
+    asyncio.run(run())
+    assert [name for name, _ in order] == ['a', 'b', 'c']
+    # One after the other, each waiting for its own 5000 tokens
+    assert order[2][1] - order[0][1] > 0.08
+
+
+def test_lower_rate_drops_the_saved_tokens():
+    async def consume():
+        bucket = TokenBucket(10 ** 6)
+        bucket.set_rate(50000)
+        assert bucket.tokens == 50000
+        await bucket.consume(60000)
+    assert 0.15 < elapsed(consume()) < 0.6